@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# vim: ts=4 sw=4 tw=80 et ai si
+"""Benchmark ister logging with swupd scale command output
+
+Runs a command printing as many lines as a swupd install through
+ister.run_command, once logging every line synchronously as ister used to
+and once with batched records and the background logging pipeline, and
+prints how long each took.
+"""
+
+#
+# This file is part of ister.
+#
+# Copyright (C) 2014 Intel Corporation
+#
+# ister is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by the
+# Free Software Foundation; version 3 of the License, or (at your
+# option) any later version.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program in a file named COPYING; if not, write to the
+# Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor,
+# Boston, MA 02110-1301 USA
+#
+
+import argparse
+import atexit
+import logging
+import os
+import tempfile
+import time
+
+import ister
+
+BATCH_LINES = ister.LOG_BATCH_LINES
+
+def run(lines, background, show_output):
+    """Time run_command printing lines lines, background selects the new
+    logging pipeline
+
+    Returns the seconds taken by run_command and until the log was fully
+    written.
+    """
+    ister.LOG = logging.getLogger("ister-benchmark-{0}".format(background))
+    ister.LOG.handlers = []
+    ister.LOG.propagate = False
+    with tempfile.TemporaryDirectory() as work_dir, \
+            open(os.devnull, "w") as console:
+        logfile = os.path.join(work_dir, "ister.log")
+        ister.handle_logging("info", logfile, logging.StreamHandler(console))
+        handlers = ister.LOG.handlers
+        listener = None
+        ister.LOG_BATCH_LINES = BATCH_LINES if background else 1
+        if background:
+            ister.LOG.handlers = []
+            handlers[0].addFilter(
+                ister.RateLimitFilter(ister.CONSOLE_LINES_PER_SECOND))
+            listener = ister.start_log_listener(handlers)
+        cmd = "seq -f 'Verifying file /usr/share/doc/%06g' {0}".format(lines)
+        start = time.monotonic()
+        ister.run_command(cmd, show_output=show_output)
+        command_time = time.monotonic() - start
+        if listener:
+            listener.stop()
+            atexit.unregister(listener.stop)
+        total_time = time.monotonic() - start
+        for handler in handlers:
+            handler.close()
+    return command_time, total_time
+
+
+def main():
+    """Print the benchmark results"""
+    parser = argparse.ArgumentParser(prog='benchmark_logging')
+    parser.add_argument("-n", "--lines", type=int, default=200000,
+                        help="Output lines of the command, default=200000")
+    args = parser.parse_args()
+
+    print("{0:<12} {1:<12} {2:>10} {3:>10}".format("logging", "output",
+                                                   "command", "flushed"))
+    for show_output in [False, True]:
+        for background in [False, True]:
+            command_time, total_time = run(args.lines, background,
+                                           show_output)
+            print("{0:<12} {1:<12} {2:>9.2f}s {3:>9.2f}s".format(
+                "background" if background else "per line",
+                "console" if show_output else "log file",
+                command_time, total_time))
+
+
+if __name__ == '__main__':
+    main()
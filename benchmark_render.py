@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# vim: ts=4 sw=4 tw=80 et ai si
+"""Benchmark redrawing the mount points screen of a 64 partition machine
+
+Sets the mount point of every partition in turn, once building the widgets
+and form again for each change as ister_gui used to and once updating the
+changed row of the kept form, rendering the screen after each change, and
+prints how long each took.
+"""
+
+#
+# This file is part of ister.
+#
+# Copyright (C) 2014 Intel Corporation
+#
+# ister is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by the
+# Free Software Foundation; version 3 of the License, or (at your
+# option) any later version.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program in a file named COPYING; if not, write to the
+# Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor,
+# Boston, MA 02110-1301 USA
+#
+
+import argparse
+import time
+
+import ister_gui
+
+SCREEN = (ister_gui.MAX_WIDTH, ister_gui.MAX_HEIGHT)
+
+
+def mount_points_step(partitions):
+    """Return a MountPointsStep showing partitions partitions of two disks"""
+    step = ister_gui.MountPointsStep(1, 2)
+    step.choices = []
+    for number in range(partitions):
+        disk = "sda" if number < partitions // 2 else "sdb"
+        step.choices.append(step.display_fmt.format(
+            "{0}{1}".format(disk, number + 1), "1G", "Linux filesystem",
+            "", ""))
+    step.build_ui_widgets()
+    step.build_ui()
+    return step
+
+
+def run(partitions, reuse):
+    """Time changing the mount point of every partition, reuse selects
+    updating the kept form
+
+    Returns the seconds taken.
+    """
+    step = mount_points_step(partitions)
+    step._ui._ui.render(SCREEN, focus=True)
+    start = time.monotonic()
+    for idx, choice in enumerate(list(step.choices)):
+        choice = step.display_fmt.format(choice.split()[0], "1G",
+                                         "Linux filesystem",
+                                         "/mnt/{0}".format(idx), "Yes")
+        if reuse:
+            step._set_choice(idx, choice)
+        else:
+            step.choices[idx] = choice
+            step.build_ui_widgets()
+            step.build_ui()
+        step._ui._ui.render(SCREEN, focus=True)
+    return time.monotonic() - start
+
+
+def main():
+    """Print the benchmark results"""
+    parser = argparse.ArgumentParser(prog='benchmark_render')
+    parser.add_argument("-n", "--partitions", type=int, default=64,
+                        help="Partitions on the machine, default=64")
+    args = parser.parse_args()
+
+    print("{0:<10} {1:>10} {2:>12}".format("widgets", "total",
+                                           "per change"))
+    for reuse in [False, True]:
+        elapsed = run(args.partitions, reuse)
+        print("{0:<10} {1:>8.1f}ms {2:>10.2f}ms".format(
+            "kept" if reuse else "rebuilt", elapsed * 1000,
+            elapsed * 1000 / args.partitions))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# vim: ts=4 sw=4 tw=80 et ai si
+"""Benchmark ister and ister_gui cold start
+
+Times importing ister, importing ister_gui and getting the first installer
+screen rendered (the installer steps built and the splash screen drawn to a
+canvas), each in a fresh interpreter, and checks that the dependencies only
+some code paths need are not imported at start up.
+
+Timings are compared as ratios to the start of an interpreter running
+nothing, `python3 -c pass`, so a baseline holds on a slower or faster
+machine. With --save the ratios are written to a baseline file. They are
+compared to the --baseline one, by default the benchmark_startup.json budget
+next to this script, and the exit status is 1 when a ratio regressed by more
+than the tolerance or a deferred module got imported eagerly.
+"""
+
+#
+# This file is part of ister.
+#
+# Copyright (C) 2014 Intel Corporation
+#
+# ister is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by the
+# Free Software Foundation; version 3 of the License, or (at your
+# option) any later version.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program in a file named COPYING; if not, write to the
+# Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor,
+# Boston, MA 02110-1301 USA
+#
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+# Budget of every benchmark as a ratio to the interpreter start, refreshed
+# with --save
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        "benchmark_startup.json")
+# Modules only needed by encryption, cloud-init, network checks or the
+# install itself, none of them may be loaded to show the first screen
+DEFERRED = {
+    "ister": ["pycryptsetup", "netifaces", "urllib.request", "ctypes"],
+    "ister_gui": ["ister", "pycryptsetup", "netifaces", "pycurl",
+                  "urllib.request", "crypt"],
+}
+
+FIRST_SCREEN = """
+gui = ister_gui
+gui.LINES, gui.COLUMNS = 16, 72
+ins = gui.Installation.__new__(gui.Installation)
+ins.args = {"contenturl": None, "versionurl": None}
+ins._steps = []
+ins.start = gui.SplashScreen()
+ins._init_actions()
+gui.prefetch_steps(ins.start)
+ins.start.build_ui_widgets()
+ins.start.build_ui()
+ins.start._ui._ui.render((80, 24), focus=True)
+"""
+
+MEASURE = """
+import sys, time
+start = time.perf_counter()
+import {module}
+{extra}
+elapsed = time.perf_counter() - start
+print(elapsed, *[name for name in {deferred!r} if name in sys.modules])
+"""
+
+
+def measure(module, first_screen=False):
+    """Time importing module (and showing the first screen) in a fresh
+    interpreter
+
+    Returns the seconds taken and the deferred modules that got loaded.
+    """
+    code = MEASURE.format(module=module, deferred=DEFERRED[module],
+                          extra=FIRST_SCREEN if first_screen else "")
+    with open(os.devnull, "w") as devnull:
+        out = subprocess.check_output(
+            [sys.executable, "-c", code], stderr=devnull,
+            cwd=os.path.dirname(os.path.abspath(__file__)))
+    fields = out.decode("utf-8").split()
+    return float(fields[0]), fields[1:]
+
+
+def interpreter_start():
+    """Return the seconds taken to start and exit an interpreter"""
+    start = time.perf_counter()
+    subprocess.check_call([sys.executable, "-c", "pass"])
+    return time.perf_counter() - start
+
+
+def run(runs):
+    """Return the median timings in milliseconds, the median interpreter
+    start in milliseconds and the eagerly imported modules of every benchmark
+    """
+    benchmarks = [("ister import", "ister", False),
+                  ("ister_gui import", "ister_gui", False),
+                  ("first screen", "ister_gui", True)]
+    timings = {}
+    eager = {}
+    for name, module, first_screen in benchmarks:
+        results = []
+        for _ in range(runs):
+            elapsed, loaded = measure(module, first_screen)
+            results.append(elapsed * 1000)
+        timings[name] = sorted(results)[len(results) // 2]
+        eager[name] = loaded
+    starts = sorted(interpreter_start() * 1000 for _ in range(runs))
+    return timings, starts[len(starts) // 2], eager
+
+
+def main():
+    """Print the benchmark results, exit 1 on a regression"""
+    parser = argparse.ArgumentParser(prog='benchmark_startup')
+    parser.add_argument("-n", "--runs", type=int, default=5,
+                        help="Interpreters started per benchmark, default=5")
+    parser.add_argument("-b", "--baseline", action="store", default=BASELINE,
+                        help="Baseline file to compare the timings to, "
+                             "default=benchmark_startup.json, '' for none")
+    parser.add_argument("-s", "--save", action="store", default=None,
+                        help="Write the timings to this baseline file")
+    parser.add_argument("-t", "--tolerance", type=float, default=20,
+                        help="Allowed slowdown in percent, default=20")
+    args = parser.parse_args()
+
+    timings, reference, eager = run(args.runs)
+    ratios = {x: y / reference for x, y in timings.items()}
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+
+    failed = False
+    print("interpreter start {0:.1f}ms".format(reference))
+    print("{0:<18} {1:>10} {2:>6} {3:>8}  {4}".format(
+        "benchmark", "median", "ratio", "baseline", "eager imports"))
+    for name, elapsed in timings.items():
+        budget = ""
+        if name in baseline:
+            budget = "{0:8.2f}".format(baseline[name])
+            if ratios[name] > baseline[name] * (1 + args.tolerance / 100):
+                budget += " REGRESSED"
+                failed = True
+        if eager[name]:
+            failed = True
+        print("{0:<18} {1:>8.1f}ms {2:>6.2f} {3:>8}  {4}".format(
+            name, elapsed, ratios[name], budget, " ".join(eager[name])))
+
+    if args.save:
+        with open(args.save, "w") as baseline_file:
+            json.dump({x: round(y, 2) for x, y in ratios.items()},
+                      baseline_file, indent=4, sort_keys=True)
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
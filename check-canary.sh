@@ -32,5 +32,5 @@ else
         rc=1
 fi
 sudo /usr/bin/umount $mnt
-sudo /usr/bin/losetup -D
+sudo /usr/bin/losetup -d ${next_dev}
 exit $rc
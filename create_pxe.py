@@ -0,0 +1,315 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# vim: ts=4 sw=4 tw=80 et ai si
+"""Build the PXE boot artifacts from a provision image
+
+Mounts the root partition of the image read only, at the offset read from
+its partition table, and streams the files into a newc cpio initrd without
+copying the tree. The initrd is made of one compressed cpio archive per
+part of the tree, which the kernel unpacks in order. Parts whose files did
+not change since the previous build are reused from the cache, the others
+are compressed concurrently with a multi-threaded codec. The initrd and the
+kernel are then packed into the PXE tarball.
+
+Needs to run as root to mount the image and read every file.
+"""
+
+#
+# This file is part of ister.
+#
+# Copyright (C) 2014 Intel Corporation
+#
+# ister is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by the
+# Free Software Foundation; version 3 of the License, or (at your
+# option) any later version.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program in a file named COPYING; if not, write to the
+# Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor,
+# Boston, MA 02110-1301 USA
+#
+
+import argparse
+import concurrent.futures
+import glob
+import hashlib
+import os
+import shutil
+import stat
+import struct
+import subprocess
+import sys
+import tempfile
+
+SECTOR_SIZE = 512
+# Top level directories of the image left out of the initrd
+EXCLUDE = ["boot", "home", "lib64", "lost+found", "media", "mnt", "root",
+           "srv", "var"]
+# Symbolic links added to the initrd, name and target
+LINKS = [("lib64", "/usr/lib64/"), ("init", "/usr/lib/systemd/systemd")]
+KERNEL_GLOB = "lib/kernel/org.clearlinux.native*"
+# Compressors writing stdin compressed to stdout, the first one found on the
+# path is used. xz needs crc32 checks for the kernel to unpack the initrd.
+CODECS = {
+    "gzip": [["pigz", "-{level}"], ["gzip", "-{level}"]],
+    "xz": [["xz", "-T0", "--check=crc32", "-{level}"]],
+    "zstd": [["zstd", "-T0", "-q", "-{level}"]],
+}
+CHUNK_SIZE = 1024 * 1024
+# Name prefix of the initrd parts in the cache, only those are pruned
+PART_PREFIX = "initrd-part-"
+
+
+def partition_offset(image, number):
+    """Return the byte offset of partition number of a GPT or MBR image"""
+    with open(image, "rb") as disk:
+        mbr = disk.read(SECTOR_SIZE)
+        header = disk.read(SECTOR_SIZE)
+        if header[:8] == b"EFI PART":
+            entries_lba, entries, entry_size = struct.unpack_from(
+                "<QII", header, 72)
+            if not 0 < number <= entries:
+                raise Exception("{0} has no partition {1}"
+                                .format(image, number))
+            disk.seek(entries_lba * SECTOR_SIZE +
+                      (number - 1) * entry_size)
+            entry = disk.read(entry_size)
+            first_lba = struct.unpack_from("<Q", entry, 32)[0]
+        elif mbr[510:512] == b"\x55\xaa" and 0 < number <= 4:
+            first_lba = struct.unpack_from("<I", mbr,
+                                           446 + (number - 1) * 16 + 8)[0]
+        else:
+            raise Exception("{0} has no partition {1}".format(image, number))
+    if not first_lba:
+        raise Exception("{0} has no partition {1}".format(image, number))
+    return first_lba * SECTOR_SIZE
+
+
+def compressor(codec, level):
+    """Return the command compressing with codec at level"""
+    for cmd in CODECS[codec]:
+        if shutil.which(cmd[0]):
+            return [part.format(level=level) for part in cmd]
+    raise Exception("No compressor found for {0}".format(codec))
+
+
+def walk_tree(root):
+    """Return the (name, lstat) of the files of root going into the initrd,
+    parents before their children"""
+    entries = []
+    for dirpath, dirnames, filenames in os.walk(root):
+        rel = os.path.relpath(dirpath, root)
+        if rel == ".":
+            dirnames[:] = [name for name in dirnames if name not in EXCLUDE]
+            filenames = [name for name in filenames
+                         if name not in EXCLUDE and
+                         name not in [link[0] for link in LINKS]]
+        dirnames.sort()
+        for name in sorted(dirnames) + sorted(filenames):
+            path = os.path.normpath(os.path.join(rel, name))
+            entries.append((path, os.lstat(os.path.join(root, path))))
+    return entries
+
+
+def split_tree(entries):
+    """Split the entries into the parts of the initrd
+
+    The directories come first so every part unpacks into existing
+    directories, the files are split by their first two path components.
+    """
+    parts = {"directories": []}
+    for name, info in entries:
+        if stat.S_ISDIR(info.st_mode):
+            parts["directories"].append((name, info))
+        else:
+            key = "/".join(name.split("/")[:2])
+            parts.setdefault(key, []).append((name, info))
+    return parts
+
+
+def part_key(entries, codec, level):
+    """Return the hash of everything the compressed part depends on"""
+    sha = hashlib.sha256("{0}-{1}".format(codec, level).encode("utf-8"))
+    for name, info in entries:
+        sha.update("{0}\0{1}\0{2}\0{3}\0{4}\0{5}\0{6}\n".format(
+            name, info.st_mode, info.st_uid, info.st_gid, info.st_size,
+            info.st_mtime_ns, info.st_rdev).encode("utf-8"))
+    return sha.hexdigest()
+
+
+def cpio_header(name, size, mode, uid=0, gid=0, mtime=0, rdev=0):
+    """Return the newc header and name of an entry
+
+    Inode numbers are 0, they would change the cached parts of every build
+    and every entry has a single link anyway.
+    """
+    name = name.encode("utf-8") + b"\0"
+    fields = [0, mode, uid, gid, 1, int(mtime), size, 0, 0,
+              os.major(rdev), os.minor(rdev), len(name), 0]
+    header = b"070701" + b"".join(b"%08X" % field for field in fields)
+    header += name
+    return header + b"\0" * (-len(header) % 4)
+
+
+def write_entry(out, name, info, data=None):
+    """Write the newc entry of name to out, data is the file contents, a
+    file object of a regular file or the bytes of a link target"""
+    size = 0
+    if isinstance(data, bytes):
+        size = len(data)
+    elif data:
+        size = info.st_size
+    out.write(cpio_header(name, size, info.st_mode, info.st_uid,
+                          info.st_gid, info.st_mtime, info.st_rdev))
+    if isinstance(data, bytes):
+        out.write(data)
+    elif data:
+        written = 0
+        for chunk in iter(lambda: data.read(CHUNK_SIZE), b""):
+            out.write(chunk)
+            written += len(chunk)
+        if written != size:
+            raise Exception("{0} changed while read".format(name))
+    out.write(b"\0" * (-size % 4))
+
+
+def write_trailer(out):
+    """Write the entry ending a newc archive to out"""
+    out.write(cpio_header("TRAILER!!!", 0, 0))
+
+
+def write_cpio(out, root, entries):
+    """Stream the newc cpio archive of entries to out"""
+    for name, info in entries:
+        path = os.path.join(root, name)
+        if stat.S_ISLNK(info.st_mode):
+            write_entry(out, name, info, os.readlink(path).encode("utf-8"))
+        elif stat.S_ISREG(info.st_mode):
+            with open(path, "rb") as infile:
+                write_entry(out, name, info, infile)
+        else:
+            write_entry(out, name, info)
+    write_trailer(out)
+
+
+def write_links(out):
+    """Write the newc cpio archive of the LINKS to out"""
+    for name, target in LINKS:
+        data = target.encode("utf-8")
+        out.write(cpio_header(name, len(data), stat.S_IFLNK | 0o777))
+        out.write(data + b"\0" * (-len(data) % 4))
+    write_trailer(out)
+
+
+def compress(cmd, path, write, *args):
+    """Write the archive written by write(out, *args) to path compressed by
+    cmd"""
+    with open(path + ".tmp", "wb") as outfile:
+        proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=outfile)
+        try:
+            write(proc.stdin, *args)
+        finally:
+            proc.stdin.close()
+            status = proc.wait()
+    if status != 0:
+        os.remove(path + ".tmp")
+        raise Exception("{0} failed".format(" ".join(cmd)))
+    os.rename(path + ".tmp", path)
+
+
+def build_initrd(root, initrd, cache_dir, codec, level, jobs):
+    """Build initrd from the tree at root, reusing the cached parts
+
+    Returns the number of parts built and reused.
+    """
+    cmd = compressor(codec, level)
+    os.makedirs(cache_dir, exist_ok=True)
+    parts = split_tree(walk_tree(root))
+    paths = []
+    pending = []
+    for name in sorted(parts, key=lambda part: part != "directories"):
+        entries = parts[name]
+        path = os.path.join(cache_dir, PART_PREFIX +
+                            part_key(entries, codec, level) + ".cpio")
+        paths.append(path)
+        if not os.path.exists(path):
+            pending.append((entries, path))
+
+    with concurrent.futures.ThreadPoolExecutor(jobs) as executor:
+        builds = [executor.submit(compress, cmd, path, write_cpio, root,
+                                  entries)
+                  for entries, path in pending]
+        for build in builds:
+            build.result()
+
+    compress(cmd, initrd, write_links)
+    with open(initrd, "ab") as outfile:
+        for path in paths:
+            with open(path, "rb") as part:
+                shutil.copyfileobj(part, outfile, CHUNK_SIZE)
+
+    # parts of older builds are not used any more
+    for path in glob.glob(os.path.join(cache_dir, PART_PREFIX + "*.cpio")):
+        if path not in paths:
+            os.remove(path)
+    return len(pending), len(paths) - len(pending)
+
+
+def handle_options():
+    """Setup option parsing"""
+    parser = argparse.ArgumentParser(prog='create_pxe')
+    parser.add_argument("-i", "--image", default="provision.img",
+                        help="Image to build from, default=provision.img")
+    parser.add_argument("-p", "--partition", type=int, default=2,
+                        help="Root partition number, default=2")
+    parser.add_argument("-o", "--output", default="clear-pxe.tar.xz",
+                        help="PXE tarball, default=clear-pxe.tar.xz")
+    parser.add_argument("-c", "--codec", choices=sorted(CODECS),
+                        default="gzip", help="initrd compression, "
+                        "default=gzip")
+    parser.add_argument("-l", "--level", type=int, default=6,
+                        help="Compression level, default=6")
+    parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count(),
+                        help="Parts compressed at once, default=CPUs")
+    parser.add_argument("-C", "--cache", default=".pxe-cache",
+                        help="Directory keeping the initrd parts between "
+                             "builds, default=.pxe-cache")
+    return parser.parse_args()
+
+
+def main():
+    """Build the PXE tarball"""
+    args = handle_options()
+    if os.geteuid() != 0:
+        print("Error: must run as root to mount {0}".format(args.image))
+        sys.exit(1)
+
+    offset = partition_offset(args.image, args.partition)
+    with tempfile.TemporaryDirectory() as work_dir:
+        mnt = os.path.join(work_dir, "mnt")
+        os.mkdir(mnt)
+        subprocess.check_call(["mount", "-o",
+                               "loop,ro,offset={0}".format(offset),
+                               args.image, mnt])
+        try:
+            initrd = os.path.join(work_dir, "initrd")
+            built, reused = build_initrd(mnt, initrd, args.cache, args.codec,
+                                         args.level, args.jobs)
+            print("initrd: {0} parts built, {1} reused".format(built, reused))
+            kernels = glob.glob(os.path.join(mnt, KERNEL_GLOB))
+            if not kernels:
+                raise Exception("No kernel found in {0}".format(args.image))
+            cmd = ["tar", "-I", " ".join(compressor("xz", 9)), "-cf",
+                   args.output, "-C", work_dir, "initrd"]
+            cmd.extend(["-C", os.path.dirname(kernels[0])])
+            cmd.extend(os.path.basename(kernel) for kernel in kernels)
+            subprocess.check_call(cmd)
+        finally:
+            subprocess.check_call(["umount", mnt])
+    print("Created {0}".format(args.output))
+
+
+if __name__ == '__main__':
+    main()
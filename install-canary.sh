@@ -29,13 +29,13 @@ sudo /usr/bin/mount ${next_dev}p3 $mnt
 if [ ! -e ${mnt}/usr/bin ]
 then
         echo "Install to installer-target.img failed"
-        sudo /usr/bin/losetup -D
+        sudo /usr/bin/losetup -d ${next_dev}
         exit 1
 else
         sudo /usr/bin/cp -f boot-canary.sh ${mnt}/usr/bin/boot-canary.sh
         sudo /usr/bin/cp -f boot-canary.service ${mnt}/usr/lib/systemd/system/boot-canary.service
         sudo /usr/bin/ln -f -s ../boot-canary.service ${mnt}/usr/lib/systemd/system/multi-user.target.wants
         sudo /usr/bin/umount $mnt
-        sudo /usr/bin/losetup -D
+        sudo /usr/bin/losetup -d ${next_dev}
         echo "Canary script and service installed to $1"
 fi
@@ -34,15 +34,14 @@
 # logic for partition creation was born to be ugly, good spot for cleanup
 # though for the adventurous sort
 # pylint: disable=too-many-branches
-# We aren't worried too much about performance of ister itself here, so using
-# .format() for the logging functions (which always formats the string) is ok.
-# pylint: disable=logging-format-interpolation
 
 
 import argparse
-import ctypes
+import atexit
+import hashlib
 import json
 import logging
+import logging.handlers
 import os
 import pwd
 import re
@@ -59,18 +58,74 @@ import binascii
 import codecs
 import errno
 import fcntl
+import functools
 import queue
 import select
 import threading
 import traceback
-import urllib.request as request
-from urllib.error import URLError, HTTPError
 from urllib.parse import urlparse
 from contextlib import closing
-import netifaces
-import pycryptsetup
 
 LOG = None
+# Console records per second shown by the background logging pipeline
+CONSOLE_LINES_PER_SECOND = 20
+# Most command output lines logged in a single record
+LOG_BATCH_LINES = 1000
+# Progress of the running software install, see start_progress
+PROGRESS = None
+# Functions called with the progress summary on every report
+PROGRESS_LISTENERS = []
+# Seconds between progress reports
+PROGRESS_INTERVAL = 5
+# Install telemetry served by the metrics endpoint, see start_metrics
+METRICS = {"phase": "starting", "phase_started": time.time(),
+           "phase_seconds": {}, "commands": 0, "command_failures": 0,
+           "command_seconds": 0.0, "template": None}
+
+# Write optimized mount options used while the OS is copied with --tune-io
+INSTALL_MOUNT_OPTIONS = {"ext2": "noatime", "ext3": "noatime,commit=60",
+                         "ext4": "noatime,commit=60",
+                         "btrfs": "noatime,commit=120", "vfat": "noatime",
+                         "xfs": "noatime"}
+# Kernel defaults restored by remounting before the target is unmounted
+PRODUCTION_MOUNT_OPTIONS = {"ext2": "relatime", "ext3": "relatime,commit=5",
+                            "ext4": "relatime,commit=5",
+                            "btrfs": "relatime,commit=30", "vfat": "relatime",
+                            "xfs": "relatime"}
+# Writeback limits raised while the OS is copied with --tune-io
+INSTALL_VM_SETTINGS = {"/proc/sys/vm/dirty_ratio": "40",
+                       "/proc/sys/vm/dirty_background_ratio": "20",
+                       "/proc/sys/vm/dirty_expire_centisecs": "6000"}
+INSTALL_READ_AHEAD_KB = "4096"
+
+# Journaled install phases in order with the template entries and options
+# their result depends on
+INSTALL_PHASES = [
+    ("partitions", ["DestinationType", "PartitionLayout",
+                    "DisabledNewPartitions"], []),
+    ("filesystems", ["FilesystemTypes", "PartitionMountPoints", "LegacyBios"],
+     []),
+    ("copy_os", ["Version", "Bundles", "SoftwareManager"],
+     ["contenturl", "versionurl", "format", "dnf_config"]),
+    ("users", ["Users"], []),
+    ("configuration", ["Hostname", "MirrorURL", "VersionURL", "Static_IP",
+                       "cmdline", "IsterCloudInitSvc"], []),
+    ("post_install", ["PostNonChroot", "PostNonChrootShell", "PostChroot",
+                      "PostChrootShell"], []),
+]
+JOURNAL_FILE = "var/lib/ister/journal.json"
+# Inputs of the phases applied to the target, read back when converging
+APPLIED_FILE = "var/lib/ister/applied.json"
+# Seconds to wait for ister-cloud-init-svc to answer for an interface
+CLOUD_INIT_TIMEOUT = 5
+# ister-cloud-init-svc answers are kept here for the rest of the boot
+CLOUD_INIT_CACHE_DIR = "/run/ister"
+# Set in the environment to always query ister-cloud-init-svc, e.g. after
+# changing the configs of the machine
+CLOUD_INIT_NO_CACHE_ENV = "ISTER_CLOUD_INIT_NO_CACHE"
+# "mac" field of the configs ister-cloud-init-svc answers for the machines
+# it does not list
+CLOUD_INIT_DEFAULT_MAC = "default"
 
 def extract_full_lines(text):
     """Extract full lines from string 'text'. Return a tuple containing 2 elements
@@ -147,20 +202,30 @@ def wait_for_process(proc, log_output, show_output):
 
     output = ([], [])
     try:
-        while True:
-            streamid, line = info["queue"].get()
-            if line is not None:
-                output[streamid].append(line)
-                if show_output:
-                    LOG.info(line)
-                elif log_output:
-                    LOG.debug(line)
-            else:
-                # 'None' means "no more output".
-                threads[streamid].join()
-                threads[streamid] = None
-                if all(thread is None for thread in threads):
-                    break
+        while any(thread is not None for thread in threads):
+            # Log the lines already queued as one record instead of one
+            # record per line.
+            batch = [info["queue"].get()]
+            try:
+                while len(batch) < LOG_BATCH_LINES:
+                    batch.append(info["queue"].get_nowait())
+            except queue.Empty:
+                pass
+            lines = []
+            for streamid, line in batch:
+                if line is not None:
+                    output[streamid].append(line)
+                    lines.append(line)
+                    if PROGRESS is not None:
+                        update_progress(PROGRESS, line)
+                else:
+                    # 'None' means "no more output".
+                    threads[streamid].join()
+                    threads[streamid] = None
+            if lines and show_output:
+                LOG.info("\n".join(lines))
+            elif lines and log_output:
+                LOG.debug("\n".join(lines))
     finally:
         # Make sure threads always exit.
         info["die_now"] = True
@@ -182,8 +247,10 @@ def run_command(cmd, raise_exception=True, log_output=True, environ=None,
     """
 
     result = ([], [], -1)
+    start = time.monotonic()
+    METRICS["commands"] += 1
     try:
-        LOG.debug("Running command {0}".format(cmd))
+        LOG.debug("Running command %s", cmd)
         sys.stdout.flush()
         if shell:
             full_cmd = cmd
@@ -194,6 +261,9 @@ def run_command(cmd, raise_exception=True, log_output=True, environ=None,
                                 shell=shell)
         result = wait_for_process(proc, log_output, show_output)
         _, stderr, exitcode = result
+        METRICS["command_seconds"] += time.monotonic() - start
+        if exitcode:
+            METRICS["command_failures"] += 1
         if exitcode and raise_exception:
             if stderr:
                 LOG.debug("\n".join(stderr))
@@ -206,25 +276,27 @@ def run_command(cmd, raise_exception=True, log_output=True, environ=None,
 def validate_network(url):
     """Validate there is network connection to swupd
     """
+    import urllib.request as request
+    from urllib.error import URLError, HTTPError
+
     LOG.info("Verifying network connection")
     url = url if url else "https://update.clearlinux.org"
     try:
         _ = request.urlopen(url, timeout=3)
     except HTTPError as exep:
         if hasattr(exep, 'code'):
-            LOG.info("SWUPD server error: {0}".format(exep.code))
+            LOG.info("SWUPD server error: %s", exep.code)
             raise exep
     except URLError as exep:
         if hasattr(exep, 'reason'):
-            LOG.info("Network error: Cannot reach swupd server: {0}"
-                     .format(exep.reason))
+            LOG.info("Network error: Cannot reach swupd server: %s",
+                     exep.reason)
             raise exep
 
 
-def create_virtual_disk(template):
-    """Create virtual disk file for install target
+def virtual_disk_command(template):
+    """Return the command creating the virtual disk file for install target
     """
-    LOG.info("Creating virtual disk")
     image_size = 0
     # number of kilobytes in each of the following
     match = {"M": 1024, "G": 1024 ** 2, "T": 1024 ** 3}
@@ -236,15 +308,22 @@ def create_virtual_disk(template):
     # Increase buffer by 1MB to give parted wiggle room due to dd using 1K
     # sector sizes and parted is getting partition sizes specified in MiB.
     image_size += 1024
-    command = "dd if=/dev/zero of={0} bs=1024 count=0 seek={1}".\
-              format(template["PartitionLayout"][0]["disk"], image_size)
-    run_command(command)
+    return "dd if=/dev/zero of={0} bs=1024 count=0 seek={1}".\
+           format(template["PartitionLayout"][0]["disk"], image_size)
 
 
-def create_partitions(template, sleep_time=1):
-    """Create partitions according to template configuration
+def create_virtual_disk(template):
+    """Create virtual disk file for install target
     """
-    LOG.info("Creating partitions")
+    LOG.info("Creating virtual disk")
+    run_command(virtual_disk_command(template))
+
+
+def partition_commands(template):
+    """Return the list of (disk, command) pairs creating the partitions
+    according to template configuration
+    """
+    commands = []
     match = {"M": 1, "G": 1024, "T": 1024 * 1024}
     parted = "parted -sa"
     alignment = "optimal"
@@ -255,15 +334,13 @@ def create_partitions(template, sleep_time=1):
         disks.add(disk["disk"])
     # Setup GPT tables on disks
     for disk in sorted(disks):
-        LOG.debug("Creating GPT label in {0}".format(disk))
         if template.get("DestinationType") == "physical":
             command = "{0} {1} /dev/{2} {3} mklabel gpt".\
                       format(parted, alignment, disk, units)
         else:
             command = "{0} {1} {2} {3} mklabel gpt".\
                       format(parted, alignment, disk, units)
-        run_command(command)
-        time.sleep(sleep_time)
+        commands.append((disk, command))
     # Create partitions
     for part in sorted(template["PartitionLayout"], key=lambda v: v["disk"] +
                        str(v["partition"])):
@@ -284,7 +361,6 @@ def create_partitions(template, sleep_time=1):
             # Using 0% on the first partition to get the first 1MB
             # border that is correctly aligned
             start = "0%"
-        LOG.debug("Creating partition {0} in {1}".format(ptype, part["disk"]))
         if template.get("DestinationType") == "physical":
             command = "{0} {1} -- /dev/{2} {3} mkpart primary {4} {5} {6}"\
                 .format(parted, alignment, part["disk"], units, ptype,
@@ -293,8 +369,7 @@ def create_partitions(template, sleep_time=1):
             command = "{0} {1} -- {2} {3} mkpart primary {4} {5} {6}"\
                 .format(parted, alignment, part["disk"], units, ptype,
                         start, end)
-        run_command(command)
-        time.sleep(sleep_time)
+        commands.append((part["disk"], command))
         if part["type"] == "EFI":
             if template.get("DestinationType") == "physical":
                 command = "parted -s /dev/{0} set {1} boot on"\
@@ -302,10 +377,20 @@ def create_partitions(template, sleep_time=1):
             else:
                 command = "parted -s {0} set {1} boot on"\
                     .format(part["disk"], part["partition"])
-            run_command(command)
-            time.sleep(sleep_time)
+            commands.append((part["disk"], command))
         start = end
         cdisk = part["disk"]
+    return commands
+
+
+def create_partitions(template, sleep_time=1):
+    """Create partitions according to template configuration
+    """
+    LOG.info("Creating partitions")
+    for disk, command in partition_commands(template):
+        LOG.debug("Partitioning %s", disk)
+        run_command(command)
+        time.sleep(sleep_time)
 
 
 def map_loop_device(template, sleep_time=1):
@@ -352,10 +437,17 @@ def get_device_name(template, disk):
     raise Exception("No partitions found on /dev/{}".format(disk))
 
 
-def create_filesystems(template):
-    """Create filesystems according to template configuration
-    """
+def swap_typecode_command(base_dev, partition):
+    """Return the command setting the swap GPT type GUID on a partition"""
+    return "sgdisk {0} --typecode={1}:0657fd6d-a4ab-43c4-84e5-0933c84b4f4f"\
+        .format(base_dev, partition)
+
 
+def format_command(fst, dev):
+    """Return the command formatting the filesystem described by fst
+
+    dev is the partition device prefix as returned by get_device_name.
+    """
     # Filesystem-specific format tool options.
     fs_util = {"ext2": {"cmd" : "mkfs.ext2 -F", "label" : "-L"},
                "ext3": {"cmd" : "mkfs.ext3 -F", "label" : "-L"},
@@ -365,30 +457,36 @@ def create_filesystems(template):
                "swap": {"cmd" : "mkswap", "label" : "-L"},
                "xfs": {"cmd" : "mkfs.xfs -f", "label" : "-L"}}
 
+    fsu = fs_util[fst["type"]]
+    opts = fst.get("options", "")
+    if opts:
+        opts = " " + opts
+    if "label" in fst:
+        opts += " {0} {1}".format(fsu["label"], fst["label"])
+    if "encryption" in fst:
+        return "{0}{1} /dev/mapper/{2}".format(fsu["cmd"], opts,
+                                               fst["encryption"]["name"])
+    return "{0}{1} {2}{3}".format(fsu["cmd"], opts, dev, fst["partition"])
+
+
+def create_filesystems(template):
+    """Create filesystems according to template configuration
+    """
     LOG.info("Creating file systems")
     for fst in template["FilesystemTypes"]:
         (dev, prefix) = get_device_name(template, fst["disk"])
-        fsu = fs_util[fst["type"]]
-        LOG.debug("Creating file system {0} in {1}{2}"
-                  .format(fst["type"], dev, fst["partition"]))
-
-        opts = fst.get("options", "")
-        if opts:
-            opts = " " + opts
-        if "label" in fst:
-            opts += " {0} {1}".format(fsu["label"], fst["label"])
-        command = "{0}{1} {2}{3}".format(fsu["cmd"], opts, dev,
-                                         fst["partition"])
+        LOG.debug("Creating file system %s in %s%s", fst["type"], dev,
+                  fst["partition"])
+
         if fst["type"] == "swap":
             if prefix:
                 base_dev = dev[:-1]
             else:
                 base_dev = dev
-            run_command("sgdisk {0} --typecode={1}:\
-0657fd6d-a4ab-43c4-84e5-0933c84b4f4f"
-                        .format(base_dev, fst["partition"]))
+            run_command(swap_typecode_command(base_dev, fst["partition"]))
         if "disable_format" not in fst:
             if "encryption" in fst:
+                import pycryptsetup
                 encr = fst["encryption"]
                 c_dev = "{0}{1}".format(dev, fst["partition"])
                 crs = pycryptsetup.CryptSetup(device=c_dev)
@@ -396,14 +494,77 @@ def create_filesystems(template):
                                keysize=512, hashMode="sha256")
                 crs.addKeyByPassphrase(encr["passphrase"], encr["passphrase"])
                 crs.activate(name=encr["name"], passphrase=encr["passphrase"])
-                command = "{0}{1} /dev/mapper/{2}".format(fsu["cmd"], opts,
-                                                          encr["name"])
-            run_command(command)
+            run_command(format_command(fst, dev))
             if fst["type"] == "swap":
                 run_command("swapon {0}{1}".format(dev, fst["partition"]),
                             raise_exception=False)
 
 
+def open_filesystems(template):
+    """Activate the encrypted and swap partitions of an already formatted
+    disk, as create_filesystems does after formatting them
+    """
+    LOG.info("Opening existing file systems")
+    for fst in template["FilesystemTypes"]:
+        (dev, _) = get_device_name(template, fst["disk"])
+        if "encryption" in fst:
+            import pycryptsetup
+            encr = fst["encryption"]
+            c_dev = "{0}{1}".format(dev, fst["partition"])
+            crs = pycryptsetup.CryptSetup(device=c_dev)
+            crs.activate(name=encr["name"], passphrase=encr["passphrase"])
+        if fst["type"] == "swap":
+            run_command("swapon {0}{1}".format(dev, fst["partition"]),
+                        raise_exception=False)
+
+
+def check_layout(template):
+    """Check the disks hold the partitions of the template's PartitionLayout
+
+    Sizes are compared in MiB allowing for the 1MiB alignment of the first
+    partition.
+
+    This function will raise an Exception on finding an error.
+    """
+    match = {"M": 1, "G": 1024, "T": 1024 * 1024}
+    errors = []
+    for part in template["PartitionLayout"]:
+        (dev, _) = get_device_name(template, part["disk"])
+        pdev = "{0}{1}".format(dev, part["partition"])
+        result = run_command("blockdev --getsize64 {0}".format(pdev),
+                             raise_exception=False, log_output=False)
+        if result[2] != 0 or not result[0]:
+            errors.append("{0} doesn't exist".format(pdev))
+            continue
+        if part["size"] == "rest":
+            continue
+        size = int(result[0][0]) // (1024 * 1024)
+        expected = int(part["size"][:-1]) * match[part["size"][-1]]
+        if size not in [expected, expected - 1]:
+            errors.append("{0} is {1}MiB instead of {2}MiB"
+                          .format(pdev, size, expected))
+    if errors:
+        raise Exception("Existing layout doesn't match the template:\n{0}"
+                        .format("\n".join(errors)))
+
+
+def check_filesystems(template):
+    """Check formatted partitions still hold the template's file systems
+
+    This function will raise an Exception on finding an error.
+    """
+    for fst in template["FilesystemTypes"]:
+        if "encryption" in fst or "disable_format" in fst:
+            continue
+        (dev, _) = get_device_name(template, fst["disk"])
+        part = "{0}{1}".format(dev, fst["partition"])
+        result = run_command("blkid -o value -s TYPE {0}".format(part),
+                             raise_exception=False, log_output=False)
+        if result[0][:1] != [fst["type"]]:
+            raise Exception("{0} no longer holds a {1} file system, it needs "
+                            "a full install".format(part, fst["type"]))
+
+
 def create_target_dir(args, template):
     """Create the target root directory
     """
@@ -419,12 +580,87 @@ def create_target_dir(args, template):
         except Exception:
             raise Exception("Failed to setup mounts for install")
 
-    LOG.debug("Installation target directory: {0}".format(target_dir))
+    LOG.debug("Installation target directory: %s", target_dir)
     return target_dir
 
-def setup_mounts(target_dir, template):
+
+def mount_unit_content(uuid, mount, fs_type):
+    """Return the content of the systemd mount unit for a partition"""
+    unit = "[Unit]\nDescription = Mount for %s\n\n" % mount
+    unit += "[Mount]\nWhat = /dev/disk/by-partuuid/{0}\nWhere = {1}\n" \
+            "Type = {2}\n\n".format(uuid, mount, fs_type)
+    unit += "[Install]\nWantedBy = multi-user.target\n"
+    return unit
+
+
+def mount_unit_filename(part):
+    """Return the systemd mount unit file name for a PartitionMountPoints
+    entry or None if no unit is needed for it.
+
+    Partitions having standard GPT type GUIDs get their mount units from the
+    standard systemd 'systemd-gpt-auto-generator' tool. However, in some rare
+    cases the systemd tool may fail to generate a mount unit, in which case
+    users have a possibility to force ister creating it by specifying
+    'forcemu' option.
+    """
+    if not part.get("forcemu"):
+        if part["mount"] in ["/", "/boot", "/srv", "/home", "/usr"]:
+            return None
+        if part["mount"].startswith("/usr/"):
+            return None
+    return part["mount"][1:].replace("/", "-") + ".mount"
+
+
+def mount_commands(target_dir, template, part, has_boot, dev, base_dev,
+                   options=None):
+    """Return the list of commands tagging and mounting a partition
+
+    dev is the partition device prefix and base_dev the whole disk device.
+    options are passed to mount when set.
+    """
+    commands = []
+    pnum = part["partition"]
+    if part["mount"] == "/":
+        uuid = "4f68bce3-e8cd-4db1-96e7-fbcaf984b709"
+        commands.append("sgdisk {0} --typecode={1}:{2}"
+                        .format(base_dev, pnum, uuid))
+        if not has_boot and template.get("LegacyBios"):
+            commands.append("sgdisk {0} --attributes={1}:set:2"
+                            .format(base_dev, pnum))
+    if part["mount"] == "/boot" and not template.get("LegacyBios"):
+        uuid = "c12a7328-f81f-11d2-ba4b-00a0c93ec93b"
+        commands.append("sgdisk {0} --typecode={1}:{2}"
+                        .format(base_dev, pnum, uuid))
+    if part["mount"] == "/boot" and template.get("LegacyBios"):
+        commands.append("sgdisk {0} --attributes={1}:set:2"
+                        .format(base_dev, pnum))
+    if part["mount"] == "/srv":
+        uuid = "3B8F8425-20E0-4F3B-907F-1A25A76F98E8"
+        commands.append("sgdisk {0} --typecode={1}:{2}"
+                        .format(base_dev, pnum, uuid))
+    if part["mount"] == "/home":
+        uuid = "933AC7E1-2EB4-4F13-B844-0E14E2AEF915"
+        commands.append("sgdisk {0} --typecode={1}:{2}"
+                        .format(base_dev, pnum, uuid))
+    if part["mount"] != "/":
+        commands.append("mkdir -p {0}{1}".format(target_dir, part["mount"]))
+    mount = "mount -o {0}".format(options) if options else "mount"
+    if "encryption" in part:
+        commands.append("{0} /dev/mapper/{1} {2}{3}"
+                        .format(mount, part["encryption"]["name"], target_dir,
+                                part["mount"]))
+    else:
+        commands.append("{0} {1}{2} {3}{4}".format(mount, dev, pnum,
+                                                   target_dir, part["mount"]))
+    return commands
+
+
+def setup_mounts(target_dir, template, tune=False):
     """Mount target folder
 
+    With tune set file systems are mounted with INSTALL_MOUNT_OPTIONS, the
+    mount units keep the production options.
+
     Returns target folder name
 
     This function will raise an Exception on finding an error.
@@ -437,16 +673,14 @@ def setup_mounts(target_dir, template):
     def create_mount_unit(unit_dir, wants_dir, filename, uuid, mount, fs_type):
         """Create mount unit file for systemd
         """
-        LOG.debug("Creating mount unit for UUID: {0}".format(uuid))
-        unit = "[Unit]\nDescription = Mount for %s\n\n" % mount
-        unit += "[Mount]\nWhat = /dev/disk/by-partuuid/{0}\nWhere = {1}\n" \
-                "Type = {2}\n\n".format(uuid, mount, fs_type)
-        unit += "[Install]\nWantedBy = multi-user.target\n"
+        LOG.debug("Creating mount unit for UUID: %s", uuid)
         unit_path = os.path.join(unit_dir, filename)
         symlink_path = os.path.join(wants_dir, filename)
         with open(unit_path, 'w') as unit_fobj:
-            unit_fobj.write(unit)
-        os.symlink(os.path.relpath(unit_path, wants_dir), symlink_path)
+            unit_fobj.write(mount_unit_content(uuid, mount, fs_type))
+        # Resumed installs already have the link
+        if not os.path.lexists(symlink_path):
+            os.symlink(os.path.relpath(unit_path, wants_dir), symlink_path)
 
     LOG.info("Setting up mount points")
 
@@ -467,117 +701,414 @@ def setup_mounts(target_dir, template):
         else:
             base_dev = dev
 
-        LOG.debug("Mounting {0}{1} in {2}".format(dev, pnum, part["mount"]))
+        LOG.debug("Mounting %s%s in %s", dev, pnum, part["mount"])
         fs_type = [x["type"] for x in template["FilesystemTypes"]
                    if x['disk'] == part['disk'] and x['partition'] == pnum][-1]
 
-        if part["mount"] == "/":
-            uuid = "4f68bce3-e8cd-4db1-96e7-fbcaf984b709"
-            cmd = "sgdisk {0} --typecode={1}:{2}".format(base_dev, pnum, uuid)
-            run_command(cmd)
-            if not has_boot and template.get("LegacyBios"):
-                cmd = "sgdisk {0} --attributes={1}:set:2".format(base_dev, pnum)
-                run_command(cmd)
-        if part["mount"] == "/boot" and not template.get("LegacyBios"):
-            uuid = "c12a7328-f81f-11d2-ba4b-00a0c93ec93b"
-            cmd = "sgdisk {0} --typecode={1}:{2}".format(base_dev, pnum, uuid)
-            run_command(cmd)
-        if part["mount"] == "/boot" and template.get("LegacyBios"):
-            cmd = "sgdisk {0} --attributes={1}:set:2".format(base_dev, pnum)
-            run_command(cmd)
-        if part["mount"] == "/srv":
-            uuid = "3B8F8425-20E0-4F3B-907F-1A25A76F98E8"
-            cmd = "sgdisk {0} --typecode={1}:{2}".format(base_dev, pnum, uuid)
-            run_command(cmd)
-        if part["mount"] == "/home":
-            uuid = "933AC7E1-2EB4-4F13-B844-0E14E2AEF915"
-            cmd = "sgdisk {0} --typecode={1}:{2}".format(base_dev, pnum, uuid)
-            run_command(cmd)
-        if part["mount"] != "/":
-            cmd = "mkdir -p {0}{1}".format(target_dir, part["mount"])
-            run_command(cmd)
-        if "encryption" in part:
-            cmd = "mount /dev/mapper/{0} {1}{2}" \
-                  .format(part["encryption"]["name"], target_dir, part["mount"])
-            run_command(cmd)
-        else:
-            cmd = "mount {0}{1} {2}{3}".format(dev, pnum, target_dir,
-                                               part["mount"])
+        options = INSTALL_MOUNT_OPTIONS.get(fs_type) if tune else None
+        for cmd in mount_commands(target_dir, template, part, has_boot, dev,
+                                  base_dev, options):
             run_command(cmd)
 
-        # Create mount units for the partitions, except for those having standard
-        # GPT type GUIDs, because the standard systemd 'systemd-gpt-auto-generator'
-        # tool will generate the mount points. However, in some rare cases the
-        # systemd tool may fail to generate a mount unit, in which case users
-        # have a possibility to force ister creating it by specifying 'forcemu'
-        # option.
-        if not part.get("forcemu"):
-            if part["mount"] in ["/", "/boot", "/srv", "/home", "/usr"]:
-                continue
-            if part["mount"].startswith("/usr/"):
-                continue
+        filename = mount_unit_filename(part)
+        if not filename:
+            continue
 
         if not os.path.exists(wants_dir):
             os.makedirs(wants_dir)
-        filename = part["mount"][1:].replace("/", "-") + ".mount"
         create_mount_unit(units_dir, wants_dir, filename,
                           get_uuid(pnum, base_dev), part["mount"], fs_type)
 
 
+def write_setting(path, value):
+    """Write value to a sysfs or procfs file, returns the previous value or
+    None if the setting isn't available
+    """
+    try:
+        with open(path) as setting:
+            old = setting.read().strip()
+        with open(path, "w") as setting:
+            setting.write(value)
+    except OSError as exep:
+        LOG.debug("Unable to set %s: %s", path, exep)
+        return None
+    if "[" in old:
+        # Selection lists like the I/O scheduler show the current one in []
+        old = old[old.index("[") + 1:old.index("]")]
+    return old
+
+
+def target_disks(template):
+    """Return the kernel names of the target disks"""
+    if template.get("dev"):
+        return [os.path.basename(template["dev"])]
+    return sorted(set(x["disk"] for x in template["PartitionLayout"]))
+
+
+def target_queues(template):
+    """Return the sysfs queue directories of the target disks"""
+    return [os.path.join("/sys/block", x, "queue")
+            for x in target_disks(template)]
+
+
+def tune_io(template, target_dir):
+    """Open the install I/O tuning window
+
+    Raises the writeback limits and the target disks' readahead and drops
+    their I/O scheduler while the OS is copied. The target file systems are
+    expected to be mounted with INSTALL_MOUNT_OPTIONS.
+
+    Returns the state restore_io needs to close the window.
+    """
+    LOG.info("Tuning I/O settings for the install")
+    state = {"settings": [], "mounts": []}
+    settings = list(INSTALL_VM_SETTINGS.items())
+    for queue_dir in target_queues(template):
+        settings.append((os.path.join(queue_dir, "read_ahead_kb"),
+                         INSTALL_READ_AHEAD_KB))
+        try:
+            with open(os.path.join(queue_dir, "scheduler")) as scheduler:
+                if "none" in scheduler.read().replace("[", " ")\
+                                             .replace("]", " ").split():
+                    settings.append((os.path.join(queue_dir, "scheduler"),
+                                     "none"))
+        except OSError:
+            pass
+    for path, value in settings:
+        old = write_setting(path, value)
+        if old is not None:
+            state["settings"].append((path, old))
+
+    for part in sorted(template["PartitionMountPoints"],
+                       key=lambda v: v["mount"]):
+        fs_type = [x["type"] for x in template["FilesystemTypes"]
+                   if x['disk'] == part['disk'] and
+                   x['partition'] == part["partition"]][-1]
+        state["mounts"].append((os.path.normpath(target_dir + part["mount"]),
+                                fs_type))
+    return state
+
+
+def restore_io(state):
+    """Close the install I/O tuning window
+
+    Flushes the target file systems, remounts them with the production
+    options and restores the settings changed by tune_io.
+    """
+    LOG.info("Restoring I/O settings")
+    for path, fs_type in reversed(state["mounts"]):
+        try:
+            syncfs(path)
+        except OSError as exep:
+            LOG.debug("Unable to sync %s: %s", path, exep)
+        if fs_type in PRODUCTION_MOUNT_OPTIONS:
+            run_command("mount -o remount,{0} {1}"
+                        .format(PRODUCTION_MOUNT_OPTIONS[fs_type], path),
+                        raise_exception=False)
+    for path, old in reversed(state["settings"]):
+        write_setting(path, old)
+
+
 def add_bundles(template, target_dir):
     """Create bundle subscription file
     """
     bundles_dir = "/usr/share/clear/bundles/"
-    os.makedirs(target_dir + bundles_dir)
+    os.makedirs(target_dir + bundles_dir, exist_ok=True)
     for index, bundle in enumerate(template["Bundles"]):
         open(target_dir + bundles_dir + bundle, "w").close()
 
     # pylint: disable=undefined-loop-variable
     # since we never reach this point with an empty Bundles list
-    LOG.info("Installing {} bundles (and dependencies)...".format(index + 1))
+    LOG.info("Installing %s bundles (and dependencies)...", index + 1)
+
+
+def _size_bytes(number, unit):
+    """Return the bytes of a size printed by swupd or dnf"""
+    mult = {"k": 1024, "m": 1024 ** 2, "g": 1024 ** 3}
+    return int(float(number) * mult.get(unit[:1].lower(), 1))
+
+
+# swupd output, stage names are the ones of newer swupd releases
+SWUPD_STAGES = [(re.compile(r"^\[(\d+)/(\d+)\] (.+?)\.*$"), None),
+                (re.compile(r"^Verifying version"), "Verifying version"),
+                (re.compile(r"^Downloading packs"), "Downloading packs"),
+                (re.compile(r"^Extracting \S+ pack"), "Extracting packs"),
+                (re.compile(r"^(Adding any missing files|Installing files)"),
+                 "Installing files"),
+                (re.compile(r"^Fixing modified files"), "Fixing files"),
+                (re.compile(r"^Staging file content"), "Staging files"),
+                (re.compile(r"^Applying update"), "Applying update"),
+                (re.compile(r"^Calling post-update helper scripts"),
+                 "Running helper scripts")]
+SWUPD_PERCENT = re.compile(r"\.\.\.\s*(\d+)%")
+SWUPD_PACKS_SIZE = re.compile(r"^Downloading packs \(([\d.]+) ([KMG])b\)")
+SWUPD_INSPECTED = re.compile(r"^Inspected (\d+) files")
+SWUPD_REPLACED = re.compile(r"(\d+) of (\d+) missing files were replaced")
+# dnf output
+DNF_DOWNLOAD_SIZE = re.compile(r"^Total download size: ([\d.]+) ([kMG]?)")
+DNF_DOWNLOADED = re.compile(r"^\((\d+)/(\d+)\): .*\|\s*([\d.]+) ([kMG]?B)\s")
+DNF_STEP = re.compile(r"^\s*(Installing|Upgrading|Running scriptlet|"
+                      r"Verifying|Cleanup)\s*:.*?(\d+)/(\d+)\s*$")
+
+
+def start_progress(tool, status_file=None, packs=0):
+    """Start tracking the progress of a swupd or dnf install
+
+    Output lines of the commands run until finish_progress update the
+    progress. packs is the number of bundles swupd installs.
+    """
+    global PROGRESS
+    now = time.time()
+    PROGRESS = {"tool": tool, "stage": "Starting", "stage_started": now,
+                "started": now, "updated": now, "reported": 0,
+                "percent": None, "done": 0, "total": packs, "unit": "packs",
+                "bytes_done": 0, "bytes_total": 0, "state": "running",
+                "packs": packs, "last_line": "", "status_file": status_file}
+    report_progress(PROGRESS, force=True)
+    return PROGRESS
+
+
+def _set_stage(state, stage, unit=None, total=0):
+    """Move the progress to a new stage"""
+    if stage == state["stage"]:
+        return
+    state.update({"stage": stage, "stage_started": state["updated"],
+                  "percent": None, "done": 0, "total": total,
+                  "unit": unit or state["unit"]})
+    state["reported"] = 0
+
+
+def update_progress(state, line):
+    """Update the progress from an output line of the install command"""
+    state["updated"] = time.time()
+    line = line.split("\r")[-1].strip() or line.strip()
+    if not line:
+        return
+    state["last_line"] = line
+    if state["tool"] == "dnf":
+        _update_dnf_progress(state, line)
+    else:
+        _update_swupd_progress(state, line)
+    report_progress(state)
+
+
+def _update_swupd_progress(state, line):
+    """update_progress for swupd output"""
+    percent = SWUPD_PERCENT.findall(line)
+    if percent:
+        state["percent"] = int(percent[-1])
+        return
+    for regex, stage in SWUPD_STAGES:
+        match = regex.match(line)
+        if not match:
+            continue
+        if stage is None:
+            stage = match.group(3)
+        if stage == "Extracting packs":
+            done = state["done"] if state["stage"] == stage else 0
+            _set_stage(state, stage, "packs", state["packs"])
+            state["done"] = done + 1
+        else:
+            _set_stage(state, stage, "files")
+        break
+    match = SWUPD_PACKS_SIZE.match(line)
+    if match:
+        state["bytes_total"] = _size_bytes(match.group(1), match.group(2))
+    match = SWUPD_INSPECTED.match(line)
+    if match:
+        state["total"] = int(match.group(1))
+        state["done"] = state["total"]
+    match = SWUPD_REPLACED.search(line)
+    if match:
+        state["done"], state["total"] = int(match.group(1)), \
+            int(match.group(2))
+
+
+def _update_dnf_progress(state, line):
+    """update_progress for dnf output"""
+    match = DNF_DOWNLOAD_SIZE.match(line)
+    if match:
+        state["bytes_total"] = _size_bytes(match.group(1), match.group(2))
+        return
+    match = DNF_DOWNLOADED.match(line)
+    if match:
+        _set_stage(state, "Downloading packages", "packages",
+                   int(match.group(2)))
+        state["done"] = int(match.group(1))
+        state["bytes_done"] += _size_bytes(match.group(3), match.group(4))
+        return
+    match = DNF_STEP.match(line)
+    if match:
+        stage = {"Running scriptlet": "Running scriptlets",
+                 "Cleanup": "Cleaning up"}.get(match.group(1),
+                                               match.group(1) + " packages")
+        _set_stage(state, stage, "packages", int(match.group(3)))
+        state["done"] = int(match.group(2))
+    elif line.startswith("Complete!"):
+        _set_stage(state, "Complete")
+
+
+def progress_summary(state, now=None):
+    """Return the JSON serializable summary of the progress
+
+    The ETA covers the current stage, from its completed fraction.
+    """
+    now = now or time.time()
+    fraction = None
+    if state["total"]:
+        fraction = min(state["done"] / state["total"], 1.0)
+    elif state["percent"] is not None:
+        fraction = state["percent"] / 100
+    eta = None
+    if fraction:
+        eta = int((now - state["stage_started"]) * (1 - fraction) / fraction)
+    elapsed = now - state["started"]
+    throughput = int(state["bytes_done"] / elapsed) if elapsed > 0 else 0
+    return {"tool": state["tool"], "state": state["state"],
+            "stage": state["stage"], "done": state["done"],
+            "total": state["total"], "unit": state["unit"],
+            "percent": int(fraction * 100) if fraction is not None else None,
+            "bytes_done": state["bytes_done"],
+            "bytes_total": state["bytes_total"],
+            "throughput": throughput, "eta": eta, "elapsed": int(elapsed),
+            "idle": int(now - state["updated"]),
+            "last_line": state["last_line"]}
+
+
+def format_progress(summary):
+    """Return a one line description of a progress summary"""
+    text = "{0}: {1}".format(summary["tool"], summary["stage"])
+    if summary["percent"] is not None:
+        text += " {0}%".format(summary["percent"])
+    if summary["total"]:
+        text += " ({0}/{1} {2})".format(summary["done"], summary["total"],
+                                        summary["unit"])
+    if summary["throughput"]:
+        text += ", {0:.1f} MB/s".format(summary["throughput"] / 1024 ** 2)
+    if summary["eta"] is not None:
+        text += ", ETA {0}m{1:02d}s".format(summary["eta"] // 60,
+                                            summary["eta"] % 60)
+    return text
+
+
+def write_status_file(path, summary):
+    """Atomically write a progress summary to a JSON status file"""
+    try:
+        with open(path + ".tmp", "w") as status:
+            json.dump(summary, status, sort_keys=True)
+        os.rename(path + ".tmp", path)
+    except OSError as exep:
+        LOG.debug("Unable to write status file: %s", exep)
+
+
+def report_progress(state, force=False):
+    """Report the progress to the log, the status file and the listeners
+
+    Reports happen on stage changes and at most every PROGRESS_INTERVAL
+    seconds otherwise.
+    """
+    if not force and state["reported"] and \
+       state["updated"] - state["reported"] < PROGRESS_INTERVAL:
+        return
+    state["reported"] = state["updated"]
+    summary = progress_summary(state, state["updated"])
+    LOG.info(format_progress(summary))
+    if state["status_file"]:
+        write_status_file(state["status_file"], summary)
+    for listener in PROGRESS_LISTENERS:
+        listener(summary)
+
+
+def finish_progress(succeeded):
+    """Stop tracking the software install progress"""
+    global PROGRESS
+    state = PROGRESS
+    PROGRESS = None
+    if not state:
+        return
+    state["updated"] = time.time()
+    state["state"] = "done" if succeeded else "failed"
+    report_progress(state, force=True)
 
 
 def copy_os(args, template, target_dir):
     """Wrapper for running install command
     """
     package_manager = template["SoftwareManager"]
-    LOG.info("Starting {0}. May take several minutes".format(package_manager))
-    if package_manager == "swupd":
-        copy_os_swupd(args, template, target_dir)
-    elif package_manager == "dnf":
-        copy_os_dnf(args, template, target_dir)
-
+    LOG.info("Starting %s. May take several minutes", package_manager)
+    start_progress(package_manager, getattr(args, "status_file", None),
+                   len(template.get("Bundles", [])))
+    succeeded = False
+    try:
+        if package_manager == "swupd":
+            copy_os_swupd(args, template, target_dir)
+        elif package_manager == "dnf":
+            copy_os_dnf(args, template, target_dir)
+        succeeded = True
+    finally:
+        finish_progress(succeeded)
 
-def copy_os_swupd(args, template, target_dir):
-    """Wrapper for running install command with swupd
-    """
-    add_bundles(template, target_dir)
 
+def swupd_statedir(args, target_dir):
+    """Return the swupd state directory used for the install"""
     if args.fast_install:
-        args.statedir = "{0}/tmp/swupd".format(target_dir)
+        return "{0}/tmp/swupd".format(target_dir)
+    return args.statedir
 
-    if template["DestinationType"] == "physical":
-        os.makedirs(args.statedir, exist_ok=True)
-        os.chmod(args.statedir, stat.S_IRWXU)
-        os.makedirs("{0}/var/tmp".format(target_dir))
-        os.chmod("{0}/var/tmp".format(target_dir), stat.S_IRWXU)
-        run_command("mount --bind {0}/var/tmp {1}"
-                    .format(target_dir, args.statedir))
 
-    cmd = "swupd verify --install"
+def swupd_install_command(args, template, target_dir):
+    """Return the swupd command installing the OS into target_dir"""
+    return swupd_command(args, template, target_dir, "verify --install")
+
+
+def swupd_command(args, template, target_dir, action, manifest=True):
+    """Return the swupd command running action on target_dir"""
+    cmd = "swupd {0}".format(action)
     cmd += " --path={0}".format(target_dir)
-    cmd += " --manifest={0}".format(template["Version"])
+    if manifest:
+        cmd += " --manifest={0}".format(template["Version"])
     if args.contenturl:
         cmd += " --contenturl={0}".format(args.contenturl)
     if args.versionurl:
         cmd += " --versionurl={0}".format(args.versionurl)
     if args.format:
         cmd += " --format={0}".format(args.format)
-    cmd += " --statedir={0}".format(args.statedir)
+    cmd += " --statedir={0}".format(swupd_statedir(args, target_dir))
     if args.cert_file:
         cmd += " --certpath={0}".format(args.cert_file)
     if shutil.which("stdbuf"):
         cmd = "stdbuf -o 0 {0}".format(cmd)
+    return cmd
+
+
+def dnf_install_command(args, template, target_dir):
+    """Return the dnf command installing the OS into target_dir"""
+    cmd = "dnf install --assumeyes"
+    if args.dnf_config:
+        cmd += " --config {0}".format(args.dnf_config)
+    cmd += " --installroot {0}".format(target_dir)
+    cmd += " {0}".format(" ".join(template["Bundles"]))
+    if shutil.which("stdbuf"):
+        cmd = "stdbuf -o 0 {0}".format(cmd)
+    return cmd
+
+
+def copy_os_swupd(args, template, target_dir):
+    """Wrapper for running install command with swupd
+    """
+    add_bundles(template, target_dir)
+
+    args.statedir = swupd_statedir(args, target_dir)
+
+    if template["DestinationType"] == "physical":
+        os.makedirs(args.statedir, exist_ok=True)
+        os.chmod(args.statedir, stat.S_IRWXU)
+        os.makedirs("{0}/var/tmp".format(target_dir), exist_ok=True)
+        os.chmod("{0}/var/tmp".format(target_dir), stat.S_IRWXU)
+        run_command("mount --bind {0}/var/tmp {1}"
+                    .format(target_dir, args.statedir))
+
+    cmd = swupd_install_command(args, template, target_dir)
     cmd_env = get_cmd_env(template)
     run_command(cmd, environ=cmd_env, show_output=True)
 
@@ -588,13 +1119,7 @@ def copy_os_swupd(args, template, target_dir):
 def copy_os_dnf(args, template, target_dir):
     """Wrapper for running install command with dnf
     """
-    cmd = "dnf install --assumeyes"
-    if args.dnf_config:
-        cmd += " --config {0}".format(args.dnf_config)
-    cmd += " --installroot {0}".format(target_dir)
-    cmd += " {0}".format(" ".join(template["Bundles"]))
-    if shutil.which("stdbuf"):
-        cmd = "stdbuf -o 0 {0}".format(cmd)
+    cmd = dnf_install_command(args, template, target_dir)
     cmd_env = get_cmd_env(template)
     run_command(cmd, environ=cmd_env, show_output=True)
 
@@ -605,7 +1130,7 @@ def get_cmd_env(template):
     cmd_env = os.environ
     if template.get("HTTPSProxy"):
         cmd_env["https_proxy"] = template["HTTPSProxy"]
-        LOG.debug("https_proxy: {}".format(template["HTTPSProxy"]))
+        LOG.debug("https_proxy: %s", template["HTTPSProxy"])
     return cmd_env
 
 
@@ -651,19 +1176,25 @@ def get_user_homedir(username):
         return os.path.join(os.sep, "root")
     return os.path.join(os.sep, "home", username)
 
-def create_account(user, target_dir):
-    """Add user to the system
-
-    Create a new account on the system with a home directory and one time
-    passwordless login. Also add a new group with same name as the user
-    """
 
+def useradd_options(user):
+    """Return the useradd/usermod options for a Users entry"""
     opts = user["username"]
     if user.get("uid"):
         opts = "-u {0} ".format(user["uid"]) + opts
     if "password" in user:
         opts = "-p '{0}' ".format(user["password"]) + opts
+    return opts
+
+
+def create_account(user, target_dir):
+    """Add user to the system
 
+    Create a new account on the system with a home directory and one time
+    passwordless login. Also add a new group with same name as the user
+    """
+
+    opts = useradd_options(user)
     command = "useradd -U -m {0}".format(opts)
 
     with ChrootOpen(target_dir) as _:
@@ -694,8 +1225,7 @@ def add_user_fullname(user, target_dir):
             subprocess.call(command)
     except Exception as exep:
         print(exep)
-        LOG.info("Unable to set user {} full name: {}".format(user["username"],
-                                                              exep))
+        LOG.info("Unable to set user %s full name: %s", user["username"], exep)
 
 
 def add_user_key(user, target_dir):
@@ -826,6 +1356,18 @@ def set_mirror_version_url(template, target_dir):
         file.write(target_mirror_version_url)
 
 
+def static_network_config(static_conf):
+    """Return the systemd-networkd configuration for a Static_IP entry"""
+    config = "[Match]\n"
+    config += "Name={}\n\n".format(static_conf["iface"])
+    config += "[Network]\n"
+    config += "Address={0}\n".format(static_conf["address"])
+    config += "Gateway={0}\n".format(static_conf["gateway"])
+    if "dns" in static_conf:
+        config += "DNS={0}\n".format(static_conf["dns"])
+    return config
+
+
 def set_static_configuration(template, target_dir):
     """Writes the configuration on /etc/systemd/network/10-en-static.network
     """
@@ -839,13 +1381,25 @@ def set_static_configuration(template, target_dir):
         os.makedirs(path)
 
     with open(path + "10-en-static.network", "w") as file:
-        file.write("[Match]\n")
-        file.write("Name={}\n\n".format(static_conf["iface"]))
-        file.write("[Network]\n")
-        file.write("Address={0}\n".format(static_conf["address"]))
-        file.write("Gateway={0}\n".format(static_conf["gateway"]))
-        if "dns" in static_conf:
-            file.write("DNS={0}\n".format(static_conf["dns"]))
+        file.write(static_network_config(static_conf))
+
+
+def configuration_files(template):
+    """Return the (function, path, content) list of the configuration files
+    the set_* functions write for a template, paths relative to the target
+    """
+    files = [("set_hostname", "etc/hostname", template.get("Hostname")),
+             ("set_mirror_url", "etc/swupd/mirror_contenturl",
+              template.get("MirrorURL")),
+             ("set_mirror_version_url", "etc/swupd/mirror_versionurl",
+              template.get("VersionURL")),
+             ("set_static_configuration",
+              "etc/systemd/network/10-en-static.network",
+              static_network_config(template["Static_IP"])
+              if template.get("Static_IP") else None),
+             ("set_kernel_cmdline_appends", "etc/kernel/cmdline",
+              template.get("cmdline"))]
+    return [x for x in files if x[2]]
 
 
 def set_kernel_cmdline_appends(template, target_dir):
@@ -927,11 +1481,192 @@ def post_install_chroot_shell(template, target_dir):
         for cmdl in template["PostChrootShell"]:
             run_command(cmdl, shell=True)
 
+
+def teardown_levels(mounts):
+    """Group a mount tree in levels that can be unmounted in parallel
+
+    Leaves come first and a mount point only appears after all the mount
+    points below it.
+    """
+    children = {x["mount"]: 0 for x in mounts}
+    for mount in mounts:
+        if mount["parent"] in children:
+            children[mount["parent"]] += 1
+    parents = {x["mount"]: x["parent"] for x in mounts}
+    levels = []
+    while children:
+        level = sorted(x for x, count in children.items() if count == 0)
+        for mount in level:
+            del children[mount]
+            if parents[mount] in children:
+                children[parents[mount]] -= 1
+        levels.append(level)
+    return levels
+
+
+def run_parallel(name, funcs):
+    """Run the (label, function) pairs of funcs in parallel threads
+
+    Each function is timed. Returns the list of (label, exception) for the
+    functions that failed.
+    """
+    failed = []
+
+    def timed(label, func):
+        """Run and time func"""
+        start = time.monotonic()
+        try:
+            func()
+        except Exception as exep:
+            failed.append((label, exep))
+        LOG.debug("%s %s took %.2fs", name, label, time.monotonic() - start)
+
+    threads = [threading.Thread(target=timed, name="ister-teardown",
+                                args=(label, func)) for label, func in funcs]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return failed
+
+
+def syncfs(path):
+    """Flush the file system holding path to disk"""
+    import ctypes
+
+    libc = ctypes.CDLL(None, use_errno=True)
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        if libc.syncfs(fd) != 0:
+            raise OSError(ctypes.get_errno(), "syncfs {0}".format(path))
+    finally:
+        os.close(fd)
+
+
+def busy_processes(path):
+    """Return a description of the processes using files below path"""
+    busy = []
+    for pid in [x for x in os.listdir("/proc") if x.isdigit()]:
+        proc_dir = os.path.join("/proc", pid)
+        links = ["cwd", "root", "exe"]
+        try:
+            links += [os.path.join("fd", x)
+                      for x in os.listdir(os.path.join(proc_dir, "fd"))]
+        except OSError:
+            pass
+        for link in links:
+            try:
+                used = os.readlink(os.path.join(proc_dir, link))
+            except OSError:
+                continue
+            if used == path or used.startswith(path + "/"):
+                try:
+                    with open(os.path.join(proc_dir, "comm")) as comm:
+                        name = comm.read().strip()
+                except OSError:
+                    name = "?"
+                busy.append("{0} ({1}) {2}: {3}".format(pid, name, link,
+                                                        used))
+    return busy
+
+
+def mounted_paths():
+    """Return the set of mount points of the host, None when unknown"""
+    paths = set()
+    try:
+        with open("/proc/self/mounts") as mounts:
+            for line in mounts:
+                fields = line.split()
+                if len(fields) > 1:
+                    # Blanks in mount points are escaped in octal
+                    paths.add(re.sub(r"\\([0-7]{3})",
+                                     lambda m: chr(int(m.group(1), 8)),
+                                     fields[1]))
+    except OSError:
+        return None
+    return paths
+
+
+def teardown_mounts(target_dir, mounts, raise_exception=True):
+    """Sync and unmount the mount tree of target_dir
+
+    Every file system is synced once, in parallel, then mount points are
+    unmounted leaves first with independent mount points in parallel. Mount
+    points that are not mounted are skipped and a failing unmount doesn't
+    stop the next levels. Whatever is still mounted below target_dir after
+    that, like bind mounts left by post install scripts, is unmounted with
+    umount -R. When that fails the processes keeping target_dir busy are
+    logged.
+
+    This function will raise an Exception if target_dir stays mounted unless
+    raise_exception is False.
+    """
+    def target_path(mount):
+        """Return the host path of a target mount point"""
+        return os.path.normpath(target_dir + mount)
+
+    def sync(path):
+        """syncfs wrapper, unmount syncs the file system anyway"""
+        try:
+            syncfs(path)
+        except OSError as exep:
+            LOG.debug("Unable to sync %s: %s", path, exep)
+
+    current = mounted_paths()
+    if current is not None:
+        mounts = [x for x in mounts if target_path(x["mount"]) in current]
+    run_parallel("sync", [(x["mount"], functools.partial(
+        sync, target_path(x["mount"]))) for x in mounts])
+
+    failed = []
+    for level in teardown_levels(mounts):
+        failed += run_parallel("umount", [(x, functools.partial(
+            run_command, "umount {0}".format(target_path(x))))
+                                          for x in level])
+    for mount, exep in failed:
+        LOG.info("Unable to unmount %s: %s", target_path(mount), exep)
+
+    root = os.path.normpath(target_dir)
+    current = mounted_paths()
+    if current is None:
+        left = [target_path(x[0]) for x in failed]
+    else:
+        left = [x for x in current if x == root or x.startswith(root + "/")]
+    if not left:
+        return True
+    LOG.info("Unmounting what is left below %s: %s", root,
+             ", ".join(sorted(left)))
+    try:
+        run_command("umount -R {0}".format(root))
+        return True
+    except Exception as exep:
+        LOG.error("Unable to unmount %s: %s", root, exep)
+        for proc in busy_processes(root):
+            LOG.error("%s is busy: %s", root, proc)
+    if raise_exception:
+        raise Exception("Unable to unmount {0}".format(root))
+    return False
+
+
+def mount_tree(template):
+    """Return the template mount points with the mount point holding each"""
+    mounts = []
+    for part in sorted(template.get("PartitionMountPoints", []),
+                       key=lambda v: v["mount"]):
+        parents = [x["mount"] for x in mounts
+                   if x["mount"] == "/" or
+                   part["mount"].startswith(x["mount"] + "/")]
+        parent = max(parents, key=len) if parents and part["mount"] != "/" \
+            else None
+        mounts.append({"mount": part["mount"], "parent": parent})
+    return mounts
+
+
 def cleanup(args, template, target_dir, raise_exception=True):
     """Unmount and remove temporary files
     """
     if args.no_unmount:
-        LOG.info("Skip unmounting target image at {0}".format(target_dir))
+        LOG.info("Skip unmounting target image at %s", target_dir)
         return
 
     LOG.info("Cleaning up")
@@ -941,31 +1676,35 @@ def cleanup(args, template, target_dir, raise_exception=True):
                         raise_exception=raise_exception)
             run_command("rm -fr {0}/var/tmp".format(target_dir),
                         raise_exception=raise_exception)
-        try:
-            run_command("umount -R {}".format(target_dir))
-        except Exception:
-            run_command("lsof {}/boot".format(target_dir),
-                        raise_exception=raise_exception)
-
-        if not args.target_dir:
+        if not teardown_mounts(target_dir, mount_tree(template), False):
+            LOG.error("Keeping %s, it is still mounted", target_dir)
+        elif not args.target_dir:
             # --target-dir was not used.
             run_command("rm -fr {}".format(target_dir),
                         raise_exception=raise_exception)
 
-    # Turn off any swap devices we enabled
+    # Turn off any swap devices we enabled and close the encrypted ones,
+    # devices don't depend on each other
+    devices = []
     for fst in template["FilesystemTypes"]:
-        (dev, _) = get_device_name(template, fst["disk"])
         if fst["type"] == "swap":
-            run_command("swapoff {0}{1}".format(dev, fst["partition"]),
-                        raise_exception=raise_exception)
+            (dev, _) = get_device_name(template, fst["disk"])
+            devices.append(("swapoff", functools.partial(
+                run_command, "swapoff {0}{1}".format(dev, fst["partition"]),
+                raise_exception=raise_exception)))
+    for dev_entry in template['PartitionMountPoints']:
+        if 'encryption' in dev_entry:
+            import pycryptsetup
+            crs = pycryptsetup.CryptSetup(name=dev_entry['encryption']['name'])
+            devices.append((dev_entry['encryption']['name'], crs.deactivate))
+    for label, exep in run_parallel("close", devices):
+        if raise_exception:
+            raise exep
+        LOG.error("Unable to close %s: %s", label, exep)
 
     if template.get("dev"):
         run_command("losetup --detach {0}".format(template["dev"]),
                     raise_exception=raise_exception)
-    for dev_entry in template['PartitionMountPoints']:
-        if 'encryption' in dev_entry:
-            crs = pycryptsetup.CryptSetup(name=dev_entry['encryption']['name'])
-            crs.deactivate()
 
 
 def get_template_location(path):
@@ -986,6 +1725,8 @@ def get_template_location(path):
 def get_template(template_location):
     """Fetch JSON template file for installer
     """
+    import urllib.request as request
+
     json_file = request.urlopen(template_location)
     parsed_json = json.loads(json_file.read().decode("utf-8"))
     # Supply default SoftwareManager value if not defined for backwards compatibility
@@ -994,162 +1735,243 @@ def get_template(template_location):
     return parsed_json
 
 
-def validate_layout(template):
-    """Validate partition layout is sane
+def _partition_order(part):
+    """Sort key for partition numbers given either as int or as str"""
+    try:
+        return (0, int(part))
+    except (TypeError, ValueError):
+        return (1, str(part))
 
-    Returns mapping of layout to disk partitions.
 
-    This function will raise an Exception on finding an error.
+def _index_layout(template, index, errors):
+    """Index the PartitionLayout section
+
+    Every valid entry is stored as index[disk + partition]["layout"]. A
+    message is appended to errors for every problem found, validation does not
+    stop at the first one.
     """
     disk_to_parts = {}
-    parts_to_size = {}
-    has_efi = False
+    rest_parts = []
+    efi_count = 0
     accepted_ptypes = ["EFI", "linux", "swap"]
     accepted_sizes = ["M", "G", "T"]
 
-    for layout in template["PartitionLayout"]:
+    for layout in template.get("PartitionLayout", []):
+        if not isinstance(layout, dict):
+            errors.append("Invalid PartitionLayout section: {}".format(layout))
+            continue
         disk = layout.get("disk")
         part = layout.get("partition")
         size = layout.get("size")
         ptype = layout.get("type")
 
         if not disk or not part or not size or not ptype:
-            raise Exception("Invalid PartitionLayout section: {}"
-                            .format(layout))
+            errors.append("Invalid PartitionLayout section: {}"
+                          .format(layout))
+            continue
 
-        if size[-1] not in accepted_sizes and size != "rest":
-            raise Exception("Invalid size specified in section {0}"
-                            .format(layout))
-        if size != "rest" and int(size[:-1]) <= 0:
-            raise Exception("Invalid size specified in section {0}"
-                            .format(layout))
+        if size != "rest" and (not isinstance(size, str) or
+                               size[-1] not in accepted_sizes or
+                               not size[:-1].isdigit() or
+                               int(size[:-1]) <= 0):
+            errors.append("Invalid size specified in section {0}"
+                          .format(layout))
 
         if ptype not in accepted_ptypes:
-            raise Exception("Invalid partiton type {0}, supported types \
-are: {1}".format(ptype, accepted_ptypes))
-
-        if ptype == "EFI" and has_efi:
-            raise Exception("Multiple EFI partitions defined")
+            errors.append("Invalid partiton type {0}, supported types are: {1}"
+                          .format(ptype, accepted_ptypes))
 
         if ptype == "EFI":
-            has_efi = True
-
-        disk_part = disk + str(part)
-        if disk_to_parts.get(disk):
-            if part in disk_to_parts[disk]:
-                raise Exception("Duplicate disk {0} and partition {1} entry \
-in PartitionLayout".format(disk, part))
-            disk_to_parts[disk].append(part)
-        else:
-            disk_to_parts[disk] = [part]
-        parts_to_size[disk_part] = size
-
-    for disk in disk_to_parts:
-        if len(disk_to_parts[disk]) > 128:
-            raise Exception("GPT disk with more than 128 partitions: {0}"
-                            .format(disk))
-
-    if template["DestinationType"] == "virtual" and len(disk_to_parts) != 1:
-        raise Exception("Mulitple files for virtual disk \
-destination is unsupported")
-    if not has_efi and template["DestinationType"] != "virtual" and \
+            efi_count += 1
+            if efi_count == 2:
+                errors.append("Multiple EFI partitions defined")
+
+        entry = index.setdefault(disk + str(part), {})
+        if "layout" in entry:
+            errors.append("Duplicate disk {0} and partition {1} entry in "
+                          "PartitionLayout".format(disk, part))
+            continue
+        entry["layout"] = layout
+        disk_to_parts.setdefault(disk, []).append(part)
+        if size == "rest":
+            rest_parts.append((disk, part))
+
+    for disk, parts in disk_to_parts.items():
+        if len(parts) > 128:
+            errors.append("GPT disk with more than 128 partitions: {0}"
+                          .format(disk))
+
+    for disk, part in rest_parts:
+        if part != max(disk_to_parts[disk], key=_partition_order):
+            errors.append("Partition other than last uses rest of disk {0} "
+                          "partition {1}".format(disk, part))
+
+    if template.get("DestinationType") == "virtual" and \
+       len(disk_to_parts) != 1:
+        errors.append("Mulitple files for virtual disk destination is "
+                      "unsupported")
+    if not efi_count and template.get("DestinationType") != "virtual" and \
        template.get("LegacyBios") is not True:
-        raise Exception("No EFI partition defined")
-
-    for key in disk_to_parts:
-        parts = sorted(disk_to_parts[key])
-        for part in parts:
-            if parts_to_size[key + str(part)] == "rest" and part != parts[-1]:
-                raise Exception("Partition other than last uses rest of \
-disk {0} partition {1}".format(key, part))
+        errors.append("No EFI partition defined")
 
-    return parts_to_size
 
+def _index_fstypes(template, index, errors):
+    """Index the FilesystemTypes section
 
-def validate_fstypes(template, parts_to_size):
-    """Validate filesystem types are sane
-
-    Returns a set of disk partitions with filesystem type information.
-
-    This function will raise an Exception on finding an error.
+    Every valid entry is stored as index[disk + partition]["fstype"] and must
+    refer to a partition already indexed from PartitionLayout.
     """
-    partition_fstypes = set()
     accepted_fstypes = ["ext2", "ext3", "ext4", "vfat", "btrfs", "xfs", "swap"]
-    force_fmt = [(item.get("disk"), item.get("partition"))
-                 for item in template.get("PartitionMountPoints", list())
-                 if item.get("mount", "") == "/"]
-    for fstype in template["FilesystemTypes"]:
+    for fstype in template.get("FilesystemTypes", []):
+        if not isinstance(fstype, dict):
+            errors.append("Invalid FilesystemTypes section: {}".format(fstype))
+            continue
         disk = fstype.get("disk")
         part = fstype.get("partition")
-        disable_fmt = fstype.get("disable_format")
-        fstype = fstype.get("type")
-        if not disk or not part or not fstype:
-            raise Exception("Invalid FilesystemTypes section: {}"
-                            .format(fstype))
-
-        if fstype not in accepted_fstypes:
-            raise Exception("Invalid filesystem type {0}, supported types \
-are: {1}".format(fstype, accepted_fstypes))
-
-        disk_part = disk + str(part)
-        if disk_part in partition_fstypes:
-            raise Exception("Duplicate disk '{0}' and partition {1} entry in \
-FilesystemTypes".format(disk, part))
-        if disk_part not in parts_to_size:
-            raise Exception("disk '{0}' partition {1} used in FilesystemTypes \
-not found in PartitionLayout".format(disk, part))
-        if force_fmt and force_fmt[0][0] == disk \
-                and force_fmt[0][1] == part and disable_fmt is not None:
-            raise Exception("/ does not apply to disable_format")
-        partition_fstypes.add(disk_part)
-
-    return partition_fstypes
+        fst = fstype.get("type")
+        if not disk or not part or not fst:
+            errors.append("Invalid FilesystemTypes section: {}"
+                          .format(fstype))
+            continue
 
+        if fst not in accepted_fstypes:
+            errors.append("Invalid filesystem type {0}, supported types are: "
+                          "{1}".format(fst, accepted_fstypes))
 
-def validate_partition_mounts(template, partition_fstypes):
-    """Validate partition mount points are sane
+        entry = index.setdefault(disk + str(part), {})
+        if "fstype" in entry:
+            errors.append("Duplicate disk '{0}' and partition {1} entry in "
+                          "FilesystemTypes".format(disk, part))
+            continue
+        if "layout" not in entry:
+            errors.append("disk '{0}' partition {1} used in FilesystemTypes "
+                          "not found in PartitionLayout".format(disk, part))
+        entry["fstype"] = fstype
 
-    This function will raise an Exception on finding an error.
+
+def _index_partition_mounts(template, index, errors):
+    """Index the PartitionMountPoints section
+
+    Every valid entry is stored as index[disk + partition]["mount"] and must
+    refer to a partition already indexed from FilesystemTypes.
     """
     has_rootfs = False
     has_boot = False
-    disk_partitions = set()
     partition_mounts = set()
-    for pmount in template["PartitionMountPoints"]:
+    for pmount in template.get("PartitionMountPoints", []):
+        if not isinstance(pmount, dict):
+            errors.append("Invalid PartitionMountPoints section: {}"
+                          .format(pmount))
+            continue
         disk = pmount.get("disk")
         part = pmount.get("partition")
         mount = pmount.get("mount")
         if not disk or not part or not mount:
-            raise Exception("Invalid PartitionMountPoints section: {}"
-                            .format(pmount))
+            errors.append("Invalid PartitionMountPoints section: {}"
+                          .format(pmount))
+            continue
 
         if mount == "/":
             has_rootfs = True
         if mount == "/boot":
             has_boot = True
-        disk_part = disk + str(part)
         if mount in partition_mounts:
-            raise Exception("Duplicate mount points found")
-        if disk_part in disk_partitions:
-            raise Exception("Duplicate disk {0} and partition {1} entry in "
-                            "PartitionMountPoints".format(disk, part))
-        if disk_part not in partition_fstypes:
-            raise Exception("disk {0} partition {1} used in "
-                            "PartitionMountPoints not found in FilesystemTypes"
-                            .format(disk, part))
-        if "forcemu" in pmount and not isinstance(pmount["forcemu"], bool):
-            raise Exception("'focecmu' of disk {0} partition {1} used in "
-                            "PartitionMountPoints has incorrect type '{2}', "
-                            "but it should be boolean"
-                            .format(disk, part, type(pmount["forcemu"])))
+            errors.append("Duplicate mount points found")
         partition_mounts.add(mount)
-        disk_partitions.add(disk_part)
+
+        entry = index.setdefault(disk + str(part), {})
+        if "mount" in entry:
+            errors.append("Duplicate disk {0} and partition {1} entry in "
+                          "PartitionMountPoints".format(disk, part))
+            continue
+        if "fstype" not in entry:
+            errors.append("disk {0} partition {1} used in "
+                          "PartitionMountPoints not found in FilesystemTypes"
+                          .format(disk, part))
+        elif mount == "/" and \
+                entry["fstype"].get("disable_format") is not None:
+            errors.append("/ does not apply to disable_format")
+        if "forcemu" in pmount and not isinstance(pmount["forcemu"], bool):
+            errors.append("'focecmu' of disk {0} partition {1} used in "
+                          "PartitionMountPoints has incorrect type '{2}', "
+                          "but it should be boolean"
+                          .format(disk, part, type(pmount["forcemu"])))
+        entry["mount"] = pmount
 
     if not has_rootfs:
-        raise Exception("Missing rootfs mount")
-    if not has_boot and template["DestinationType"] != "virtual" and \
+        errors.append("Missing rootfs mount")
+    if not has_boot and template.get("DestinationType") != "virtual" and \
        template.get("LegacyBios") is not True:
-        raise Exception("Missing boot mount")
+        errors.append("Missing boot mount")
+
+
+def check_disk_template(template):
+    """Check all disk layout related information in a single pass
+
+    The PartitionLayout, FilesystemTypes and PartitionMountPoints sections are
+    each walked exactly once while building an index keyed by disk and
+    partition, cross references are resolved against that index.
+
+    Returns the list of every error found, empty if the layout is sane.
+    """
+    index = {}
+    errors = []
+    _index_layout(template, index, errors)
+    _index_fstypes(template, index, errors)
+    _index_partition_mounts(template, index, errors)
+    return errors
+
+
+def validate_layout(template):
+    """Validate partition layout is sane
+
+    Returns mapping of layout to disk partitions.
+
+    This function will raise an Exception on finding an error.
+    """
+    index = {}
+    errors = []
+    _index_layout(template, index, errors)
+    if errors:
+        raise Exception(errors[0])
+    return {disk_part: entry["layout"]["size"]
+            for disk_part, entry in index.items()}
+
+
+def validate_fstypes(template, parts_to_size):
+    """Validate filesystem types are sane
+
+    Returns a set of disk partitions with filesystem type information.
+
+    This function will raise an Exception on finding an error.
+    """
+    index = {disk_part: {"layout": size}
+             for disk_part, size in (parts_to_size or {}).items()}
+    errors = []
+    _index_fstypes(template, index, errors)
+    if errors:
+        raise Exception(errors[0])
+    for item in template.get("PartitionMountPoints", list()):
+        if item.get("mount", "") == "/":
+            root = index.get(item.get("disk", "") + str(item.get("partition")))
+            if root and \
+                    root.get("fstype", {}).get("disable_format") is not None:
+                raise Exception("/ does not apply to disable_format")
+    return set(disk_part for disk_part, entry in index.items()
+               if "fstype" in entry)
+
+
+def validate_partition_mounts(template, partition_fstypes):
+    """Validate partition mount points are sane
+
+    This function will raise an Exception on finding an error.
+    """
+    index = {disk_part: {"fstype": {}}
+             for disk_part in (partition_fstypes or set())}
+    errors = []
+    _index_partition_mounts(template, index, errors)
+    if errors:
+        raise Exception(errors[0])
 
 
 def validate_type_template(template):
@@ -1164,10 +1986,12 @@ def validate_type_template(template):
 
 def validate_disk_template(template):
     """Attempt to verify all disk layout related information is sane
+
+    This function will raise an Exception listing every error found.
     """
-    parts_to_size = validate_layout(template)
-    partition_fstypes = validate_fstypes(template, parts_to_size)
-    validate_partition_mounts(template, partition_fstypes)
+    errors = check_disk_template(template)
+    if errors:
+        raise Exception("\n".join(errors))
 
 
 def validate_version_template(template):
@@ -1183,7 +2007,7 @@ def validate_version_template(template):
 def validate_softmgr_template(template):
     """Attempt to verify the package manager is sane
     """
-    package_manager = template["SoftwareManager"]
+    package_manager = template.get("SoftwareManager")
     if package_manager != "dnf" and package_manager != "swupd":
         raise Exception("Invalid package manager.  Use either swupd or dnf")
 
@@ -1196,6 +2020,8 @@ def validate_user_template(users):
 
     This function will raise an Exception on finding an error.
     """
+    import ctypes
+
     max_uid = ctypes.c_uint32(-1).value
     uids = {}
     unames = {}
@@ -1356,48 +2182,73 @@ def validate_cmdline_template(cmdline):
         raise Exception("cmdline must be stored as a string")
 
 
-def validate_template(template):
-    """Attempt to verify template is sane
+def _collect_error(errors, validator, *args):
+    """Run a raising validator and record its error message in errors"""
+    try:
+        validator(*args)
+    except Exception as exep:
+        errors.append(str(exep))
 
-    This function will raise an Exception on finding an error.
+
+def check_template(template):
+    """Check the whole template without stopping at the first error
+
+    Returns the list of every error found, empty if the template is sane.
     """
-    LOG.info("Validating configuration")
-    if not template.get("DestinationType"):
-        raise Exception("Missing DestinationType field")
-    if not template.get("PartitionLayout"):
-        raise Exception("Missing PartitionLayout field")
-    if not template.get("FilesystemTypes"):
-        raise Exception("Missing FilesystemTypes field")
-    if not template.get("PartitionMountPoints"):
-        raise Exception("Missing PartitionMountPoints field")
-    if not template.get("Version"):
-        raise Exception("Missing Version field")
-    if not template.get("Bundles"):
-        raise Exception("Missing Bundles field")
-    validate_type_template(template)
-    validate_disk_template(template)
-    validate_version_template(template)
-    validate_softmgr_template(template)
+    errors = []
+    required = ["DestinationType", "PartitionLayout", "FilesystemTypes",
+                "PartitionMountPoints", "Version", "Bundles"]
+    for field in required:
+        if not template.get(field):
+            errors.append("Missing {0} field".format(field))
+
+    if template.get("DestinationType"):
+        _collect_error(errors, validate_type_template, template)
+    if all(template.get(field) for field in required[:4]):
+        errors.extend(check_disk_template(template))
+    if template.get("Version"):
+        _collect_error(errors, validate_version_template, template)
+    _collect_error(errors, validate_softmgr_template, template)
     if template.get("Users"):
-        validate_user_template(template["Users"])
+        _collect_error(errors, validate_user_template, template["Users"])
     if template.get("Hostname") is not None:
-        validate_hostname_template(template["Hostname"])
+        _collect_error(errors, validate_hostname_template,
+                       template["Hostname"])
     if template.get("Static_IP") is not None:
-        validate_static_ip_template(template['Static_IP'])
+        _collect_error(errors, validate_static_ip_template,
+                       template["Static_IP"])
     if template.get("PostNonChroot"):
-        validate_postnonchroot_template(template["PostNonChroot"])
+        _collect_error(errors, validate_postnonchroot_template,
+                       template["PostNonChroot"])
     if template.get("LegacyBios"):
-        validate_legacybios_template(template["LegacyBios"])
+        _collect_error(errors, validate_legacybios_template,
+                       template["LegacyBios"])
     if template.get("HTTPSProxy"):
-        validate_proxy_url_template(template["HTTPSProxy"])
+        _collect_error(errors, validate_proxy_url_template,
+                       template["HTTPSProxy"])
     if template.get("HTTPProxy"):
-        validate_proxy_url_template(template["HTTPProxy"])
+        _collect_error(errors, validate_proxy_url_template,
+                       template["HTTPProxy"])
     if template.get("MirrorURL"):
-        validate_mirror_url_template(template["MirrorURL"])
+        _collect_error(errors, validate_mirror_url_template,
+                       template["MirrorURL"])
     if template.get("VersionURL"):
-        validate_mirror_version_url_template(template["VersionURL"])
+        _collect_error(errors, validate_mirror_version_url_template,
+                       template["VersionURL"])
     if template.get("cmdline"):
-        validate_cmdline_template(template["cmdline"])
+        _collect_error(errors, validate_cmdline_template, template["cmdline"])
+    return errors
+
+
+def validate_template(template):
+    """Attempt to verify template is sane
+
+    This function will raise an Exception listing every error found.
+    """
+    LOG.info("Validating configuration")
+    errors = check_template(template)
+    if errors:
+        raise Exception("\n".join(errors))
     LOG.debug("Configuration is valid:")
     LOG.debug(template)
 
@@ -1407,8 +2258,10 @@ def download_ister_conf(uri, timeout=15):
     file and return the temporary file path. The timeout argument specifies for
     how long to try downloading the file."""
 
+    import urllib.request as request
+
     tmpfd, abs_path = tempfile.mkstemp()
-    LOG.debug("ister_conf tmp file = {0}".format(abs_path))
+    LOG.debug("ister_conf tmp file = %s", abs_path)
 
     start_time = time.time()
     while True:
@@ -1460,7 +2313,7 @@ def process_kernel_cmdline(f_kcmdline):
     returns path to a local copy of the file. Otherwise returns 'None'.
     """
     LOG.debug("Inspecting kernel command line for ister.conf location")
-    LOG.debug("kernel command line file: {0}".format(f_kcmdline))
+    LOG.debug("kernel command line file: %s", f_kcmdline)
     kernel_args = list()
     ister_conf_uri = None
     with open(f_kcmdline, "r") as file:
@@ -1477,7 +2330,7 @@ def process_kernel_cmdline(f_kcmdline):
         if opt.startswith("isterconf="):
             ister_conf_uri = opt.split("=")[1]
 
-    LOG.debug("ister_conf_uri = {0}".format(ister_conf_uri))
+    LOG.debug("ister_conf_uri = %s", ister_conf_uri)
     if ister_conf_uri:
         return download_ister_conf(ister_conf_uri)
     return None
@@ -1493,48 +2346,61 @@ def get_host_from_url(url):
     return parsed.hostname or None
 
 
-def get_iface_for_host(host):
-    """ Get interface being used to reach host
+def get_ifaces_for_host(host):
+    """ Get the interfaces with a route to host, the interface of the most
+    specific route first
     """
-    LOG.debug("Finding interface used to reach {0}".format(host))
+    LOG.debug("Finding interfaces used to reach %s", host)
     ip_addr = socket.gethostbyname(host)
     cmd = "ip route show to match {0}".format(ip_addr)
-    iface = None
+    ifaces = []
 
     output, _, ret = run_command(cmd)
     LOG.debug("Output from ip route show...")
     LOG.debug(output)
     if ret == 0:
-        match = re.match(r'.*dev (\w+)', output[-1])
-        iface = match.group(1)
-        # Maybe make sure this really exists?
+        for line in reversed(output):
+            match = re.match(r'.*dev (\w+)', line)
+            if match and match.group(1) not in ifaces:
+                ifaces.append(match.group(1))
 
-    return iface
+    return ifaces
+
+
+def get_iface_for_host(host):
+    """ Get interface being used to reach host
+    """
+    ifaces = get_ifaces_for_host(host)
+    return ifaces[0] if ifaces else None
 
 
 def get_mac_for_iface(iface):
     """ Get the MAC address for iface
     """
     # pylint: disable=E1101
-    LOG.debug("Determining MAC address for iface {0}".format(iface))
+    import netifaces
+
+    LOG.debug("Determining MAC address for iface %s", iface)
     try:
         addrs = netifaces.ifaddresses(iface)
     except Exception:
         return None
     macs = addrs[netifaces.AF_LINK]
     mac = macs[0].get('addr')
-    LOG.debug("FOUND MAC address {0}".format(mac))
+    LOG.debug("FOUND MAC address %s", mac)
     return mac
 
 
-def fetch_cloud_init_configs(src_url, mac):
+def fetch_cloud_init_configs(src_url, mac, timeout=CLOUD_INIT_TIMEOUT):
     """ Fetch the json configs from ister-cloud-init-svc for mac
     """
+    import urllib.request as request
+
     src_url += 'get_config/{0}'.format(mac)
     LOG.debug("Fetching cloud init configs from:\n"
-              "\t{0}".format(src_url))
+              "\t%s", src_url)
     try:
-        json_file = request.urlopen(src_url)
+        json_file = request.urlopen(src_url, timeout=timeout)
     except Exception:
         json_file = None
 
@@ -1544,33 +2410,101 @@ def fetch_cloud_init_configs(src_url, mac):
     return dict()
 
 
+def query_cloud_init_configs(icis_source, macs):
+    """ Query ister-cloud-init-svc for every mac at once
+
+    The first answer for one of the macs is returned without waiting for the
+    others. The service answers macs it does not list with its default
+    configs, whose "mac" field is CLOUD_INIT_DEFAULT_MAC, those are only
+    used when no mac is listed, and an empty dict when the service has no
+    configs at all.
+    """
+    answers = queue.Queue()
+    default = dict()
+
+    def query(mac):
+        """Queue the configs of mac"""
+        try:
+            answers.put((mac, fetch_cloud_init_configs(icis_source, mac)))
+        except Exception as exep:
+            LOG.debug("Query for %s failed: %s", mac, exep)
+            answers.put((mac, None))
+
+    for mac in macs:
+        threading.Thread(target=query, args=(mac,), daemon=True,
+                         name="ister-icis-{0}".format(mac)).start()
+    for _ in macs:
+        mac, confs = answers.get()
+        if isinstance(confs, dict) and \
+           confs.get("mac") == CLOUD_INIT_DEFAULT_MAC:
+            default = confs
+        elif confs:
+            LOG.debug("ister-cloud-init-svc answered for %s", mac)
+            return confs
+    return default
+
+
+def cloud_init_cache_file(icis_source, macs):
+    """ Return the file caching the configs of macs for this boot
+    """
+    key = "\n".join([icis_source] + sorted(macs)).encode("utf-8")
+    return os.path.join(CLOUD_INIT_CACHE_DIR, "cloud-init-{0}.json".format(
+        hashlib.sha256(key).hexdigest()[:16]))
+
+
 def get_cloud_init_configs(icis_source):
     """ Fetch configs from ister-cloud-init-svc
     """
 
-    # TODO: Iterate over all interfaces in the future?
-
     # extract hostname/ip from url
     host = get_host_from_url(icis_source)
     if not host:
         LOG.debug("Could not extract hostname for ister cloud "
-                  "init service from url: {0}".format(icis_source))
+                  "init service from url: %s", icis_source)
         return None
 
-    # get interface being used to communicate
-    iface = get_iface_for_host(host)
-    if not iface:
+    # get interfaces that can be used to communicate
+    ifaces = get_ifaces_for_host(host)
+    if not ifaces:
         LOG.debug("No route to ister-cloud-init-svc host?"
                   "  Failed to find interface for route")
         return None
 
-    mac = get_mac_for_iface(iface)
-    if not mac:
-        LOG.debug("Could not find MAC for iface: {0}".format(iface))
+    macs = []
+    for iface in ifaces:
+        mac = get_mac_for_iface(iface)
+        if not mac:
+            LOG.debug("Could not find MAC for iface: %s", iface)
+        elif mac not in macs:
+            macs.append(mac)
+    if not macs:
         return None
 
+    cache_file = cloud_init_cache_file(icis_source, macs)
+    use_cache = not os.environ.get(CLOUD_INIT_NO_CACHE_ENV)
+    if use_cache:
+        try:
+            with open(cache_file, "r") as cache:
+                LOG.debug("Using cloud init configs cached in %s", cache_file)
+                return json.load(cache)
+        except (OSError, ValueError):
+            pass
+
     # query icis service for confs
-    icis_confs = fetch_cloud_init_configs(icis_source, mac)
+    icis_confs = query_cloud_init_configs(icis_source, macs)
+
+    if icis_confs and use_cache:
+        # The configs may hold secrets, only root reads them
+        try:
+            os.makedirs(CLOUD_INIT_CACHE_DIR, mode=0o700, exist_ok=True)
+            fd = os.open(cache_file + ".tmp",
+                         os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            os.fchmod(fd, 0o600)
+            with os.fdopen(fd, "w") as cache:
+                json.dump(icis_confs, cache)
+            os.rename(cache_file + ".tmp", cache_file)
+        except OSError as exep:
+            LOG.debug("Could not cache cloud init configs: %s", exep)
 
     # return confs
     return icis_confs
@@ -1579,11 +2513,14 @@ def get_cloud_init_configs(icis_source):
 def fetch_cloud_init_role(icis_source, role, target_dir):
     """ Get role from icis_source - install into target
     """
+    import urllib.request as request
+
     icis_role_url = icis_source + "get_role/" + role
     out_file = target_dir + "/etc/cloud-init-user-data"
-    LOG.debug("Fetching role file from {0}".format(icis_role_url))
+    LOG.debug("Fetching role file from %s", icis_role_url)
 
-    with request.urlopen(icis_role_url) as response:
+    with request.urlopen(icis_role_url,
+                         timeout=CLOUD_INIT_TIMEOUT) as response:
         with closing(open(out_file, 'wb')) as out_file:
             shutil.copyfileobj(response, out_file)
 
@@ -1612,10 +2549,11 @@ def cloud_init_configs(template, target_dir):
     """
 
     icis_source = template.get("IsterCloudInitSvc")
+    if not icis_source:
+        return
 
-    if icis_source:
-        icis_confs = get_cloud_init_configs(icis_source)
-
+    # None when the service can't be reached from this host
+    icis_confs = get_cloud_init_configs(icis_source) or {}
     icis_role = icis_confs.get('role')
 
     if icis_role:
@@ -1654,10 +2592,120 @@ def parse_config(args):
         else:
             config["template"] = "file://" + os.path.\
                                  abspath(args.template_file)
-    LOG.debug("File found: {0}".format(config["template"]))
+    LOG.debug("File found: %s", config["template"])
     return config
 
 
+def phase_inputs(args, template, phase):
+    """Return the hash of everything an install phase's result depends on"""
+    for name, keys, options in INSTALL_PHASES:
+        if name == phase:
+            content = {"template": {x: template.get(x) for x in keys},
+                       "args": {x: getattr(args, x, None) for x in options}}
+            return hashlib.sha256(json.dumps(content, sort_keys=True)
+                                  .encode("utf-8")).hexdigest()
+    raise Exception("Unknown install phase {0}".format(phase))
+
+
+def journal_path(template, target_dir):
+    """Return the install journal path, None when it isn't available yet
+
+    Virtual installs keep the journal in a file next to the image, physical
+    installs on the target root file system.
+    """
+    if template["DestinationType"] == "virtual":
+        return template["PartitionLayout"][0]["disk"] + ".ister-journal"
+    if target_dir:
+        return os.path.join(target_dir, JOURNAL_FILE)
+    return None
+
+
+def load_journal(path):
+    """Return the phases recorded in a journal file, empty if unreadable"""
+    try:
+        with open(path) as journal_file:
+            journal = json.load(journal_file)
+    except (OSError, ValueError):
+        return {}
+    if not isinstance(journal, dict) or \
+       not isinstance(journal.get("phases"), dict):
+        return {}
+    return journal["phases"]
+
+
+def write_journal(journal, template, target_dir):
+    """Write the install journal if its location is available"""
+    path = journal_path(template, target_dir)
+    if not path:
+        return
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path + ".tmp", "w") as journal_file:
+        json.dump({"phases": journal}, journal_file, sort_keys=True)
+        journal_file.flush()
+        os.fsync(journal_file.fileno())
+    os.rename(path + ".tmp", path)
+
+
+def record_phase(args, template, journal, phase, target_dir):
+    """Mark an install phase as completed in the journal"""
+    journal[phase] = phase_inputs(args, template, phase)
+    LOG.debug("Install phase %s completed", phase)
+    metrics_phase_done(phase)
+    write_journal(journal, template, target_dir)
+
+
+def read_target_journal(template):
+    """Return the phases recorded by a previous install on the target
+
+    The root partition of a physical target is mounted read-only to find
+    the journal. Encrypted roots can't be opened before their phase so
+    their installs aren't resumed.
+    """
+    if template["DestinationType"] == "virtual":
+        path = journal_path(template, None)
+        if not os.path.isfile(template["PartitionLayout"][0]["disk"]):
+            return {}
+        return load_journal(path)
+
+    root = [x for x in template["PartitionMountPoints"] if x["mount"] == "/"]
+    if not root or "encryption" in root[0]:
+        return {}
+    try:
+        (dev, _) = get_device_name(template, root[0]["disk"])
+    except Exception:
+        return {}
+    mount_dir = tempfile.mkdtemp(prefix="ister-journal-")
+    try:
+        _, _, ret = run_command("mount -o ro {0}{1} {2}"
+                                .format(dev, root[0]["partition"], mount_dir),
+                                raise_exception=False)
+        if ret != 0:
+            return {}
+        try:
+            return load_journal(os.path.join(mount_dir, JOURNAL_FILE))
+        finally:
+            run_command("umount {0}".format(mount_dir), raise_exception=False)
+    finally:
+        os.rmdir(mount_dir)
+
+
+def resume_phase(args, template, journal):
+    """Return the first install phase to run given a journal
+
+    A phase is skipped only if it and all phases before it completed with
+    the current inputs. The phases from the returned one on are removed
+    from the journal.
+    """
+    start = None
+    for phase, _, _ in INSTALL_PHASES:
+        if start is None and journal.get(phase) != phase_inputs(args, template,
+                                                                phase):
+            start = phase
+        if start is not None:
+            journal.pop(phase, None)
+    return start
+
+
 def install_os(args, template):
     """Install the OS
 
@@ -1670,42 +2718,571 @@ def install_os(args, template):
     target_dir = None
 
     validate_template(template)
+    start_metrics(template)
+    installed = False
+    io_state = None
+    journal = {}
+    if getattr(args, "resume", False):
+        journal = read_target_journal(template)
+    start = resume_phase(args, template, journal)
+    phases = [x[0] for x in INSTALL_PHASES]
+    if start is None:
+        LOG.info("Previous installation completed, nothing to resume")
+    elif start != phases[0]:
+        LOG.info("Resuming installation at phase %s", start)
+
+    def pending(phase):
+        """Whether an install phase still needs to run"""
+        return start is not None and \
+            phases.index(phase) >= phases.index(start)
+
     try:
         # Disabling this until implementation replaced with pycurl
         # validate_network(args.url)
         pre_install_shell(template)
+        if pending("partitions"):
+            if template["DestinationType"] == "virtual":
+                create_virtual_disk(template)
+            if not template.get("DisabledNewPartitions", False):
+                create_partitions(template)
         if template["DestinationType"] == "virtual":
-            create_virtual_disk(template)
-        if not template.get("DisabledNewPartitions", False):
-            create_partitions(template)
+            map_loop_device(template)
+        if not pending("partitions"):
+            check_layout(template)
+        record_phase(args, template, journal, "partitions", target_dir)
+        if pending("filesystems"):
+            create_filesystems(template)
+        else:
+            check_filesystems(template)
+            open_filesystems(template)
+        record_phase(args, template, journal, "filesystems", target_dir)
+        target_dir = create_target_dir(args, template)
+        setup_mounts(target_dir, template, getattr(args, "tune_io", False))
+        if getattr(args, "tune_io", False):
+            io_state = tune_io(template, target_dir)
+        write_journal(journal, template, target_dir)
+        if pending("copy_os"):
+            copy_os(args, template, target_dir)
+        elif not os.path.exists(os.path.join(target_dir,
+                                             "usr/lib/os-release")):
+            raise Exception("Target has no OS installed to resume, it needs "
+                            "a full install")
+        record_phase(args, template, journal, "copy_os", target_dir)
+        if pending("users"):
+            add_users(template, target_dir)
+        record_phase(args, template, journal, "users", target_dir)
+        if pending("configuration"):
+            set_hostname(template, target_dir)
+            set_mirror_url(template, target_dir)
+            set_mirror_version_url(template, target_dir)
+            set_static_configuration(template, target_dir)
+            set_kernel_cmdline_appends(template, target_dir)
+            if template.get("IsterCloudInitSvc"):
+                LOG.debug("Detected IsterCloudInitSvc directive")
+                cloud_init_configs(template, target_dir)
+        record_phase(args, template, journal, "configuration", target_dir)
+        if pending("post_install"):
+            post_install_nonchroot(template, target_dir)
+            post_install_nonchroot_shell(template, target_dir)
+            post_install_chroot(template, target_dir)
+            post_install_chroot_shell(template, target_dir)
+        record_phase(args, template, journal, "post_install", target_dir)
+        write_applied(args, template, target_dir)
+        # The installed system doesn't need the journal
+        path = journal_path(template, target_dir)
+        if os.path.exists(path):
+            os.remove(path)
+        installed = True
+    except Exception as excep:
+        LOG.error("Couldn't install ClearLinux")
+        raise excep
+    finally:
+        # Entering the cleanup phase first tells the GUI not to interrupt it
+        if METRICS["phase"] != "cleanup":
+            metrics_phase_done(METRICS["phase"], "cleanup")
+        if io_state:
+            restore_io(io_state)
+        cleanup(args, template, target_dir, False)
+        metrics_phase_done("cleanup", "done" if installed else "failed")
+
+
+def write_applied(args, template, target_dir):
+    """Record the inputs of the phases applied to the target"""
+    applied = {x[0]: phase_inputs(args, template, x[0])
+               for x in INSTALL_PHASES}
+    path = os.path.join(target_dir, APPLIED_FILE)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as applied_file:
+        json.dump(applied, applied_file, sort_keys=True)
+
+
+def get_target_version(target_dir):
+    """Return the VERSION_ID of the OS installed in target_dir or None"""
+    try:
+        with open(os.path.join(target_dir, "usr/lib/os-release")) as rel_file:
+            for line in rel_file:
+                if line.startswith("VERSION_ID="):
+                    return line.split("=", 1)[1].strip().strip('"')
+    except OSError:
+        pass
+    return None
+
+
+def converge_os_swupd(args, template, target_dir):
+    """Bring the target's OS to the template Version and Bundles
+
+    Missing bundles are subscribed and installed with swupd verify --fix and
+    a different version is reached with swupd update. Nothing runs when the
+    target already matches.
+    """
+    bundles_dir = os.path.join(target_dir, "usr/share/clear/bundles")
+    missing = [x for x in template["Bundles"]
+               if not os.path.exists(os.path.join(bundles_dir, x))]
+    version = str(template["Version"])
+    current = get_target_version(target_dir)
+    if current == version and not missing:
+        LOG.info("OS already at version %s with all bundles", current)
+        return
+
+    cmd_env = get_cmd_env(template)
+    args.statedir = swupd_statedir(args, target_dir)
+    if missing:
+        add_bundles({"Bundles": missing}, target_dir)
+    if current != version:
+        LOG.info("Updating OS from version %s to %s", current, version)
+        cmd = swupd_command(args, template, target_dir, "update",
+                            manifest=version != "latest")
+        run_command(cmd, environ=cmd_env, show_output=True)
+    if missing:
+        cmd = swupd_command(args, template, target_dir, "verify --fix")
+        run_command(cmd, environ=cmd_env, show_output=True)
+    if args.fast_install:
+        run_command("rm -rf {0}".format(args.statedir))
+
+
+def converge_os(args, template, target_dir):
+    """Bring the target's OS content to the template"""
+    if template["SoftwareManager"] == "swupd":
+        converge_os_swupd(args, template, target_dir)
+    elif template["SoftwareManager"] == "dnf":
+        # dnf install only acts on missing packages
+        copy_os_dnf(args, template, target_dir)
+
+
+def read_colon_file(path):
+    """Return the entries of a passwd style file keyed by name"""
+    entries = {}
+    try:
+        with open(path) as colon_file:
+            for line in colon_file:
+                fields = line.rstrip("\n").split(":")
+                if fields[0]:
+                    entries[fields[0]] = fields
+    except OSError:
+        pass
+    return entries
+
+
+def converge_users(template, target_dir):
+    """Apply the template's Users entries that differ from the target"""
+    users = template.get("Users")
+    if not users:
+        return
+
+    passwd = read_colon_file(os.path.join(target_dir, "etc/passwd"))
+    shadow = read_colon_file(os.path.join(target_dir, "etc/shadow"))
+    group = read_colon_file(os.path.join(target_dir, "etc/group"))
+    for user in users:
+        entry = passwd.get(user["username"])
+        if not entry:
+            LOG.info("Adding user %s", user["username"])
+            add_users({"Users": [user]}, target_dir)
+            continue
+        # Template passwords are hashes, as stored in etc/shadow
+        password = shadow.get(user["username"], [None, None])[1:2]
+        if ("password" in user and password != [user["password"]]) or \
+           (user.get("uid") and str(user["uid"]) != entry[2]):
+            create_account(user, target_dir)
+        if user.get("key"):
+            akey_path = os.path.join(target_dir,
+                                     get_user_homedir(user["username"])[1:],
+                                     ".ssh", "authorized_keys")
+            try:
+                with open(akey_path) as akey_fobj:
+                    present = user["key"] in akey_fobj.read()
+            except OSError:
+                present = False
+            if not present:
+                add_user_key(user, target_dir)
+        wheel = group.get("wheel", [""] * 4)[3].split(",")
+        if user.get("sudo") and user["username"] not in wheel:
+            setup_sudo(user, target_dir)
+            disable_root_login(target_dir)
+        if user.get("fullname") and \
+           entry[4:5] != [user["fullname"]]:
+            add_user_fullname(user, target_dir)
+
+
+def converge_configuration(template, target_dir):
+    """Rewrite the configuration files that differ from the template
+
+    Returns the list of rewritten paths.
+    """
+    changed = []
+    for func, path, content in configuration_files(template):
+        path = os.path.join(target_dir, path)
+        try:
+            with open(path) as conf_file:
+                if conf_file.read() == content:
+                    continue
+        except OSError:
+            pass
+        LOG.info("Updating %s", path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w") as conf_file:
+            conf_file.write(content)
+        changed.append(func)
+    if "set_kernel_cmdline_appends" in changed:
+        run_command("{0}/usr/bin/clr-boot-manager update --path {0}"
+                    .format(target_dir))
+    return changed
+
+
+def converge_target(args, template):
+    """Converge an existing install to the template
+
+    The existing partitions and file systems are kept when they match the
+    template. The OS is updated to the template's Version and Bundles and
+    users, configuration files and post install scripts are applied only
+    where they differ from what the target has.
+
+    This function will raise an Exception on finding an error.
+    """
+    target_dir = None
+
+    validate_template(template)
+    try:
+        pre_install_shell(template)
         if template["DestinationType"] == "virtual":
+            if not os.path.isfile(template["PartitionLayout"][0]["disk"]):
+                raise Exception("No image to converge: {0}".format(
+                    template["PartitionLayout"][0]["disk"]))
             map_loop_device(template)
-        create_filesystems(template)
+        check_layout(template)
+        check_filesystems(template)
+        open_filesystems(template)
         target_dir = create_target_dir(args, template)
         setup_mounts(target_dir, template)
-        copy_os(args, template, target_dir)
-        add_users(template, target_dir)
-        set_hostname(template, target_dir)
-        set_mirror_url(template, target_dir)
-        set_mirror_version_url(template, target_dir)
-        set_static_configuration(template, target_dir)
-        set_kernel_cmdline_appends(template, target_dir)
+        if not get_target_version(target_dir):
+            raise Exception("Target has no OS installed to converge")
+        converge_os(args, template, target_dir)
+        converge_users(template, target_dir)
+        converge_configuration(template, target_dir)
         if template.get("IsterCloudInitSvc"):
             LOG.debug("Detected IsterCloudInitSvc directive")
             cloud_init_configs(template, target_dir)
-        post_install_nonchroot(template, target_dir)
-        post_install_nonchroot_shell(template, target_dir)
-        post_install_chroot(template, target_dir)
-        post_install_chroot_shell(template, target_dir)
+        try:
+            with open(os.path.join(target_dir, APPLIED_FILE)) as applied_file:
+                applied = json.load(applied_file)
+        except (OSError, ValueError):
+            applied = {}
+        if applied.get("post_install") != phase_inputs(args, template,
+                                                       "post_install"):
+            post_install_nonchroot(template, target_dir)
+            post_install_nonchroot_shell(template, target_dir)
+            post_install_chroot(template, target_dir)
+            post_install_chroot_shell(template, target_dir)
+        else:
+            LOG.info("Post install scripts already applied")
+        write_applied(args, template, target_dir)
     except Exception as excep:
-        LOG.error("Couldn't install ClearLinux")
+        LOG.error("Couldn't converge ClearLinux")
         raise excep
     finally:
         cleanup(args, template, target_dir, False)
 
 
-def handle_logging(level, logfile, shandler=logging.StreamHandler(sys.stdout)):
-    """Setup log levels and direct logs to a file"""
+class BackgroundLogHandler(logging.handlers.QueueHandler):
+    """Queue log records for the background listener without formatting them
+
+    The listener thread formats and writes the records so the installing
+    thread never waits on the console or the log file.
+    """
+    def prepare(self, record):
+        """Keep the record as is, formatting happens in the listener"""
+        return record
+
+
+class RateLimitFilter(logging.Filter):
+    """Let through at most rate lines of records below WARNING per second
+
+    Records are left untouched, a record with more lines than the budget
+    left is let through and its extra lines are dropped when it's formatted.
+    The number of lines dropped before the next record let through and the
+    number of lines kept of it are in reported for RateLimitFormatter.
+    """
+    def __init__(self, rate):
+        """Store the rate limit"""
+        super(RateLimitFilter, self).__init__()
+        self.rate = rate
+        self.window = 0
+        self.count = 0
+        self.dropped = 0
+        self.reported = (None, 0, None)
+
+    def filter(self, record):
+        """Drop the record if the current second's budget is used up"""
+        if record.levelno >= logging.WARNING:
+            return True
+        window = int(record.created)
+        if window != self.window:
+            self.window = window
+            self.count = 0
+        lines = record.getMessage().count("\n") + 1
+        if self.count >= self.rate:
+            self.dropped += lines
+            return False
+        keep = min(lines, self.rate - self.count)
+        self.count += keep
+        if self.dropped or keep < lines:
+            self.reported = (record, self.dropped,
+                             keep if keep < lines else None)
+            self.dropped = 0
+        return True
+
+
+class RateLimitFormatter(logging.Formatter):
+    """Prefix a record with the number of lines RateLimitFilter dropped
+    before it and truncate it to the lines the filter kept
+    """
+    def __init__(self, limit, formatter=None):
+        """Store the filter and the formatter of the records"""
+        super(RateLimitFormatter, self).__init__()
+        self.limit = limit
+        self.formatter = formatter or logging.Formatter()
+
+    def format(self, record):
+        """Format the record with formatter"""
+        reported, dropped, keep = self.limit.reported
+        if reported is not record:
+            return self.formatter.format(record)
+        self.limit.reported = (None, 0, None)
+        suffix = ""
+        if keep is not None:
+            # Other handlers get the whole record, format a copy
+            lines = record.getMessage().split("\n")
+            record = logging.makeLogRecord(record.__dict__)
+            record.msg = "\n".join(lines[:keep])
+            record.args = None
+            suffix = "\n({0} lines skipped)".format(len(lines) - keep)
+        line = self.formatter.format(record) + suffix
+        if dropped:
+            line = "({0} lines skipped) {1}".format(dropped, line)
+        return line
+
+
+def start_log_listener(handlers):
+    """Send LOG records to handlers from a background thread
+
+    The listener is stopped, flushing the queued records, at exit.
+    Returns the listener.
+    """
+    log_queue = queue.Queue()
+    LOG.addHandler(BackgroundLogHandler(log_queue))
+    listener = logging.handlers.QueueListener(log_queue, *handlers,
+                                              respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
+
+
+def start_metrics(template):
+    """Reset the install telemetry for an install of template"""
+    METRICS.update({"phase": INSTALL_PHASES[0][0],
+                    "phase_started": time.time(), "phase_seconds": {},
+                    "template": template})
+
+
+def metrics_phase_done(phase, next_phase=None):
+    """Record the duration of a completed install phase
+
+    The current phase becomes next_phase, by default the phase following
+    phase in INSTALL_PHASES or cleanup after the last one.
+    """
+    now = time.time()
+    METRICS["phase_seconds"][phase] = now - METRICS["phase_started"]
+    if not next_phase:
+        phases = [x[0] for x in INSTALL_PHASES] + ["cleanup"]
+        next_phase = phases[phases.index(phase) + 1] \
+            if phase in phases[:-1] else "done"
+    METRICS["phase"] = next_phase
+    METRICS["phase_started"] = now
+
+
+def device_io_bytes(devices):
+    """Return {device: (bytes read, bytes written)} from /proc/diskstats"""
+    stats = {}
+    try:
+        with open("/proc/diskstats") as diskstats:
+            for line in diskstats:
+                fields = line.split()
+                if len(fields) > 9 and fields[2] in devices:
+                    # Sectors are always 512 bytes in diskstats
+                    stats[fields[2]] = (int(fields[5]) * 512,
+                                        int(fields[9]) * 512)
+    except OSError:
+        pass
+    return stats
+
+
+def memory_rss_bytes():
+    """Return the resident memory of the installer"""
+    try:
+        with open("/proc/self/status") as status:
+            for line in status:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return 0
+
+
+def escape_label(value):
+    """Return value escaped for a Prometheus label value"""
+    return str(value).replace("\\", "\\\\").replace('"', '\\"')\
+        .replace("\n", "\\n")
+
+
+def render_metrics():
+    """Return the install telemetry in the Prometheus text format"""
+    lines = []
+
+    def metric(name, kind, doc, samples):
+        """Add a metric with its (labels, value) samples"""
+        lines.append("# HELP ister_{0} {1}".format(name, doc))
+        lines.append("# TYPE ister_{0} {1}".format(name, kind))
+        for labels, value in samples:
+            label_text = ",".join('{0}="{1}"'.format(key, escape_label(val))
+                                  for key, val in sorted(labels.items()))
+            if label_text:
+                label_text = "{" + label_text + "}"
+            lines.append("ister_{0}{1} {2}".format(name, label_text, value))
+
+    now = time.time()
+    metric("phase", "gauge", "Current install phase",
+           [({"phase": METRICS["phase"]}, 1)])
+    metric("phase_elapsed_seconds", "gauge", "Time spent in the current phase",
+           [({}, round(now - METRICS["phase_started"], 3))])
+    metric("phase_duration_seconds", "gauge", "Duration of completed phases",
+           [({"phase": x}, round(y, 3))
+            for x, y in sorted(METRICS["phase_seconds"].items())])
+    metric("commands_total", "counter", "Commands run",
+           [({}, METRICS["commands"])])
+    metric("command_failures_total", "counter", "Commands that failed",
+           [({}, METRICS["command_failures"])])
+    metric("command_seconds_total", "counter", "Time spent running commands",
+           [({}, round(METRICS["command_seconds"], 3))])
+
+    devices = target_disks(METRICS["template"]) if METRICS["template"] else []
+    stats = device_io_bytes(devices)
+    metric("device_read_bytes_total", "counter", "Bytes read from the targets",
+           [({"device": x}, y[0]) for x, y in sorted(stats.items())])
+    metric("device_written_bytes_total", "counter",
+           "Bytes written to the targets",
+           [({"device": x}, y[1]) for x, y in sorted(stats.items())])
+
+    progress = PROGRESS
+    if progress:
+        summary = progress_summary(progress)
+        # swupd only prints the size of the packs, not what it downloaded
+        if progress["tool"] == "dnf":
+            metric("download_bytes_total", "counter", "Bytes downloaded",
+                   [({}, summary["bytes_done"])])
+            metric("download_throughput_bytes", "gauge",
+                   "Download throughput in bytes per second",
+                   [({}, summary["throughput"])])
+        metric("progress_ratio", "gauge", "Completed part of the current "
+               "software install stage",
+               [({"stage": summary["stage"]},
+                 (summary["percent"] or 0) / 100)])
+        metric("output_idle_seconds", "gauge",
+               "Time since the install command last printed a line",
+               [({}, summary["idle"])])
+    metric("memory_rss_bytes", "gauge", "Resident memory of the installer",
+           [({}, memory_rss_bytes())])
+    return "\n".join(lines) + "\n"
+
+
+def start_metrics_server(address):
+    """Serve the install telemetry for Prometheus from a background thread
+
+    address is either host:port for HTTP over TCP or unix:/path for HTTP
+    over a Unix socket. Returns the server.
+    """
+    import http.server
+    import socketserver
+
+    class MetricsHandler(http.server.BaseHTTPRequestHandler):
+        """Answer every GET with the metrics"""
+        def do_GET(self):
+            """Send the metrics"""
+            body = render_metrics().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type",
+                             "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *_):
+            """Scrapes don't belong in the install log"""
+            pass
+
+    if address.startswith("unix:"):
+        path = address[len("unix:"):]
+        if os.path.exists(path):
+            os.remove(path)
+
+        class UnixServer(socketserver.ThreadingMixIn,
+                         socketserver.UnixStreamServer):
+            """HTTP over a Unix socket"""
+            daemon_threads = True
+
+            def get_request(self):
+                """BaseHTTPRequestHandler expects a (host, port) address"""
+                request, _ = super(UnixServer, self).get_request()
+                return request, ("local", 0)
+        server = UnixServer(path, MetricsHandler)
+    else:
+        host, _, port = address.rpartition(":")
+
+        class TCPServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+            """HTTP over TCP"""
+            daemon_threads = True
+        server = TCPServer((host, int(port)), MetricsHandler)
+    thread = threading.Thread(target=server.serve_forever,
+                              name="ister-metrics", daemon=True)
+    thread.start()
+    LOG.info("Serving install metrics on %s", address)
+    return server
+
+
+def stop_metrics_server(server):
+    """Stop serving the install telemetry"""
+    server.shutdown()
+    server.server_close()
+    if isinstance(server.server_address, str) and \
+       os.path.exists(server.server_address):
+        os.remove(server.server_address)
+
+
+def handle_logging(level, logfile, shandler=logging.StreamHandler(sys.stdout),
+                   background=False):
+    """Setup log levels and direct logs to a file
+
+    With background set records are written by a listener thread and the
+    console output is rate limited.
+    """
     # Apparently the LOG object's level trumps level of handler?
     LOG.setLevel(logging.DEBUG)
 
@@ -1714,16 +3291,27 @@ def handle_logging(level, logfile, shandler=logging.StreamHandler(sys.stdout)):
         shandler.setLevel(logging.DEBUG)
     elif level == 'error':
         shandler.setLevel(logging.ERROR)
-    LOG.addHandler(shandler)
+    handlers = [shandler]
 
     if logfile:
         open(logfile, 'w').close()
         fhandler = logging.FileHandler(logfile)
         fhandler.setLevel(logging.DEBUG)
+        # Compact: time of day, level initial and the logging function
         formatter = logging.Formatter(
-            '%(asctime)s-%(levelname)s: %(message)s')
+            '%(asctime)s.%(msecs)03d %(levelname).1s %(funcName)s: '
+            '%(message)s', '%H:%M:%S')
         fhandler.setFormatter(formatter)
-        LOG.addHandler(fhandler)
+        handlers.append(fhandler)
+
+    if background:
+        limit = RateLimitFilter(CONSOLE_LINES_PER_SECOND)
+        shandler.addFilter(limit)
+        shandler.setFormatter(RateLimitFormatter(limit, shandler.formatter))
+        start_log_listener(handlers)
+    else:
+        for handler in handlers:
+            LOG.addHandler(handler)
 
 
 def handle_options(sys_args):
@@ -1773,6 +3361,21 @@ def handle_options(sys_args):
     parser.add_argument("-d", "--dnf-config", action="store",
                         default=None,
                         help="DNF configuration file for installing packages")
+    parser.add_argument("-R", "--resume", action="store_true",
+                        help="Resume a failed install from its journal")
+    parser.add_argument("-X", "--converge", action="store_true",
+                        help="Converge an existing install to the template "
+                        "instead of reinstalling")
+    parser.add_argument("-T", "--tune-io", action="store_true",
+                        help="Use write optimized mount and I/O settings "
+                        "while installing")
+    parser.add_argument("--status-file", action="store",
+                        default=None,
+                        help="JSON file updated with the install progress")
+    parser.add_argument("--metrics", action="store",
+                        default=None,
+                        help="Serve Prometheus metrics on host:port or "
+                        "unix:/path")
     args = parser.parse_args(sys_args)
     return args
 
@@ -1784,16 +3387,23 @@ def main():
     args = handle_options(sys.argv[1:])
 
     LOG = logging.getLogger(__name__)
-    handle_logging(args.loglevel, args.logfile)
+    handle_logging(args.loglevel, args.logfile, background=True)
+
+    if args.metrics:
+        atexit.register(stop_metrics_server,
+                        start_metrics_server(args.metrics))
 
     try:
         configuration = parse_config(args)
         template = get_template(configuration["template"])
-        install_os(args, template)
+        if args.converge:
+            converge_target(args, template)
+        else:
+            install_os(args, template)
     except Exception as exep:
         if args.loglevel == "debug":
             traceback.print_exc()
-        LOG.error("Failed: {}".format(repr(exep)))
+        LOG.error("Failed: %r", exep)
         sys.exit(-1)
     LOG.info("Successful installation")
     sys.exit(0)
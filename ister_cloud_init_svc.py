@@ -0,0 +1,327 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# vim: ts=4 sw=4 tw=80 et ai si
+"""Reference ister-cloud-init-svc
+
+Serves the cloud init configs ister fetches for an install target when its
+template has an IsterCloudInitSvc url:
+
+    get_config/<mac>    the json configs of the machine with that MAC, or
+                        of the "default" machine when it is not listed
+    get_role/<role>     the cloud-init user-data of the role
+
+The "mac" field of the get_config configs is the MAC they are listed for,
+"default" for the default configs. ister only uses the default configs when
+none of the MACs of the machine is listed.
+
+The configs file maps MACs to their configs, for example
+    {"default": {"role": "compute"},
+     "52:54:00:12:34:56": {"role": "storage"}}
+and the roles directory has one user-data file per role. Every answer is
+rendered once when the files are read, and again on SIGHUP, so a request is
+a dictionary lookup. Connections are kept alive and answers carry an ETag
+clients can revalidate with If-None-Match.
+
+With --load-test the service is not started, instead the given number of
+PXE clients fetch their configs and role from a running service all at once
+and the latencies are printed.
+"""
+
+#
+# This file is part of ister.
+#
+# Copyright (C) 2014 Intel Corporation
+#
+# ister is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by the
+# Free Software Foundation; version 3 of the License, or (at your
+# option) any later version.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program in a file named COPYING; if not, write to the
+# Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor,
+# Boston, MA 02110-1301 USA
+#
+
+import argparse
+import hashlib
+import http.client
+import http.server
+import json
+import os
+import random
+import signal
+import socketserver
+import sys
+import threading
+import time
+from urllib.parse import urlparse
+
+# Configs key and "mac" field of the machines that are not listed
+DEFAULT_MAC = "default"
+# Connections the kernel queues while every handler thread is busy, a boot
+# storm opens one per machine at the same moment
+LISTEN_BACKLOG = 1024
+# Seconds an idle kept alive connection stays open
+KEEP_ALIVE_SECONDS = 30
+# Seconds a load test client waits for an answer
+CLIENT_TIMEOUT = 30
+
+
+def normalize_mac(mac):
+    """Return mac in the lower case colon separated form netifaces uses"""
+    return mac.strip().lower().replace("-", ":")
+
+
+def render(body, content_type):
+    """Return the pre-rendered answer of body"""
+    etag = '"{0}"'.format(hashlib.sha256(body).hexdigest()[:32])
+    return {"body": body, "etag": etag, "type": content_type}
+
+
+def load_index(configs_file, roles_dir):
+    """Return the answers to every get_config and get_role request
+
+    This function will raise an Exception on finding an error.
+    """
+    with open(configs_file, "r") as configs:
+        machines = json.load(configs)
+    if not isinstance(machines, dict):
+        raise Exception("{0} must map MACs to configs".format(configs_file))
+
+    index = {"config": {}, "role": {}}
+    for mac, confs in machines.items():
+        if not isinstance(confs, dict):
+            raise Exception("Configs of {0} must be an object".format(mac))
+        mac = mac if mac == DEFAULT_MAC else normalize_mac(mac)
+        confs = dict(confs, mac=mac)
+        body = json.dumps(confs, sort_keys=True).encode("utf-8")
+        index["config"][mac] = render(body, "application/json")
+
+    if roles_dir:
+        for role in os.listdir(roles_dir):
+            path = os.path.join(roles_dir, role)
+            if os.path.isfile(path):
+                with open(path, "rb") as role_file:
+                    index["role"][role] = render(role_file.read(),
+                                                 "text/plain")
+    for mac, answer in index["config"].items():
+        role = json.loads(answer["body"].decode("utf-8")).get("role")
+        if role and role not in index["role"]:
+            raise Exception("No {0} role file for {1}".format(role, mac))
+    return index
+
+
+class ConfigHandler(http.server.BaseHTTPRequestHandler):
+    """Answers the requests of ister from the index of the server"""
+    protocol_version = "HTTP/1.1"
+    timeout = KEEP_ALIVE_SECONDS
+
+    def do_GET(self):
+        """Send the pre-rendered answer of the request"""
+        answer = self.lookup(self.server.index)
+        if not answer:
+            self.send_error(404)
+            return
+        if self.headers.get("If-None-Match") == answer["etag"]:
+            self.send_response(304)
+            self.send_header("ETag", answer["etag"])
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header("ETag", answer["etag"])
+        self.send_header("Content-Type", answer["type"])
+        self.send_header("Content-Length", str(len(answer["body"])))
+        self.end_headers()
+        self.wfile.write(answer["body"])
+
+    def lookup(self, index):
+        """Return the answer to the path of the request or None"""
+        kind, _, name = self.path.strip("/").partition("/")
+        if kind == "get_config":
+            return index["config"].get(normalize_mac(name),
+                                       index["config"].get(DEFAULT_MAC))
+        if kind == "get_role":
+            return index["role"].get(name)
+        return None
+
+    def log_message(self, *_):
+        """A line per request would slow a boot storm down"""
+        pass
+
+
+class ConfigServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    """Serves the configs with a thread per connection"""
+    daemon_threads = True
+    request_queue_size = LISTEN_BACKLOG
+
+    def __init__(self, address, index):
+        self.index = index
+        super(ConfigServer, self).__init__(address, ConfigHandler)
+
+
+def serve(args):
+    """Serve the configs until interrupted, reading them again on SIGHUP"""
+    server = ConfigServer((args.address, args.port),
+                          load_index(args.configs, args.roles))
+
+    def reload_index(*_):
+        """Swap in the answers of the changed files"""
+        try:
+            server.index = load_index(args.configs, args.roles)
+            print("Reloaded {0}".format(args.configs))
+        except Exception as exep:
+            print("Keeping the previous configs: {0}".format(exep))
+
+    signal.signal(signal.SIGHUP, reload_index)
+    print("Serving {0} machines and {1} roles on {2}:{3}".format(
+        len(server.index["config"]), len(server.index["role"]),
+        *server.server_address[:2]))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+def conditional_get(conn, path, etags):
+    """Get path revalidating with the ETag in etags
+
+    Returns the body, None when it did not change.
+    """
+    headers = {}
+    if path in etags:
+        headers["If-None-Match"] = etags[path]
+    conn.request("GET", path, headers=headers)
+    response = conn.getresponse()
+    body = response.read()
+    if response.status == 304:
+        return None
+    if response.status != 200:
+        raise Exception("{0} answered {1}".format(path, response.status))
+    etags[path] = response.getheader("ETag")
+    return body
+
+
+def pxe_client(url, mac, start, results):
+    """Fetch the configs and role of mac like ister does, twice, the second
+    time revalidating with the ETags, and append the latencies to results
+    """
+    parsed = urlparse(url)
+    base = parsed.path.rstrip("/")
+    start.wait()
+    try:
+        conn = http.client.HTTPConnection(parsed.hostname, parsed.port or 80,
+                                          timeout=CLIENT_TIMEOUT)
+        etags = {}
+        role = None
+        for kind in ["fetch", "revalidate"]:
+            began = time.monotonic()
+            body = conditional_get(conn,
+                                   "{0}/get_config/{1}".format(base, mac),
+                                   etags)
+            if body is not None:
+                role = json.loads(body.decode("utf-8")).get("role")
+            if role:
+                conditional_get(conn, "{0}/get_role/{1}".format(base, role),
+                                etags)
+            results.append((kind, time.monotonic() - began))
+        conn.close()
+    except Exception as exep:
+        results.append(("error", str(exep)))
+
+
+def load_test(args):
+    """Run args.load_test PXE clients against the service at once and
+    print the latencies
+    """
+    macs = []
+    if args.configs:
+        with open(args.configs, "r") as configs:
+            macs = [mac for mac in json.load(configs) if mac != DEFAULT_MAC]
+    while len(macs) < args.load_test:
+        macs.append("52:54:00:{0:02x}:{1:02x}:{2:02x}".format(
+            *[random.randrange(256) for _ in range(3)]))
+    random.shuffle(macs)
+
+    start = threading.Event()
+    clients = []
+    threads = []
+    for mac in macs[:args.load_test]:
+        clients.append([])
+        threads.append(threading.Thread(target=pxe_client,
+                                        args=(args.url, mac, start,
+                                              clients[-1]),
+                                        daemon=True))
+        threads[-1].start()
+    began = time.monotonic()
+    start.set()
+    for thread in threads:
+        thread.join()
+    elapsed = time.monotonic() - began
+
+    timings = {"fetch": [], "revalidate": []}
+    errors = []
+    for results in clients:
+        for kind, value in results:
+            if kind == "error":
+                errors.append(value)
+            else:
+                timings[kind].append(value * 1000)
+    print("{0} clients in {1:.2f}s, {2} failed".format(
+        len(clients), elapsed, len(errors)))
+    print("{0:<12} {1:>10} {2:>10} {3:>10} {4:>10}".format(
+        "request", "p50", "p95", "p99", "max"))
+    for kind, values in timings.items():
+        if not values:
+            continue
+        values.sort()
+        print("{0:<12} {1:>8.1f}ms {2:>8.1f}ms {3:>8.1f}ms {4:>8.1f}ms".format(
+            kind, *[values[min(len(values) - 1, int(len(values) * pct))]
+                    for pct in [0.5, 0.95, 0.99, 1]]))
+    for error in sorted(set(errors))[:5]:
+        print("error: {0}".format(error))
+    return not errors
+
+
+def handle_options():
+    """Setup option parsing"""
+    parser = argparse.ArgumentParser(prog='ister_cloud_init_svc')
+    parser.add_argument("-c", "--configs", default=None,
+                        help="JSON file mapping MACs to their configs")
+    parser.add_argument("-r", "--roles", default=None,
+                        help="Directory of the role user-data files")
+    parser.add_argument("-a", "--address", default="",
+                        help="Address to listen on, default=all")
+    parser.add_argument("-p", "--port", type=int, default=8000,
+                        help="Port to listen on, default=8000")
+    parser.add_argument("-l", "--load-test", type=int, default=0,
+                        metavar="CLIENTS",
+                        help="Run CLIENTS PXE clients against --url at once "
+                             "instead of serving")
+    parser.add_argument("-u", "--url", default="http://localhost:8000/",
+                        help="Service url of the load test, "
+                             "default=http://localhost:8000/")
+    args = parser.parse_args()
+    if not args.load_test and not args.configs:
+        parser.error("--configs is needed to serve")
+    return args
+
+
+def main():
+    """Start ister-cloud-init-svc or its load test"""
+    args = handle_options()
+    if args.load_test:
+        sys.exit(0 if load_test(args) else 1)
+    try:
+        serve(args)
+    except Exception as exep:
+        print("Error: {0}".format(exep))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -31,26 +31,23 @@
 # pylint: disable=arguments-differ
 
 import argparse
-import crypt
+import collections
 import json
 import logging
 import os
+import queue
 import re
+import select
 import subprocess
 import threading
 import sys
-import pprint
 import tempfile
 import ipaddress
 import signal
 import time
 import itertools
-import netifaces
-import pycurl
 import urwid
 
-import ister
-
 PALETTE = [
     ('header', 'white', 'dark red', 'bold'),
     ('banner', 'white', 'dark gray'),
@@ -65,7 +62,9 @@ PALETTE = [
     ('warn', 'dark red', 'dark gray'),
     ('button', 'light cyan', 'dark gray'),
     ('ex', 'light gray', 'dark gray'),
-    ('popbg', 'white', 'dark blue')]
+    ('popbg', 'white', 'dark blue'),
+    ('pg normal', 'white', 'black'),
+    ('pg complete', 'white', 'dark red')]
 
 MIN_WIDTH = 80
 MIN_HEIGHT = 24
@@ -75,6 +74,49 @@ PERCENTAGE_W = 90
 PERCENTAGE_H = 70
 LINES = 0
 COLUMNS = 0
+# Progress screens redraw at most this often, output arriving in between is
+# shown by the next redraw
+REDRAWS_PER_SECOND = 4
+# Lines of command output kept in the scrolling output of a progress screen
+OUTPUT_LINES = 500
+# Threads reading partition tables for the device selection screens
+PROBE_THREADS = 4
+# Block device events trigger a new disk scan, without udevadm the disks are
+# scanned every RESCAN_SECONDS
+UDEV_MONITOR = ['udevadm', 'monitor', '--udev', '--subsystem-match=block']
+RESCAN_SECONDS = 3
+# Seconds a connectivity check result stays valid for the same proxy and URLs
+NETWORK_CHECK_TTL = 30
+# Seconds network_service_ready waits for a usable network
+NETWORK_READY_TIMEOUT = 7
+# rtnetlink multicast groups from linux/rtnetlink.h
+RTMGRP_LINK = 0x1
+RTMGRP_IPV4_IFADDR = 0x10
+RTMGRP_IPV4_ROUTE = 0x40
+RTMGRP_IPV6_IFADDR = 0x100
+RTMGRP_IPV6_ROUTE = 0x400
+# Groups of the link, address and route changes, a carrier coming up or
+# going down doesn't always change an address or a route
+RTNETLINK_GROUPS = RTMGRP_LINK | RTMGRP_IPV4_IFADDR | RTMGRP_IPV4_ROUTE | \
+    RTMGRP_IPV6_IFADDR | RTMGRP_IPV6_ROUTE
+# Files listing the DNS servers, the first existing one is used
+RESOLV_CONF_PATHS = ['/run/systemd/resolve/resolv.conf', '/etc/resolv.conf']
+# DNS servers show up without a netlink event, while there is a default route
+# but no DNS server resolv.conf is checked this often
+RESOLV_CHECK_SECONDS = 0.25
+# The network services restarted by restart_networkd_resolved and how often
+# systemctl is asked whether they are active again
+NETWORK_SERVICES = ['systemd-networkd', 'systemd-resolved']
+SERVICE_CHECK_SECONDS = 0.1
+# Row widgets a LazyListWalker keeps around, rows not shown for a while are
+# built again when they scroll back into view
+ROW_CACHE = 64
+# Steps are built when first shown, the facts needed by the steps up to this
+# many actions ahead of the shown one are gathered in the background
+PREFETCH_DEPTH = 2
+# Seconds a cancelled install gets to clean up its mounts and loop devices
+# before it is killed
+CANCEL_CLEANUP_SECONDS = 60
 
 
 def get_disk_info(disk):
@@ -188,23 +230,158 @@ def compute_mask(mask_ip):
     return sum([bin(int(x)).count("1") for x in mask_ip.split(".")])
 
 
-def network_service_ready():
-    """Check network status with increasing sleep times on each failure"""
-    for i in [.1, 1, 2, 4]:
-        try:
-            out = subprocess.check_output(['/usr/bin/systemctl',
-                                           'status',
-                                           'systemd-networkd',
-                                           'systemd-resolved'])
-        except subprocess.CalledProcessError:
-            return False
+def default_route():
+    """Check for an IPv4 or IPv6 default route"""
+    try:
+        with open('/proc/net/route') as routes:
+            for line in list(routes)[1:]:
+                fields = line.split()
+                # destination and mask
+                if fields[1] == '00000000' and fields[7] == '00000000':
+                    return True
+    except OSError:
+        pass
+    try:
+        with open('/proc/net/ipv6_route') as routes:
+            for line in routes:
+                fields = line.split()
+                # destination, prefix length and device
+                if fields[0] == '0' * 32 and fields[1] == '00' and \
+                   fields[9] != 'lo':
+                    return True
+    except OSError:
+        pass
+    return False
 
-        if out.decode('utf-8').count('Active: active (running)') == 2:
-            return True
 
-        time.sleep(i)
+def dns_servers():
+    """Return the DNS servers in use"""
+    for path in RESOLV_CONF_PATHS:
+        if os.path.exists(path):
+            with open(path) as resolv:
+                return [line.split()[1] for line in resolv
+                        if line.startswith('nameserver') and
+                        len(line.split()) > 1]
+    return []
 
-    return False
+
+def network_usable():
+    """Check for a default route and a DNS server"""
+    return default_route() and bool(dns_servers())
+
+
+def network_service_ready(timeout=NETWORK_READY_TIMEOUT):
+    """Wait up to timeout seconds for the network to be usable"""
+    return NetworkMonitor().wait(timeout)
+
+
+class NetworkMonitor(object):
+    """Follow whether the network is usable, see network_usable
+
+    Address and route changes are picked up from rtnetlink as they happen.
+    DNS servers are written to resolv.conf without a netlink event, so while
+    there is a default route but no DNS server (or without netlink) the
+    state is checked every RESOLV_CHECK_SECONDS. While the form runs
+    on_change is called from the urwid main loop when the state changes.
+    """
+    def __init__(self, on_change=None):
+        self.on_change = on_change
+        self.usable = False
+        self.loop = None
+        self._sock = None
+        self._handle = None
+        self._alarm = None
+
+    def _open(self):
+        import socket
+
+        try:
+            sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW,
+                                 socket.NETLINK_ROUTE)
+            sock.bind((0, RTNETLINK_GROUPS))
+            sock.setblocking(False)
+        except OSError:
+            return None
+        return sock
+
+    def _close(self):
+        if self._sock:
+            self._sock.close()
+            self._sock = None
+
+    def _drain(self):
+        """Discard the queued events, only the current state matters"""
+        try:
+            while self._sock.recv(65536):
+                pass
+        except OSError:
+            # no more events, or events were lost which is fine as well
+            pass
+
+    def _interval(self):
+        """Seconds until the state needs checking without an event"""
+        if not self._sock or default_route():
+            return RESOLV_CHECK_SECONDS
+        return None
+
+    def wait(self, timeout):
+        """Wait up to timeout seconds for the network to be usable"""
+        self._sock = self._open()
+        deadline = time.monotonic() + timeout
+        try:
+            while not network_usable():
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                interval = self._interval()
+                if interval:
+                    remaining = min(remaining, interval)
+                if self._sock:
+                    select.select([self._sock], [], [], remaining)
+                    self._drain()
+                else:
+                    time.sleep(remaining)
+            return True
+        finally:
+            self._close()
+
+    def _event(self):
+        self._drain()
+        self._check()
+
+    def _timer(self, *_):
+        self._alarm = None
+        self._check()
+
+    def _check(self):
+        if self._alarm:
+            self.loop.remove_alarm(self._alarm)
+            self._alarm = None
+        usable = network_usable()
+        if usable != self.usable:
+            self.usable = usable
+            if self.on_change:
+                self.on_change()
+        interval = self._interval()
+        if not usable and interval:
+            self._alarm = self.loop.set_alarm_in(interval, self._timer)
+
+    def start(self, loop):
+        """Follow the network state while loop runs"""
+        self.loop = loop
+        self._sock = self._open()
+        if self._sock:
+            self._handle = loop.watch_file(self._sock.fileno(), self._event)
+        self._check()
+
+    def stop(self):
+        """Stop following the network state"""
+        if self._alarm:
+            self.loop.remove_alarm(self._alarm)
+            self._alarm = None
+        if self._sock:
+            self.loop.remove_watch_file(self._handle)
+        self._close()
 
 
 def find_current_disk():
@@ -225,19 +402,12 @@ def find_current_disk():
 
 
 def find_dns():
-    """Find active DNS server by searching /etc/resolv.conf if it exists"""
-    content = ''
-    if os.path.exists('/etc/resolv.conf'):
-        with open('/etc/resolv.conf', 'r') as resolv:
-            content = resolv.readlines()
-
-    # just report the first nameserver
-    for line in content:
-        if 'nameserver' in line:
-            return line.split(' ')[1].strip()
+    """Return the first DNS server in use, see dns_servers"""
+    servers = FACTS.get('dns')
+    return servers[0] if servers else None
 
 
-def get_keyboards():
+def read_keyboards():
     """
     Get list of keyboards from localectl to create dropdown selection
     """
@@ -255,6 +425,11 @@ def get_keyboards():
     return kbs
 
 
+def get_keyboards():
+    """Return the keyboards to select from, see read_keyboards"""
+    return FACTS.get('keymaps')
+
+
 def set_keyboard(keyboard):
     """
     Set system keymapping to keyboard
@@ -262,14 +437,32 @@ def set_keyboard(keyboard):
     subprocess.call(['localectl', 'set-keymap', keyboard])
 
 
+def services_active(services, timeout):
+    """Wait up to timeout seconds for systemctl to report all the services
+    active"""
+    deadline = time.monotonic() + timeout
+    while subprocess.call(['/usr/bin/systemctl', 'is-active', '--quiet'] +
+                          services) != 0:
+        if time.monotonic() >= deadline:
+            return False
+        time.sleep(SERVICE_CHECK_SECONDS)
+    return True
+
+
 def restart_networkd_resolved():
-    """Restart the network services then poll systemctl status output until
-    both are back up"""
-    # restart systemd-networkd and systemd-resolved
-    subprocess.call(['/usr/bin/systemctl', 'restart',
-                     'systemd-networkd', 'systemd-resolved'])
+    """Restart the network services then poll systemctl until both are active
+    again and wait for the network to be usable
+
+    The route and resolv.conf from before the restart are still there, so
+    the network being usable alone doesn't tell the services are back.
+    """
+    subprocess.call(['/usr/bin/systemctl', 'restart'] + NETWORK_SERVICES)
 
-    if not network_service_ready():
+    # resolved rewrites resolv.conf on restart
+    FACTS.invalidate('dns')
+    deadline = time.monotonic() + NETWORK_READY_TIMEOUT
+    if not services_active(NETWORK_SERVICES, NETWORK_READY_TIMEOUT) or \
+       not network_service_ready(max(deadline - time.monotonic(), 0)):
         raise Exception('Unable to restart network services')
 
 
@@ -297,6 +490,8 @@ def setup():
 
 def ister_wrapper(fn_name, *args):
     """Wrapper to dynamically call ister validations"""
+    import ister
+
     # pylint: disable=no-member
     try:
         ister.__getattribute__(fn_name)(*args)
@@ -330,12 +525,7 @@ def required_bundles(config):
 
     # configure core bundles (kernel, os-core, and os-core-update)
     # detect virtualization technology to determine which kernel to require
-    try:
-        output = subprocess.check_output('systemd-detect-virt',
-                                         shell=True).decode('utf-8')
-    except Exception:
-        output = 'none'
-
+    output = FACTS.get('virt')
     if 'qemu' in output or 'kvm' in output:
         kernel = {'name': 'kernel-kvm',
                   'desc': 'Required to run Clear Linux OS on kvm'}
@@ -427,42 +617,113 @@ def search_swap(choices, config, mount_d):
 
 def interface_list():
     """List all interface names"""
+    import netifaces
+
     # pylint: disable=no-member
     return [ifc for ifc in netifaces.interfaces() if ifc.startswith('e')]
 
 
-def get_swupd_content_url():
+def detect_virt():
+    """Return the virtualization technology systemd-detect-virt reports"""
+    try:
+        return subprocess.check_output('systemd-detect-virt',
+                                       shell=True).decode('utf-8')
+    except Exception:
+        return 'none'
+
+
+def read_swupd_mirror():
     """
-    Find and return the content url that swupd determines
+    Find the content and version urls that swupd determines, returns a
+    dictionary keyed by 'Content URL' and 'Version URL'
     """
+    urls = {'Content URL': None, 'Version URL': None}
     cmd = ['swupd', 'mirror']
     try:
         output = subprocess.check_output(cmd).decode('utf-8')
     except:
-        return None
+        return urls
 
     for line in output.split('\n'):
-        if re.match('^Content URL:\s+', line):
-            return (re.split(r'\s+',line)[-1]).strip()
+        match = re.match(r'^(Content URL|Version URL):\s+', line)
+        if match and not urls[match.group(1)]:
+            urls[match.group(1)] = (re.split(r'\s+', line)[-1]).strip()
 
-    return None
+    return urls
+
+
+def get_swupd_content_url():
+    """
+    Find and return the content url that swupd determines
+    """
+    return FACTS.get('swupd_mirror')['Content URL']
 
 
 def get_swupd_version_url():
     """
     Find and return the version url that swupd determines
     """
-    cmd = ['swupd', 'mirror']
-    try:
-        output = subprocess.check_output(cmd).decode('utf-8')
-    except:
-        return None
+    return FACTS.get('swupd_mirror')['Version URL']
 
-    for line in output.split('\n'):
-        if re.match('^Version URL:\s+', line):
-            return (re.split(r'\s+',line)[-1]).strip()
 
-    return None
+class SystemFacts(object):
+    """Facts about the live system which take a while to find out
+
+    Each fact is gathered once by its own worker thread, start gathers all of
+    them concurrently ahead of time. get waits for the gatherer when the fact
+    is not known yet, invalidate makes the next get gather it again.
+
+    gatherers maps the name of each fact to its (gatherer, fallback) pair,
+    the fallback value is used when the gatherer raises.
+    """
+    def __init__(self, gatherers):
+        self._gatherers = gatherers
+        self._lock = threading.Lock()
+        self._facts = {}
+
+    def _fetch(self, name):
+        with self._lock:
+            fact = self._facts.get(name)
+            if fact:
+                return fact
+            fact = {'ready': threading.Event(), 'value': None}
+            self._facts[name] = fact
+        threading.Thread(target=self._gather, args=(name, fact),
+                         daemon=True).start()
+        return fact
+
+    def _gather(self, name, fact):
+        gatherer, fallback = self._gatherers[name]
+        try:
+            fact['value'] = gatherer()
+        except Exception:
+            fact['value'] = fallback
+        finally:
+            fact['ready'].set()
+
+    def start(self, names=None):
+        """Start gathering the facts names, every fact by default"""
+        for name in self._gatherers if names is None else names:
+            self._fetch(name)
+
+    def get(self, name):
+        """Return the fact name, waiting for it to be gathered"""
+        fact = self._fetch(name)
+        fact['ready'].wait()
+        return fact['value']
+
+    def invalidate(self, name):
+        """Forget the fact name, it changed"""
+        with self._lock:
+            self._facts.pop(name, None)
+
+
+FACTS = SystemFacts({'swupd_mirror': (read_swupd_mirror,
+                                      {'Content URL': None,
+                                       'Version URL': None}),
+                     'virt': (detect_virt, 'none'),
+                     'keymaps': (read_keyboards, ['us']),
+                     'dns': (dns_servers, [])})
 
 
 class Alert(object):
@@ -524,24 +785,288 @@ class Alert(object):
             self.loop.draw_screen()
 
 
-class AlertLoggerHandler(logging.StreamHandler):
-    def __init__(self, title):
-        self.title = title
-        self.text = ''
-        self.block = False
+# Set in the install process when the GUI cancelled the install
+CANCEL_REQUESTED = threading.Event()
+
+
+class InstallCancelled(BaseException):
+    """Raised in the install process when the install is cancelled
+
+    Not an Exception so the install error handling does not swallow it, the
+    cleanup in finally blocks still runs.
+    """
+    pass
+
+
+class PipeLogHandler(logging.Handler):
+    """Send the install log messages to the GUI over a pipe"""
+    def __init__(self, conn, lock):
+        self.conn = conn
+        self.lock = lock
         super().__init__()
 
     def emit(self, record):
         try:
-            self.block = hasattr(record, 'block')
-            self.text += '{0}{1}'.format(record.msg, self.terminator)
-            Alert(self.title, self.text, block=self.block).do_alert()
-        except (KeyboardInterrupt, SystemExit):
+            lines = record.getMessage().splitlines()
+            with self.lock:
+                self.conn.send(('log', lines))
+        except (KeyboardInterrupt, SystemExit, InstallCancelled):
             raise
         except:
             self.handleError(record)
 
 
+def install_status():
+    """Return the install phase, the progress detail and the percentage
+    done"""
+    import ister
+
+    phases = [phase[0] for phase in ister.INSTALL_PHASES]
+    phase = ister.METRICS['phase']
+    done = phases.index(phase) if phase in phases else 0
+    detail = ''
+    state = ister.PROGRESS
+    if state and phase == 'copy_os':
+        summary = ister.progress_summary(state)
+        detail = ister.format_progress(summary)
+        done += (summary['percent'] or 0) / 100
+    if phase not in phases and phase != 'starting':
+        done = len(phases)
+    return phase, detail, 100 * done / len(phases)
+
+
+def install_cleaning_up():
+    """Whether the install process reached the cleanup of the install"""
+    ister = sys.modules.get('ister')
+    return ister is not None and \
+        ister.METRICS['phase'] in ('cleanup', 'done', 'failed')
+
+
+def _cancel_install(*_):
+    """SIGTERM handler of the install process
+
+    Once the install cleans up the cancel is only recorded, terminating its
+    umount, losetup or cryptsetup commands would leave the target in use.
+    """
+    CANCEL_REQUESTED.set()
+    if install_cleaning_up():
+        return
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    # the commands the install runs are in the process group of the install
+    os.killpg(0, signal.SIGTERM)
+    raise InstallCancelled()
+
+
+def supervised_install(conn, install, *args):
+    """Run install(handler, *args) as the install process of the GUI
+
+    The log messages install sends to handler and its status are sent over
+    conn, followed by ('done' | 'cancelled' | 'error', message). SIGTERM
+    cancels the install: its commands are terminated and InstallCancelled is
+    raised so the cleanup of the install still runs. A SIGTERM during the
+    cleanup lets it finish and the install is reported as cancelled.
+    """
+    os.setpgid(0, 0)
+    lock = threading.Lock()
+    finished = threading.Event()
+
+    def report():
+        status = None
+        while not finished.wait(1 / REDRAWS_PER_SECOND):
+            current = install_status()
+            if current != status:
+                status = current
+                with lock:
+                    conn.send(('status',) + status)
+
+    signal.signal(signal.SIGTERM, _cancel_install)
+    threading.Thread(target=report, daemon=True).start()
+    result = ('done', None)
+    try:
+        install(PipeLogHandler(conn, lock), *args)
+    except InstallCancelled:
+        result = ('cancelled', None)
+    except (Exception, SystemExit) as exc:
+        result = ('error', str(exc))
+    finally:
+        signal.signal(signal.SIGTERM, signal.SIG_IGN)
+        finished.set()
+    if CANCEL_REQUESTED.is_set() and result[0] == 'done':
+        result = ('cancelled', None)
+    with lock:
+        conn.send(('status',) + install_status())
+        conn.send(result)
+    conn.close()
+
+
+def gui_install(handler, ister_cmd, template, ister_log):
+    """Install the OS from the install process, see supervised_install"""
+    import ister
+
+    args = ister.handle_options(ister_cmd)
+    ister.LOG = logging.getLogger('ister')
+    ister.handle_logging(args.loglevel, ister_log, handler)
+    ister.install_os(args, template)
+
+
+class InstallProgress(object):
+    """Screen showing the progress of an install running in its own process
+
+    The install process sends its log messages and status over a pipe read
+    from the main loop, the screen is refreshed from an alarm at most
+    REDRAWS_PER_SECOND times a second with the install phase, a progress bar
+    and the most recent log lines. A crash of the install process is
+    reported as an error, Cancel stops the install and waits for its
+    cleanup.
+    """
+    # pylint: disable=R0902
+    def __init__(self, title):
+        self.error = None
+        self.cancelled = False
+        self.loop = None
+        self.process = None
+        self._conn = None
+        self._watch = None
+        self._kill = None
+        self._result = None
+        self._pending = []
+        self._status = ('starting', '', 0)
+        self._start = None
+        self._phase = urwid.Text('')
+        self._elapsed = urwid.Text('', align='right')
+        self._bar = urwid.ProgressBar('pg normal', 'pg complete')
+        self._detail = urwid.Text('')
+        self._output = urwid.SimpleFocusListWalker([])
+        self._button = ister_button('Cancel', on_press=self._cancel,
+                                    align='center')
+        self._frame = urwid.Pile([('pack', urwid.Columns([self._phase,
+                                                          self._elapsed])),
+                                  ('pack', urwid.Divider()),
+                                  ('pack', self._bar),
+                                  ('pack', self._detail),
+                                  ('pack', urwid.Divider()),
+                                  urwid.ListBox(self._output),
+                                  ('pack', self._button)])
+        self._frame.focus_position = 6
+        self._frame = urwid.LineBox(self._frame, title=title)
+        self._ui = urwid.Overlay(self._frame,
+                                 urwid.AttrMap(urwid.SolidFill(u' '), 'bg'),
+                                 align='center',
+                                 width=('relative', PERCENTAGE_W),
+                                 valign='middle',
+                                 height=('relative', PERCENTAGE_H))
+        self._ui = urwid.AttrMap(self._ui, 'banner')
+
+    def _receive(self):
+        """Read what the install process sent"""
+        try:
+            while self._conn.poll():
+                message = self._conn.recv()
+                if message[0] == 'log':
+                    self._pending.extend(message[1])
+                elif message[0] == 'status':
+                    self._status = message[1:]
+                else:
+                    self._result = message
+        except (EOFError, OSError):
+            self._finished()
+
+    def _finished(self):
+        """The install process exited, find out how"""
+        self.loop.remove_watch_file(self._watch)
+        self._watch = None
+        self._conn.close()
+        self.process.join()
+        if self._kill:
+            self.loop.remove_alarm(self._kill)
+            self._kill = None
+        kind, message = self._result or (None, None)
+        if kind == 'error':
+            self.error = Exception(message)
+        elif kind == 'cancelled':
+            self.cancelled = True
+        elif self.cancelled:
+            self.error = Exception('The install did not clean up within {0} '
+                                   'seconds and was killed'
+                                   .format(CANCEL_CLEANUP_SECONDS))
+        elif kind != 'done':
+            self.error = Exception('The install process exited with code {0}'
+                                   .format(self.process.exitcode))
+
+    def _cancel(self, _):
+        """Stop the install, it cleans up before exiting"""
+        if self.cancelled or self._watch is None:
+            return
+        self.cancelled = True
+        os.kill(self.process.pid, signal.SIGTERM)
+        self._kill = self.loop.set_alarm_in(CANCEL_CLEANUP_SECONDS,
+                                            self._kill_install)
+
+    def _kill_install(self, *_):
+        self._kill = None
+        try:
+            os.killpg(self.process.pid, signal.SIGKILL)
+        except OSError:
+            self.process.kill()
+
+    def _refresh(self, *_):
+        """Show the install phase, progress and received log lines"""
+        elapsed = int(time.monotonic() - self._start)
+        self._elapsed.set_text('Elapsed {0}:{1:02}'.format(elapsed // 60,
+                                                           elapsed % 60))
+        phase, detail, completion = self._status
+        if self.cancelled and self._watch is not None:
+            self._phase.set_text('Cancelling: cleaning up {0}'.format(phase))
+        else:
+            self._phase.set_text('Installing: {0}'.format(phase))
+        self._detail.set_text(detail)
+        self._bar.set_completion(completion)
+
+        pending, self._pending = self._pending, []
+        if pending:
+            self._output.extend(urwid.Text(line)
+                                for line in pending[-OUTPUT_LINES:])
+            del self._output[:-OUTPUT_LINES]
+            self._output.set_focus(len(self._output) - 1)
+
+        if self._watch is not None:
+            self.loop.set_alarm_in(1 / REDRAWS_PER_SECOND, self._refresh)
+        elif not pending:
+            raise urwid.ExitMainLoop()
+        else:
+            # Show the last lines once before leaving
+            self.loop.set_alarm_in(0, self._refresh)
+
+    def start(self, loop, install, *args):
+        """Start install(handler, *args) in the install process, see
+        supervised_install, refreshing the screen from loop"""
+        import multiprocessing
+
+        self.loop = loop
+        self._start = time.monotonic()
+        # a fresh interpreter, not a fork of the threads of the GUI
+        context = multiprocessing.get_context('spawn')
+        self._conn, child_conn = context.Pipe(duplex=False)
+        self.process = context.Process(target=supervised_install,
+                                       args=(child_conn, install) + args)
+        self.process.start()
+        child_conn.close()
+        self._watch = self.loop.watch_file(self._conn.fileno(), self._receive)
+        self.loop.set_alarm_in(0, self._refresh)
+
+    def run(self, install, *args):
+        """Run the install until it exits, raising its error
+
+        Returns False when the install was cancelled.
+        """
+        loop = urwid.MainLoop(self._ui, palette=PALETTE)
+        self.start(loop, install, *args)
+        loop.run()
+        if self.error:
+            raise self.error
+        return not self.cancelled
+
+
 class AlertPass(object):
     """Class to display alerts or confirm boxes"""
     # pylint: disable=R0902
@@ -679,6 +1204,154 @@ class PopUpWidget(urwid.PopUpLauncher):
         super(PopUpWidget, self).open_pop_up()
 
 
+class LazyListWalker(urwid.ListWalker):
+    """List walker building the row widget of an item only when it is shown
+
+    make_row(item) returns the widget of an item, label(item) the text
+    matched by set_filter. Items which are widgets already are their own row
+    and are shown whatever the filter.
+    """
+    def __init__(self, items, make_row, label=str):
+        self.make_row = make_row
+        self.label = label
+        self.search = ''
+        self.focus = 0
+        self.items = []
+        self._shown = []
+        self._rows = collections.OrderedDict()
+        self.set_items(items)
+
+    def set_items(self, items):
+        """Replace the items, keeping the filter and focus position"""
+        self.items = list(items)
+        self._rows.clear()
+        self._shown = self._matching(range(len(self.items)), self.search)
+        self.focus = max(0, min(self.focus, len(self._shown) - 1))
+        self._modified()
+
+    def set_filter(self, search):
+        """Only show the items whose label contains search, ignoring case
+
+        A search extending the current one only looks at the items shown.
+        """
+        if search.startswith(self.search):
+            indexes = self._shown
+        else:
+            indexes = range(len(self.items))
+        focused = self._shown[self.focus] if self._shown else None
+        self.search = search
+        self._shown = self._matching(indexes, search)
+        if focused in self._shown:
+            self.focus = self._shown.index(focused)
+        else:
+            self.focus = 0
+        self._modified()
+
+    def _matching(self, indexes, search):
+        search = search.lower()
+        return [index for index in indexes
+                if not search or isinstance(self.items[index], urwid.Widget)
+                or search in self.label(self.items[index]).lower()]
+
+    def update(self, index, item):
+        """Replace items[index], only its row is built again"""
+        self.items[index] = item
+        self._rows.pop(index, None)
+        self._modified()
+
+    def row(self, index):
+        """Return the widget of items[index], building it when needed"""
+        item = self.items[index]
+        if isinstance(item, urwid.Widget):
+            return item
+        widget = self._rows.pop(index, None)
+        if widget is None:
+            widget = self.make_row(item)
+        self._rows[index] = widget
+        if len(self._rows) > ROW_CACHE:
+            self._rows.popitem(last=False)
+        return widget
+
+    def __len__(self):
+        return len(self._shown)
+
+    def __getitem__(self, position):
+        if not 0 <= position < len(self._shown):
+            raise IndexError(position)
+        return self.row(self._shown[position])
+
+    def next_position(self, position):
+        """Position after position, IndexError at the end"""
+        if position + 1 >= len(self._shown):
+            raise IndexError(position)
+        return position + 1
+
+    def prev_position(self, position):
+        """Position before position, IndexError at the start"""
+        if position <= 0:
+            raise IndexError(position)
+        return position - 1
+
+    def positions(self, reverse=False):
+        """All shown positions"""
+        positions = range(len(self._shown))
+        return reversed(positions) if reverse else positions
+
+    def set_focus(self, position):
+        """Focus the row at position"""
+        if not 0 <= position < len(self._shown):
+            raise IndexError(position)
+        self.focus = position
+        self._modified()
+
+
+class SearchListBox(urwid.ListBox):
+    """ListBox filtering its LazyListWalker body by typed text
+
+    '/' starts a search, the list is filtered as the text is typed, enter
+    keeps the filter and esc clears it. search_text shows the search.
+    """
+    def __init__(self, body):
+        self.searching = False
+        self.search_text = urwid.Text('')
+        super(SearchListBox, self).__init__(body)
+
+    def _show_search(self):
+        if self.searching:
+            self.search_text.set_text('Search: {}_'.format(self.body.search))
+        elif self.body.search:
+            self.search_text.set_text('Filter: {} (esc to clear)'
+                                      .format(self.body.search))
+        else:
+            self.search_text.set_text('')
+
+    def keypress(self, size, key):
+        """Handles the search keys, passes the others on"""
+        # pylint: disable=W0201
+        if not isinstance(self.body, LazyListWalker):
+            return super(SearchListBox, self).keypress(size, key)
+        if not self.searching:
+            key = super(SearchListBox, self).keypress(size, key)
+            if key == '/':
+                self.searching = True
+            elif key == 'esc' and self.body.search:
+                self.body.set_filter('')
+            else:
+                return key
+        elif key in ['enter', 'esc']:
+            self.searching = False
+            if key == 'esc':
+                self.body.set_filter('')
+        elif key == 'backspace':
+            self.body.set_filter(self.body.search[:-1])
+        elif len(key) == 1 and key.isprintable():
+            self.body.set_filter(self.body.search + key)
+        elif key in ['up', 'down', 'page up', 'page down']:
+            super(SearchListBox, self).keypress(size, key)
+        self._show_search()
+        return None
+
+
 class ButtonMenu(object):
     """Assemble the button menu - ultimately store it in self._ui"""
     # pylint: disable=R0903
@@ -694,15 +1367,10 @@ class ButtonMenu(object):
         frame_contents = [('pack', urwid.Divider()),
                           ('pack', urwid.Text(title)),
                           ('pack', urwid.Divider())]
-        self._menu = []
-        for choice in self.choices:
-            label = choice if self.selection != choice else '* ' + choice
-            button = ister_button(label,
-                                  on_press=self._item_chosen,
-                                  user_data=choice)
-            self._menu.append(button)
-
-        self._lb = NavListBox(urwid.SimpleFocusListWalker(self._menu), self)
+        # hundreds of keymaps, only build the buttons scrolled into view
+        self._menu = LazyListWalker(self.choices, self._choice_button)
+        self._lb = NavListBox(self._menu, self)
+        frame_contents.append(('pack', self._lb.search_text))
         frame_contents.append(self._lb)
         frame_contents = urwid.Pile(frame_contents)
         self._fgwin = urwid.Padding(frame_contents, left=2, right=2)
@@ -714,6 +1382,11 @@ class ButtonMenu(object):
                                  height=('relative', PERCENTAGE_H))
         self._ui = urwid.AttrMap(self._ui, 'banner')
 
+    def _choice_button(self, choice):
+        label = choice if self.selection != choice else '* ' + choice
+        return ister_button(label, on_press=self._item_chosen,
+                            user_data=choice)
+
     # This callback is registered with urwid.MainLoop and gives us the
     # opportunity to intercept keystrokes and handle things like tabs.
     # In theory the callback for each keystroke should be function
@@ -783,16 +1456,38 @@ class NavBar(urwid.Columns):
             return key
 
 
-class FormBody(urwid.ListBox):
+class FormBody(SearchListBox):
     """ Adds a list of widgets to a list box.
-    Includes navigation management """
+    Includes navigation management
+
+    fields is a list of widgets or a LazyListWalker, which makes the form
+    searchable.
+    """
     # pylint: disable=R0903
     def __init__(self, fields):
         self._lost_focus = False
-        self._num_fields = len(fields)
-        self._body = urwid.SimpleFocusListWalker(fields)
+        if not isinstance(fields, LazyListWalker):
+            fields = urwid.SimpleFocusListWalker(fields)
+        self._body = fields
         super(FormBody, self).__init__(self._body)
 
+    @property
+    def _num_fields(self):
+        return len(self._body)
+
+    def set_fields(self, fields):
+        """Replace the fields, keeping the focus position when possible"""
+        if isinstance(fields, LazyListWalker):
+            if fields is not self._body:
+                fields.set_filter(self._body.search)
+                self._body = fields
+                self.body = fields
+            return
+        pos = self.focus_position if self._body else 0
+        self._body[:] = fields
+        if fields:
+            self.focus_position = min(pos, len(fields) - 1)
+
     def keypress(self, size, key):
         """Manages key press event"""
         # self.focus_position defined in parent
@@ -800,6 +1495,8 @@ class FormBody(urwid.ListBox):
         # pylint: disable=W0201
         # pylint: disable=R0912
 
+        if self.searching:
+            return super(FormBody, self).keypress(size, key)
         # we will handle the following keys ourselves, don't call super
         if key not in ['tab', 'down', 'shift tab']:
             key = super(FormBody, self).keypress(size, key)
@@ -892,11 +1589,13 @@ class SimpleForm(object):
                        ('pack', urwid.Divider())]
 
         self._form_body = FormBody(fields)
+        if isinstance(fields, LazyListWalker):
+            self._frame.append(('pack', self._form_body.search_text))
         self._frame.append(self._form_body)
 
-        for field in fields:
-            if field.selectable():
-                self._nav_bar_has_focus = False
+        # stops at the first selectable field, lazy rows are not all built
+        if any(field.selectable() for field in fields):
+            self._nav_bar_has_focus = False
 
         # This helps push the default focus to the NavBar
         if self._nav_bar_has_focus:
@@ -938,10 +1637,25 @@ class SimpleForm(object):
                                  height=('relative', PERCENTAGE_H))
         self._ui = urwid.AttrMap(self._ui, 'banner')
 
-    def do_form(self, pop_ups=False):
-        """Creates the loop and enter to it, to focus the UI"""
+    def set_fields(self, fields):
+        """Replace the form fields while the form is shown"""
+        self._form_body.set_fields(fields)
+
+    def do_form(self, pop_ups=False, watchers=()):
+        """Creates the loop and enter to it, to focus the UI
+
+        watchers are started with the loop before it runs and stopped after.
+        """
+        # forms are shown again by steps keeping their widgets
+        self._clicked = ''
         main_loop = urwid.MainLoop(self._ui, palette=PALETTE, pop_ups=pop_ups)
-        main_loop.run()
+        for watcher in watchers:
+            watcher.start(main_loop)
+        try:
+            main_loop.run()
+        finally:
+            for watcher in watchers:
+                watcher.stop()
         return self._clicked
 
 
@@ -1021,7 +1735,12 @@ class IpEdit(urwid.Edit):
 
 
 class ProcessStep(object):
-    """Defines a step to be run by the installation handler"""
+    """Defines a step to be run by the installation handler
+
+    Steps shown more than once keep their widgets and form: build_ui_widgets
+    and build_ui run on the first visit and update_ui changes the widgets in
+    place on the later ones, so the focus and the unchanged rows are kept.
+    """
     def __init__(self):
         self._ui = None
         self._ui_widgets = None
@@ -1073,6 +1792,11 @@ class ProcessStep(object):
         """Method to create the ui"""
         self._ui = True
 
+    def update_ui(self, config):
+        """Method to refresh the widgets of an already built ui"""
+        # pylint: disable=W0613
+        return
+
 
 class SplashScreen(ProcessStep):
     # pylint: disable=R0902
@@ -1144,6 +1868,8 @@ class KeyboardSelection(ButtonMenu):
                        'tab, right arrow        - proceed to next screen '
                        'without changing keyboard map\n'
                        'j, k, up/down arrow     - navigate the list\n'
+                       '/                       - search the list, enter '
+                       'to keep the filter\n'
                        'enter                   - set keyboard mapping to '
                        'selection and proceed')
         self.selection = 'us'
@@ -1190,7 +1916,7 @@ class KeyboardSelection(ButtonMenu):
         return self
 
 
-class NavListBox(urwid.ListBox):
+class NavListBox(SearchListBox):
     """
     Screen to allow user to select keyboard layout for installer
     """
@@ -1203,6 +1929,8 @@ class NavListBox(urwid.ListBox):
         """ Get the key that was pressed """
         # pylint: disable=E0203
         # pylint: disable=W0201
+        if self.searching or (key == 'esc' and self.body.search):
+            return super(NavListBox, self).keypress(size, key)
         # we will handle the following keys ourselves, don't call super
         if key not in ['tab', 'j', 'k', 'q', 'right', 'left', 'esc']:
             key = super(NavListBox, self).keypress(size, key)
@@ -1323,28 +2051,21 @@ class ChooseAction(ProcessStep):
             self._action = 'return'
             return
 
-        watch = WatchableProcess(['swupd',
+        repair = CommandProgress('Repairing',
+                                 ['swupd',
                                   'verify',
                                   '--path={}'.format(self.target_dir),
                                   '--statedir={}'
                                   .format(os.path.join(self.target_dir,
                                                        "var/lib/swupd")),
-                                  '--fix'])
-        watch.start()
-        current = 0
-        Alert('Repairing',
-              'Repairing host os on {}...'.format(root_part),
-              block=False).do_alert()
-        while not watch.done:
-            if len(watch.output) > current:
-                current = len(watch.output)
-                text = '\n'.join(watch.output[-10:])
-                Alert('Repairing', text, block=False).do_alert()
-        Alert('Repairing', '\n'.join(watch.output[-10:])).do_alert()
-
-        if not watch.poll():
+                                  '--fix'],
+                                 'Repairing host os on {}...'
+                                 .format(root_part))
+        returncode = repair.run()
+
+        if returncode == 0:
             Alert('Repairing', 'Successful repair').do_alert()
-        else:
+        elif returncode is not None:
             Alert('Error!', 'Unable to repair host os').do_alert()
 
         self._umount_host_disk(root_part, boot_part)
@@ -1478,6 +2199,8 @@ class NetworkControl(object):
         """
         Update widgets with latest network information that can be found
         """
+        import netifaces
+
         interface_ip = self.find_interface_ip()
         if interface_ip:
             interface_res = interface_ip[0]
@@ -1548,6 +2271,8 @@ class NetworkControl(object):
 
     def find_interface_ip(self):
         """Find active interface and ip address"""
+        import netifaces
+
         # pylint: disable=E1103
         addrs = {}
         mask = ''
@@ -1662,6 +2387,71 @@ class NetworkControl(object):
         raise urwid.ExitMainLoop()
 
 
+class ConnectionCheck(object):
+    """Run a connectivity check in the background and cache its result
+
+    check is called with the key (the proxy and URLs to check) from a worker
+    thread, its result is kept for NETWORK_CHECK_TTL seconds. While the form
+    runs, results are handed to the urwid main loop through a watch_pipe and
+    passed to on_result.
+    """
+    def __init__(self, check, on_result):
+        self.check = check
+        self.on_result = on_result
+        self.loop = None
+        self._lock = threading.Lock()
+        self._pipe = None
+        self._results = {}
+        self._running = set()
+
+    def result(self, key):
+        """Return the cached result for key, None while it is checked"""
+        with self._lock:
+            cached = self._results.get(key)
+            if cached and time.monotonic() - cached[0] < NETWORK_CHECK_TTL:
+                return cached[1]
+            if key not in self._running:
+                self._running.add(key)
+                threading.Thread(target=self._work, args=(key,),
+                                 daemon=True).start()
+        return None
+
+    def invalidate(self):
+        """Drop the cached results, the network configuration changed"""
+        with self._lock:
+            self._results = {}
+
+    def _work(self, key):
+        try:
+            result = self.check(*key)
+        except Exception:
+            result = False
+        with self._lock:
+            self._running.discard(key)
+            self._results[key] = (time.monotonic(), result)
+            if self._pipe:
+                os.write(self._pipe, b'.')
+
+    def _deliver(self, _):
+        self.on_result()
+        return True
+
+    def start(self, loop):
+        """Deliver the results arriving while loop runs"""
+        self.loop = loop
+        with self._lock:
+            self._pipe = loop.watch_pipe(self._deliver)
+        # a result may have arrived before the loop was started
+        self.on_result()
+
+    def stop(self):
+        """Stop delivering results to the main loop"""
+        with self._lock:
+            self.loop.remove_watch_pipe(self._pipe)
+            os.close(self._pipe)
+            self._pipe = None
+
+
 class NetworkRequirements(ProcessStep):
     """UI to verify and configure network connectivity to
     the version and content urls for the installer"""
@@ -1698,28 +2488,30 @@ class NetworkRequirements(ProcessStep):
         self.version_url_alt = None
         self.config = None
         self.nettime = False
+        self.time_error = None
         self.reset = False
         self.netcontrol = None
-        # wait for network service to load the first time this screen is loaded
-        self.timeout = ''
-        if not network_service_ready():
-            self.timeout = 'Network service timed out, hit refresh to retry'
+        self.wired_req = None
+        self.check = ConnectionCheck(self._check_connection,
+                                     self._show_connection)
+        self.monitor = NetworkMonitor(self._network_changed)
 
     def handler(self, config):
         # make config an instance variable so we can copy proxy settings to it
         self.config = config
-        self.netcontrol = NetworkControl(target=self._static_configuration,
-                                         allow_reset=True,
-                                         gen_en=True,
-                                         header='Static IP Configuration '
-                                                '(optional)',
-                                         label='Set static IP configuration '
-                                               '(may require "Refresh")')
-
-        # normally much of this would belong in __init__, but we want it
-        # refreshed every time the user refreshes/returns to the screen
-        self.build_ui_widgets()
-        self.build_ui()
+        if self._ui is None:
+            self.netcontrol = NetworkControl(
+                target=self._static_configuration,
+                allow_reset=True,
+                gen_en=True,
+                header='Static IP Configuration (optional)',
+                label='Set static IP configuration (may require "Refresh")')
+            self.build_ui_widgets()
+            self.build_ui()
+        else:
+            # refreshed every time the user refreshes/returns to the screen
+            FACTS.invalidate('dns')
+            self.update_ui(config)
         self._action = self.run_ui()
         if self._action == 'Refresh':
             # re-build the widgets
@@ -1756,34 +2548,40 @@ class NetworkRequirements(ProcessStep):
                 urwid.Text(('ex', 'example: http://alt.version.com/update/'),
                         align='center')])
 
-        if self.timeout:
-            wired_req = urwid.Text(('warn', self.timeout))
-        else:
-            if self._network_connection():
-                wired_req = urwid.Text(['* Connection to the update server: ',
-                                        ('success', 'established')])
-            else:
-                wired_req = urwid.Text(['* Connection to the update server: ',
-                                        ('warn', 'none detected, '),
-                                        'install will fail'])
-
-        self._ui_widgets = [self.progress,
-                            wired_req,
-                            urwid.Divider(),
-                            self.mirror_header,
-                            content_col,
-                            self.mirror_button,
-                            version_col,
-                            self.version_button,
-                            urwid.Divider(),
-                            self.proxy_header,
-                            https_col,
-                            self.proxy_button,
-                            urwid.Divider()]
-        self._ui_widgets.extend(self.netcontrol.widgets)
+        self.wired_req = urwid.Text('')
+        self._show_connection()
+
+        self._settings = [self.progress,
+                          self.wired_req,
+                          urwid.Divider(),
+                          self.mirror_header,
+                          content_col,
+                          self.mirror_button,
+                          version_col,
+                          self.version_button,
+                          urwid.Divider(),
+                          self.proxy_header,
+                          https_col,
+                          self.proxy_button,
+                          urwid.Divider()]
+        self._ui_widgets = self._settings + self._network_widgets()
+
+    def _network_widgets(self):
+        widgets = list(self.netcontrol.widgets)
         if os.path.isfile('/etc/systemd/network/10-en-static.network'):
-            self._ui_widgets.extend([self.netcontrol.reset_button,
-                                     urwid.Divider()])
+            widgets.extend([self.netcontrol.reset_button, urwid.Divider()])
+        return widgets
+
+    def update_ui(self, config):
+        """Show the current proxy, URLs and detected network"""
+        self.https_proxy.set_edit_text(os.environ.get('https_proxy', ''))
+        self.content_url_alt.set_edit_text(self.content_url or '')
+        self.version_url_alt.set_edit_text(self.version_url or '')
+        self._show_connection()
+        # only the detected network rows change
+        self.netcontrol.update_widgets()
+        self._ui_widgets = self._settings + self._network_widgets()
+        self._ui.set_fields(self._ui_widgets)
 
     def build_ui(self):
         self._ui = SimpleForm(u'Network Requirements',
@@ -1792,11 +2590,57 @@ class NetworkRequirements(ProcessStep):
                                                          "Next"])
 
     def run_ui(self):
-        return self._ui.do_form(pop_ups=True)
+        return self._ui.do_form(pop_ups=True,
+                                watchers=[self.monitor, self.check])
+
+    def _network_changed(self):
+        """The network came up or went away, check the connection again"""
+        self.check.invalidate()
+        self._show_connection()
+
+    def _check_key(self):
+        """The settings a connectivity check result depends on"""
+        return (os.environ.get('https_proxy'), self.content_url,
+                self.version_url)
+
+    def _show_connection(self):
+        """Show the connectivity check result, starting a check if needed"""
+        connected = None
+        if self.monitor.usable:
+            connected = self.check.result(self._check_key())
+        if not self.monitor.usable:
+            text = ['* Connection to the update server: ',
+                    ('warn', 'waiting for a network route and DNS server')]
+        elif connected is None:
+            text = ['* Connection to the update server: ', 'checking...']
+        elif connected:
+            text = ['* Connection to the update server: ',
+                    ('success', 'established')]
+        else:
+            text = ['* Connection to the update server: ',
+                    ('warn', 'none detected, '),
+                    'install will fail']
+        if self.time_error:
+            text.append(('warn', '\nUnable to set system time, this may '
+                                 'cause failures with the Clear Linux OS '
+                                 'Software Updater: {}'
+                                 .format(self.time_error)))
+        self.wired_req.set_text(text)
+
+    def _check_connection(self, _, content_url, version_url):
+        """ConnectionCheck function, the proxy is taken from the environment"""
+        return self._network_connection(content_url, version_url)
+
+    def _network_connection(self, content_url=None, version_url=None):
+        """Check if connection to content and version urls are available
+
+        The urls are checked concurrently.
+        """
+        import pycurl
 
-    def _network_connection(self):
-        """Check if connection to content and version urls are available"""
         # pylint: disable=E1103
+        content_url = content_url or self.content_url
+        version_url = version_url or self.version_url
 
         class Storage(object):
             """Storage class for pycurl"""
@@ -1822,21 +2666,33 @@ class NetworkRequirements(ProcessStep):
             curl.setopt(curl.TIMEOUT, 3)
             return headers, curl
 
-        urls = {self.content_url: make_curl(self.content_url)}
-        if self.content_url != self.version_url:
-            urls[self.version_url] = make_curl(self.version_url)
-
-        try:
-            for (headers, curl) in urls.values():
+        def perform(curl):
+            """perform the request, recording failures"""
+            try:
                 curl.perform()
-                if '401' not in str(headers):
-                    if not self.nettime:
-                        self._set_hw_time(headers.buffer)
-                else:
-                    return False
-        except Exception:
+            except Exception:
+                failed.append(curl)
+
+        urls = {content_url: make_curl(content_url)}
+        if content_url != version_url:
+            urls[version_url] = make_curl(version_url)
+
+        failed = []
+        threads = [threading.Thread(target=perform, args=(curl,))
+                   for (_, curl) in urls.values()]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if failed:
             return False
 
+        for (headers, _) in urls.values():
+            if '401' in str(headers):
+                return False
+            if not self.nettime:
+                self._set_hw_time(headers.buffer)
+
         return True
 
     def _set_hw_time(self, headers):
@@ -1854,10 +2710,8 @@ class NetworkRequirements(ProcessStep):
                                      '--set={}'.format(line)])
                     subprocess.call(['hwclock', '--systohc'])
                 except Exception as excep:
-                    Alert('Error!',
-                          'Unable to set system time, this may cause failures '
-                          'with the Clear Linux OS Software Updater: {}'
-                          .format(excep)).do_alert()
+                    # runs in the check thread, shown with the check result
+                    self.time_error = excep
 
                 break
 
@@ -1899,6 +2753,7 @@ class NetworkRequirements(ProcessStep):
         except Exception as err:
             Alert('Error!', str(err)).do_alert()
 
+        self.check.invalidate()
         raise urwid.ExitMainLoop()
 
     def _set_proxy(self, _):
@@ -2262,6 +3117,142 @@ class PartitioningMenu(ProcessStep):
         return self._action
 
 
+class DiskProbe(object):
+    """Find the target disks and read their partition tables in the background
+
+    Worker threads run get_list_of_disks and get_disk_info and hand the
+    results to the urwid main loop through a watch_pipe. Block device events
+    from udevadm monitor trigger a new scan so hotplugged disks show up and
+    changed partition tables are read again. on_change is called from the
+    main loop whenever the disks or their partition tables changed.
+    """
+    # pylint: disable=R0902
+    def __init__(self, on_change):
+        self.on_change = on_change
+        self.disks = []
+        self.info = {}
+        self.scanned = False
+        self.loop = None
+        self._lock = threading.Lock()
+        self._generation = 0
+        self._queue = None
+        self._results = []
+        self._pipe = None
+        self._monitor = None
+        self._monitor_handle = None
+        self._events = set()
+        self._rescan = None
+
+    def reset(self):
+        """Forget the disks found by the last scan"""
+        self.disks = []
+        self.info = {}
+        self.scanned = False
+        self._events = set()
+        self._rescan = None
+
+    def start(self, loop):
+        """Scan the disks, delivering the results to loop"""
+        self.loop = loop
+        self.reset()
+        self._pipe = loop.watch_pipe(self._deliver)
+        self._queue = queue.Queue()
+        for _ in range(PROBE_THREADS):
+            threading.Thread(target=self._work,
+                             args=(self._queue, self._generation),
+                             daemon=True).start()
+        self._queue.put(('scan', None))
+        try:
+            self._monitor = subprocess.Popen(UDEV_MONITOR,
+                                             stdout=subprocess.PIPE,
+                                             stderr=subprocess.DEVNULL)
+        except OSError:
+            self._monitor = None
+            self._rescan = loop.set_alarm_in(RESCAN_SECONDS, self._scan)
+        else:
+            self._monitor_handle = loop.watch_file(
+                self._monitor.stdout.fileno(), self._udev_event)
+
+    def stop(self):
+        """Stop scanning, results of running probes are dropped"""
+        with self._lock:
+            self._generation += 1
+            self.loop.remove_watch_pipe(self._pipe)
+            os.close(self._pipe)
+        for _ in range(PROBE_THREADS):
+            self._queue.put(None)
+        if self._rescan:
+            self.loop.remove_alarm(self._rescan)
+        self._stop_monitor()
+
+    def _stop_monitor(self):
+        if self._monitor:
+            self.loop.remove_watch_file(self._monitor_handle)
+            self._monitor.kill()
+            self._monitor.wait()
+            self._monitor.stdout.close()
+            self._monitor = None
+
+    def _work(self, tasks, generation):
+        """Worker thread running the queued scans and probes"""
+        for task in iter(tasks.get, None):
+            if task[0] == 'scan':
+                result = ('disks', get_list_of_disks())
+            else:
+                result = ('info', task[1],
+                          get_disk_info('/dev/{}'.format(task[1])))
+            with self._lock:
+                if generation != self._generation:
+                    return
+                self._results.append(result)
+                os.write(self._pipe, b'.')
+
+    def _deliver(self, _):
+        """Main loop side of the pipe, apply the finished scans and probes"""
+        with self._lock:
+            results, self._results = self._results, []
+        for result in results:
+            if result[0] == 'disks':
+                self.scanned = True
+                self.disks = result[1]
+                for disk in list(self.info):
+                    if disk not in self.disks:
+                        del self.info[disk]
+                for disk in self.disks:
+                    if disk not in self.info or \
+                       any(name.startswith(disk) for name in self._events):
+                        self.info[disk] = None
+                        self._queue.put(('probe', disk))
+                self._events = set()
+            else:
+                self.info[result[1]] = result[2]
+        if results:
+            self.on_change()
+        return True
+
+    def _udev_event(self):
+        """Collect the devices of block events, scan again once they settle"""
+        data = os.read(self._monitor.stdout.fileno(), 65536)
+        if not data:
+            # no udev, fall back to scanning every RESCAN_SECONDS
+            self._stop_monitor()
+            if self._rescan:
+                self.loop.remove_alarm(self._rescan)
+            self._scan()
+            return
+        for line in data.decode('utf-8', 'replace').splitlines():
+            if line.endswith('(block)'):
+                self._events.add(os.path.basename(line.split()[-2]))
+        if not self._rescan:
+            self._rescan = self.loop.set_alarm_in(0.5, self._scan)
+
+    def _scan(self, *_):
+        self._rescan = None
+        self._queue.put(('scan', None))
+        if not self._monitor:
+            self._rescan = self.loop.set_alarm_in(RESCAN_SECONDS, self._scan)
+
+
 class SelectDeviceStep(ProcessStep):
     """UI to display the available disks"""
     def __init__(self, cur_step, tot_steps):
@@ -2270,14 +3261,11 @@ class SelectDeviceStep(ProcessStep):
         self._actions = None
         self.disks = []
         self.progress = 'Step {} of {}'.format(cur_step, tot_steps)
-
-    def handler(self, config):
         # look every time, slow-loading or plug-in devices may show up late
-        self.disks = get_list_of_disks()
-        self.build_ui_widgets()
+        self.probe = DiskProbe(self._disks_changed)
 
-        self._ui = SimpleForm(u'Choose target device for installation',
-                              self._ui_widgets, buttons=['Previous'])
+    def handler(self, config):
+        self.update_ui(config)
         self._action = None
         self._clicked = None
 
@@ -2296,8 +3284,27 @@ class SelectDeviceStep(ProcessStep):
 
         return self._action
 
+    def update_ui(self, config):
+        """Start over from an empty disk list, the probe fills it in"""
+        self.disks = []
+        self.probe.reset()
+        if self._ui is None:
+            self.build_ui_widgets()
+            self.build_ui()
+        else:
+            self._ui_widgets.set_items(self._disk_rows())
+
+    def build_ui(self):
+        self._ui = SimpleForm(u'Choose target device for installation',
+                              self._ui_widgets, buttons=['Previous'])
+
     def run_ui(self):
-        return self._ui.do_form()
+        return self._ui.do_form(watchers=[self.probe])
+
+    def _disks_changed(self):
+        """Show the disks and partition tables found so far"""
+        self.disks = self.probe.disks
+        self._ui_widgets.set_items(self._disk_rows())
 
     def _item_chosen(self, _, choice):
         self._clicked = choice
@@ -2308,51 +3315,60 @@ class SelectDeviceStep(ProcessStep):
         raise urwid.ExitMainLoop()
 
     def build_ui_widgets(self):
-        self._ui_widgets = [urwid.Text(self.progress)]
+        self._ui_widgets = LazyListWalker(self._disk_rows(), self._disk_row,
+                                          label=lambda row: row[1])
+
+    def _disk_rows(self):
+        """Rows of the disk list, (kind, disk) for the rows of a disk"""
+        rows = [urwid.Text(self.progress)]
         if not self.disks:
-            widget = urwid.Text(u"No free devices found.")
-            self._ui_widgets.append(widget)
+            if self.probe.scanned:
+                rows.append(urwid.Text(u"No free devices found."))
+            else:
+                rows.append(urwid.Text(u"Looking for devices..."))
+        for disk in self.disks:
+            rows.extend([('header', disk), ('info', disk), ('button', disk),
+                         ('divider', disk)])
+        rows.append(ister_button('Refresh device list',
+                                 on_press=self._refresh))
+        return rows
+
+    def _disk_row(self, row):
+        kind, disk = row
+        if kind == 'header':
+            return urwid.Text('/dev/{}'.format(disk))
+        if kind == 'button':
+            return ister_button('Partition /dev/{}'.format(disk),
+                                on_press=self._item_chosen,
+                                user_data=disk)
+        if kind == 'divider':
+            return urwid.Divider()
+        info = ''
+        disk_info = self.probe.info.get(disk)
+        if disk_info is None:
+            info += 'reading partition table...'
+        elif not disk_info["partitions"]:
+            info += 'no partitions found'
         else:
-            for disk in self.disks:
-                header = urwid.Text('/dev/{}'.format(disk))
-                info = ''
-                disk_info = get_disk_info('/dev/{}'.format(disk))
-                if not disk_info["partitions"]:
-                    info += 'no partitions found'
-                else:
-                    for part in disk_info["partitions"]:
-                        # leave space between part name and size so long
-                        # partition names such as mmcblk1p1 don't bump into the
-                        # partition size
-                        info += '{0:10} {1:6}{2:28}\n'.format(part["name"],
-                                                              part["size"],
-                                                              part["type"])
-
-                info = urwid.Padding(urwid.Text(info), left=8)
-                button = ister_button('Partition /dev/{}'.format(disk),
-                                      on_press=self._item_chosen,
-                                      user_data=disk)
-                self._ui_widgets.extend([header,
-                                         info,
-                                         button,
-                                         urwid.Divider()])
-
-        self._ui_widgets.append(ister_button('Refresh device list',
-                                             on_press=self._refresh))
+            for part in disk_info["partitions"]:
+                # leave space between part name and size so long
+                # partition names such as mmcblk1p1 don't bump into the
+                # partition size
+                info += '{0:10} {1:6}{2:28}\n'.format(part["name"],
+                                                      part["size"],
+                                                      part["type"])
+        return urwid.Padding(urwid.Text(info), left=8)
 
 
 class SelectMultiDeviceStep(SelectDeviceStep):
     """UI to display the available disks"""
     def handler(self, config):
-        # look every time, slow-loading or plug-in devices may show up late
-        self.disks = get_list_of_disks()
-        config["Disks"] = self.disks
-        other_options = ['Previous', 'Next']
-        self.build_ui_widgets()
-        self._ui = SimpleForm(u'Choose a drive to partition using cgdisk tool',
-                              self._ui_widgets, buttons=other_options)
+        self.update_ui(config)
         self._clicked = None
         self._action = self.run_ui()
+        # the list may have changed while the screen was shown
+        config["Disks"] = self.probe.disks if self.probe.scanned \
+            else get_list_of_disks()
         if self._clicked:
             if self._clicked == 'Refresh':
                 return self._clicked
@@ -2360,10 +3376,12 @@ class SelectMultiDeviceStep(SelectDeviceStep):
                 config["CurrentDisk"] = self._clicked
                 return 'cgdisk'
 
-        # get the list again, it might have changed
-        config["Disks"] = get_list_of_disks()
         return self._action
 
+    def build_ui(self):
+        self._ui = SimpleForm(u'Choose a drive to partition using cgdisk tool',
+                              self._ui_widgets, buttons=['Previous', 'Next'])
+
 
 class TerminalStep(ProcessStep):
     """UI to display cgdisk to manage partitioning"""
@@ -2451,6 +3469,9 @@ class MountPointsStep(ProcessStep):
         self.mount_d = {}
         self.choices = None
         self.encrypt = False
+        self.cbox_encrypt = urwid.CheckBox('Encrypt Root Partition')
+        # position of the first partition row in the list
+        self._first_choice = 2
 
     def handler(self, config):
         # pylint: disable=R0914
@@ -2467,13 +3488,14 @@ class MountPointsStep(ProcessStep):
         for disk in removed:
             mount_d.pop(disk, None)
 
-        other_options = ['Previous', 'Next']
         required_mounts = ['/', '/boot']
         validated = False
-        while not validated:
+        if self._ui is None:
             self.build_ui_widgets()
-            self._ui = SimpleForm(u'Set mount points',
-                                  self._ui_widgets, buttons=other_options)
+            self.build_ui()
+        else:
+            self.update_ui(config)
+        while not validated:
             self._clicked = None
             self._action = self._ui.do_form()
             self.encrypt = self.cbox_encrypt.get_state()
@@ -2487,11 +3509,11 @@ class MountPointsStep(ProcessStep):
                     self._erase_dup_mount(point, partition)
                     idx = self.choices.index(self._clicked)
                     _format = 'Yes' if mount_d[point]['format'] else ''
-                    self.choices[idx] = self.display_fmt.format(partition,
-                                                                size,
-                                                                part_type,
-                                                                point,
-                                                                _format)
+                    self._set_choice(idx, self.display_fmt.format(partition,
+                                                                  size,
+                                                                  part_type,
+                                                                  point,
+                                                                  _format))
             elif self._action == 'Next':
                 validated = True
                 for mount in required_mounts:
@@ -2514,35 +3536,48 @@ class MountPointsStep(ProcessStep):
     def _erase_dup_mount(self, point, part):
         for idx, chc in enumerate(self.choices):
             if '{} '.format(point) in chc and '{} '.format(part) not in chc:
-                self.choices[idx] = \
-                    (self.choices[idx]
-                     .replace(point, ' ' * len(point))
-                     .replace('Yes', '   '))
+                choice = chc.replace(point, ' ' * len(point))
+                self._set_choice(idx, choice.replace('Yes', '   '))
+
+    def _set_choice(self, idx, choice):
+        """Change the partition at idx, only its row is built again"""
+        self.choices[idx] = choice
+        self._ui_widgets.update(self._first_choice + idx, choice)
 
     def _item_chosen(self, _, choice):
         self._clicked = choice
         raise urwid.ExitMainLoop()
 
     def build_ui_widgets(self, *_):
-        self._ui_widgets = [self.progress]
+        self._ui_widgets = LazyListWalker(self._partition_rows(),
+                                          self._partition_button)
+
+    def build_ui(self):
+        self._ui = SimpleForm(u'Set mount points', self._ui_widgets,
+                              buttons=['Previous', 'Next'])
+
+    def update_ui(self, config):
+        """Show the partitions found again, cgdisk may have changed them"""
+        self._ui_widgets.set_items(self._partition_rows())
+
+    def _partition_rows(self):
+        rows = [self.progress]
         if not self.choices:
             widget = urwid.Text(u"No partitions found.")
-            self._ui_widgets.append(widget)
+            rows.append(widget)
         else:
             wgt = urwid.Text("  " + self.display_fmt.format("Disk",
                                                             "Size",
                                                             "Partition type",
                                                             "Mount point",
                                                             "Format?"))
-            self._ui_widgets.append(wgt)
-            for part in self.choices:
-                button = ister_button(part,
-                                      on_press=self._item_chosen,
-                                      user_data=part)
-                self._ui_widgets.append(button)
-            self.cbox_encrypt = urwid.CheckBox('Encrypt Root Partition',
-                    state=self.encrypt)
-            self._ui_widgets.append(self.cbox_encrypt)
+            rows.append(wgt)
+            rows.extend(self.choices)
+            rows.append(self.cbox_encrypt)
+        return rows
+
+    def _partition_button(self, part):
+        return ister_button(part, on_press=self._item_chosen, user_data=part)
 
     def _save_config(self, config, mount_d):
         config['PartitionLayout'] = list()
@@ -2702,24 +3737,21 @@ class BundleSelectorStep(ProcessStep):
             self.bundles.extend(self.default_bundles)
             self.default_set = True
 
-        # build widgets and ui each time in case user went back and opted out
-        # of telemetrics
-        self.build_ui_widgets(config)
-        self.build_ui()
+        # update the list each time in case user went back and opted out of
+        # telemetrics
+        if self._ui is None:
+            self.build_ui_widgets(config)
+            self.build_ui()
+        else:
+            self.update_ui(config)
         self._action = self.run_ui()
-        wgen = (w for w in self._ui_widgets[2:]
-                if isinstance(w, urwid.Columns))
-        for widget in wgen:
-            for content in widget.contents:
-                if isinstance(content[0], urwid.CheckBox):
-                    bundle = content[0].get_label()
-                    bundle = bundle.split()[0]
-                    if content[0].get_state():
-                        if bundle not in config['Bundles']:
-                            config['Bundles'].append(bundle)
-                    else:
-                        if bundle in config['Bundles']:
-                            config['Bundles'].remove(bundle)
+        for bundle, state in self._selected.items():
+            if state:
+                if bundle not in config['Bundles']:
+                    config['Bundles'].append(bundle)
+            else:
+                if bundle in config['Bundles']:
+                    config['Bundles'].remove(bundle)
 
         # update only if user had chance to unselect - the user had a chance to
         # unselect the bundle if it is not in the required_bundles list.
@@ -2733,11 +3765,22 @@ class BundleSelectorStep(ProcessStep):
         return self._ui.do_form()
 
     def build_ui_widgets(self, config):
-        self._ui_widgets = []
+        self._ui_widgets = LazyListWalker(self._bundle_rows(config),
+                                          self._bundle_row,
+                                          label=lambda row: row['name'])
+
+    def update_ui(self, config):
+        """Show the bundles again, the required ones may have changed"""
+        self._ui_widgets.set_items(self._bundle_rows(config))
+
+    def _bundle_rows(self, config):
+        rows = []
         if self.progress:
-            self._ui_widgets = [self.progress, urwid.Divider()]
-        self._ui_widgets.extend([urwid.Text('Select the bundles to install:'),
-                                 urwid.Divider()])
+            rows = [self.progress, urwid.Divider()]
+        rows.extend([urwid.Text('Select the bundles to install:'),
+                     urwid.Divider()])
+        # check box states live here, the rows may be rebuilt while scrolling
+        self._selected = collections.OrderedDict()
         for bundle in self.bundles:
             state = True if bundle['name'] in config['Bundles'] else False
             # sysadmin-basic state needs to be handled differently.
@@ -2746,18 +3789,27 @@ class BundleSelectorStep(ProcessStep):
             # the required bundles list.
             if bundle['name'] == 'sysadmin-basic':
                 state = self.sysadmin_basic_state
-            check = urwid.CheckBox(bundle['name'], state=state)
-            desc_text = urwid.Text(bundle['desc'])
-            column = urwid.Columns([check, ('weight', 2, desc_text)])
-            self._ui_widgets.append(column)
-
-        self._ui_widgets.extend([urwid.Divider(),
-                                 urwid.Text('--- required ---')])
-        for bundle in self.required_bundles:
-            text_name = urwid.Text('    {0}'.format(bundle['name']))
-            text_desc = urwid.Text(bundle['desc'])
-            column = urwid.Columns([text_name, ('weight', 2, text_desc)])
-            self._ui_widgets.append(column)
+            self._selected[bundle['name']] = state
+            rows.append(bundle)
+
+        rows.extend([urwid.Divider(), urwid.Text('--- required ---')])
+        rows.extend(dict(bundle, required=True)
+                    for bundle in self.required_bundles)
+        return rows
+
+    def _bundle_row(self, bundle):
+        if bundle.get('required'):
+            name = urwid.Text('    {0}'.format(bundle['name']))
+        else:
+            name = urwid.CheckBox(bundle['name'],
+                                  state=self._selected[bundle['name']],
+                                  on_state_change=self._bundle_toggled,
+                                  user_data=bundle['name'])
+        desc_text = urwid.Text(bundle['desc'])
+        return urwid.Columns([name, ('weight', 2, desc_text)])
+
+    def _bundle_toggled(self, _, state, bundle):
+        self._selected[bundle] = state
 
     def build_ui(self):
         self._ui = SimpleForm(u'Bundle selector', self._ui_widgets)
@@ -2866,6 +3918,8 @@ class UserConfigurationStep(ProcessStep):
                 user['fullname'] = fname or lname
 
     def handler(self, config):
+        import crypt
+
         if not self._ui_widgets:
             self.build_ui_widgets()
         if not self._ui:
@@ -3014,6 +4068,8 @@ class StaticIpStep(ProcessStep):
 
     def handler(self, config):
         self.config = config
+        # the DNS servers may have changed since the previous screens
+        FACTS.invalidate('dns')
         self.netcontrol = NetworkControl(allow_reset=True,
                                          target=self._save_config,
                                          gen_en=True)
@@ -3068,6 +4124,8 @@ class StaticIpStep(ProcessStep):
         Find the network information to pre-populate the static configuration
         fields.
         """
+        import netifaces
+
         if_ip = self.netcontrol.find_interface_ip()
         self.iface_res = if_ip[0] if if_ip else ''
         self.ip_res = if_ip[1] if if_ip else ''
@@ -3120,26 +4178,174 @@ class RunInstallation(ProcessStep):
     pass
 
 
-class WatchableProcess(threading.Thread):
-    """Thread class to watch output of system command"""
-    def __init__(self, cmd):
-        self.poll = lambda *x: None
+class LazyStep(object):
+    """Stands in for step_class(*args) until the step is first shown
+
+    The actions set before the step is built are passed on to it, facts
+    names the FACTS its constructor and screen need.
+    """
+    def __init__(self, step_class, *args, facts=()):
+        self.step_class = step_class
+        self.args = args
+        self.facts = facts
+        self.step = None
+        self._actions = {}
+
+    @property
+    def action_map(self):
+        """The actions of the step, built or not"""
+        return self.step.action_map if self.step else self._actions
+
+    def set_action(self, action, target, **_):
+        """Sets process step to be matched by a key"""
+        if self.step:
+            self.step.set_action(action, target)
+        else:
+            self._actions[action] = target
+
+    def build(self):
+        """Return the step, building it on the first call"""
+        if self.step is None:
+            self.step = self.step_class(*self.args)
+            for action, target in self._actions.items():
+                self.step.set_action(action, target)
+        return self.step
+
+
+def prefetch_steps(step, depth=PREFETCH_DEPTH):
+    """Start gathering the facts of the steps up to depth actions ahead of
+    step"""
+    steps = [step]
+    for _ in range(depth):
+        steps = [target for current in steps
+                 for target in getattr(current, 'action_map', {}).values()]
+        for target in steps:
+            if isinstance(target, LazyStep):
+                FACTS.start(target.facts)
+
+
+class CommandProgress(object):
+    """Screen running a command from the urwid main loop
+
+    The command output is read from a file descriptor callback into a
+    scrolling list which, with the elapsed time, is refreshed by an alarm at
+    most REDRAWS_PER_SECOND times a second. Cancel terminates the command.
+    """
+    # pylint: disable=R0902
+    def __init__(self, title, cmd, message=''):
         self.cmd = cmd
         self.process = None
-        self.output = []
-        self.done = False
-        threading.Thread.__init__(self)
+        self.returncode = None
+        self.cancelled = False
+        self.loop = None
+        self._handle = None
+        self._start = None
+        self._partial = b''
+        self._pending = []
+        self._finished = False
+        self._status = urwid.Text(message)
+        self._elapsed = urwid.Text('', align='right')
+        self._output = urwid.SimpleFocusListWalker([])
+        self._pile = urwid.Pile([('pack', urwid.Columns([self._status,
+                                                         self._elapsed])),
+                                 ('pack', urwid.Divider()),
+                                 urwid.ListBox(self._output),
+                                 ('pack', urwid.Divider()),
+                                 ('pack', self._button('Cancel'))],
+                                focus_item=4)
+        self._frame = urwid.LineBox(self._pile, title=title)
+        self._ui = urwid.Overlay(self._frame,
+                                 urwid.AttrMap(urwid.SolidFill(u' '), 'bg'),
+                                 align='center',
+                                 width=('relative', PERCENTAGE_W),
+                                 valign='middle',
+                                 height=('relative', PERCENTAGE_H))
+        self._ui = urwid.AttrMap(self._ui, 'banner')
+
+    def _button(self, label):
+        return ister_button(label, on_press=self._on_click, align='center')
+
+    def _on_click(self, _):
+        if self._finished:
+            raise urwid.ExitMainLoop()
+        if not self.cancelled:
+            self.cancelled = True
+            self._status.set_text('Cancelling...')
+            self.process.terminate()
+            self.loop.set_alarm_in(5, self._kill)
+
+    def _kill(self, *_):
+        if self.process.poll() is None:
+            self.process.kill()
+
+    def _read(self):
+        """File descriptor callback queueing the new output lines"""
+        data = os.read(self.process.stdout.fileno(), 65536)
+        if data:
+            lines = (self._partial + data).split(b'\n')
+            self._partial = lines.pop()
+            self._pending.extend(lines)
+            return
+        if self._partial:
+            self._pending.append(self._partial)
+        self.loop.remove_watch_file(self._handle)
+        self.process.stdout.close()
+        self.returncode = self.process.wait()
+        self._finished = True
+        self._refresh()
+
+    def _refresh(self, *_):
+        """Show the queued output and the elapsed time"""
+        elapsed = int(time.monotonic() - self._start)
+        self._elapsed.set_text('Elapsed {0}:{1:02}'.format(elapsed // 60,
+                                                           elapsed % 60))
+        if self._pending:
+            self._output.extend(
+                urwid.Text(line.decode('utf-8', 'replace').rstrip())
+                for line in self._pending[-OUTPUT_LINES:])
+            self._pending = []
+            del self._output[:-OUTPUT_LINES]
+            self._output.set_focus(len(self._output) - 1)
+        if not self._finished:
+            self.loop.set_alarm_in(1 / REDRAWS_PER_SECOND, self._refresh)
+            return
+        if self.cancelled:
+            self._status.set_text('Cancelled')
+        elif self.returncode:
+            self._status.set_text('Failed with exit code {0}'
+                                  .format(self.returncode))
+        else:
+            self._status.set_text('Finished')
+        self._pile.contents[4] = (self._button(u'Ok'),
+                                  self._pile.options('pack'))
+        self._pile.focus_position = 4
+
+    def start(self, loop):
+        """Start the command and watch its output from loop"""
+        self.loop = loop
+        self._start = time.monotonic()
+        try:
+            self.process = subprocess.Popen(self.cmd,
+                                            stdout=subprocess.PIPE,
+                                            stderr=subprocess.STDOUT)
+        except OSError as exc:
+            self._pending.append(str(exc).encode('utf-8'))
+            self.returncode = 127
+            self._finished = True
+        else:
+            self._handle = loop.watch_file(self.process.stdout.fileno(),
+                                           self._read)
+        self._refresh()
 
     def run(self):
-        self.process = subprocess.Popen(self.cmd,
-                                        stdout=subprocess.PIPE,
-                                        stderr=subprocess.PIPE,
-                                        bufsize=1)
-        self.poll = self.process.poll
-        lines = self.process.stdout
-        for line in lines:
-            self.output.append(line.decode('utf-8').strip())
-        self.done = True
+        """Run the command until it exits and the result is acknowledged
+
+        Returns the exit code of the command, None when it was cancelled.
+        """
+        loop = urwid.MainLoop(self._ui, palette=PALETTE)
+        self.start(loop)
+        loop.run()
+        return None if self.cancelled else self.returncode
 
 
 class Installation(object):
@@ -3154,6 +4360,8 @@ class Installation(object):
         self._steps = list()
         self.start = SplashScreen()
         self._init_actions()
+        # the first steps ask for these while they are built and shown
+        prefetch_steps(self.start)
         self.current_w = None
         self.logger = logging.getLogger('ister_gui')
         self.template_path = '/var/log/ister_gui.log'
@@ -3183,28 +4391,31 @@ class Installation(object):
         current = itertools.count(start=1)
         # auto install assumed so the total is lower
         total = 6
+        # Steps are only built when they are first shown, see LazyStep
         # Select keyboard layout
-        keyboard_select = KeyboardSelection()
+        keyboard_select = LazyStep(KeyboardSelection, facts=['keymaps'])
 
         # Configure network for installer
-        network_requirements = NetworkRequirements(next(current), total,
-                                                   self.args['contenturl'],
-                                                   self.args['versionurl'])
+        network_requirements = LazyStep(NetworkRequirements,
+                                        next(current), total,
+                                        self.args['contenturl'],
+                                        self.args['versionurl'],
+                                        facts=['swupd_mirror', 'dns'])
 
         # Choose action (install/repair/shell)
-        choose_action = ChooseAction(next(current), total)
+        choose_action = LazyStep(ChooseAction, next(current), total)
 
         # Telemetry opt-in
-        telem_disclosure = TelemetryDisclosure(next(current), total)
+        telem_disclosure = LazyStep(TelemetryDisclosure, next(current), total)
 
         # Start installation (manual/automatic)
-        startmenu = StartInstaller(next(current), total)
+        startmenu = LazyStep(StartInstaller, next(current), total)
 
         # Select target device (for automatic install)
-        automatic_device = SelectDeviceStep(next(current), total)
+        automatic_device = LazyStep(SelectDeviceStep, next(current), total)
 
         # Confirm disk wipe
-        confirm_disk_wipe = ConfirmDiskWipe(next(current), total)
+        confirm_disk_wipe = LazyStep(ConfirmDiskWipe, next(current), total)
 
         # The manual install route starts at step 5. The total must be updated
         # to the total in the manual path.
@@ -3212,47 +4423,47 @@ class Installation(object):
         total = 13
 
         # Partition menu
-        part_menu = PartitioningMenu(next(current), total)
+        part_menu = LazyStep(PartitioningMenu, next(current), total)
 
         # Partition meta-step
         meta_step = next(current)
-        manual_part_device = SelectMultiDeviceStep(meta_step, total)
-        manual_nopart_device = SelectDeviceStep(meta_step, total)
+        manual_part_device = LazyStep(SelectMultiDeviceStep, meta_step, total)
+        manual_nopart_device = LazyStep(SelectDeviceStep, meta_step, total)
 
         # cgdisk terminal
-        terminal_cgdisk = TerminalStep()
+        terminal_cgdisk = LazyStep(TerminalStep)
 
         # Mount points meta-step
         meta_step = next(current)
-        set_mount_points = MountPointsStep(meta_step, total)
-        confirm_disk_wipe2 = ConfirmDiskWipe(meta_step, total)
+        set_mount_points = LazyStep(MountPointsStep, meta_step, total)
+        confirm_disk_wipe2 = LazyStep(ConfirmDiskWipe, meta_step, total)
 
         # Configure kernel cmdline
-        config_cmdline = ConfigureCmdline(next(current), total)
+        config_cmdline = LazyStep(ConfigureCmdline, next(current), total)
 
         # Configure hostname
-        config_hostname = ConfigureHostname(next(current), total)
+        config_hostname = LazyStep(ConfigureHostname, next(current), total)
 
         # User configuration meta-step
         meta_step = next(current)
-        confirm_user = ConfirmUserMenu(meta_step, total)
-        user_configuration = UserConfigurationStep(meta_step, total)
+        confirm_user = LazyStep(ConfirmUserMenu, meta_step, total)
+        user_configuration = LazyStep(UserConfigurationStep, meta_step, total)
 
         # Select bundle
-        bundle_selector = BundleSelectorStep(next(current), total)
+        bundle_selector = LazyStep(BundleSelectorStep, next(current), total,
+                                   facts=['virt'])
 
         # Networking meta-step
         meta_step = next(current)
-        confirm_dhcp = ConfirmDHCPMenu(meta_step, total)
-        static_ip_config = StaticIpStep(meta_step, total)
+        confirm_dhcp = LazyStep(ConfirmDHCPMenu, meta_step, total)
+        static_ip_config = LazyStep(StaticIpStep, meta_step, total)
 
         # Confirm installation
         setup_msg = 'Setup is complete. Do you want to begin installation? '  \
                     'This step may take several minutes depending on '        \
                     'bundles selected and network speed.'
-        confirm_installation = ConfirmStep('Attention!',
-                                           setup_msg,
-                                           next(current), total)
+        confirm_installation = LazyStep(ConfirmStep, 'Attention!', setup_msg,
+                                        next(current), total)
         run = RunInstallation()
 
         self.start.set_action('Next', keyboard_select)
@@ -3328,13 +4539,15 @@ class Installation(object):
 
     def run(self):
         """Starts up the installer ui"""
-        pprint.PrettyPrinter(indent=4)
         step = self.start
         # initiate the bundles list at the start, not in a screen, so it does
         # not get overwritten when a user returns to that screen.
         self.installation_d['Bundles'] = list()
         i = 0
         while not isinstance(step, RunInstallation):
+            if isinstance(step, LazyStep):
+                step = step.build()
+            prefetch_steps(step)
             action = step.handler(self.installation_d)
             self.logger.debug("Stepping to % screen", type(step).__name__)
             self.logger.debug(self.installation_d)
@@ -3343,7 +4556,6 @@ class Installation(object):
             elif isinstance(action, Exception):
                 self._exit(-1, str(action))
             step = step.get_next_step(action)
-            _ = pprint.pformat(step, indent=4)
             i += 1
         # Make sure that required bundles are included independently of
         # installation method.
@@ -3373,46 +4585,46 @@ class Installation(object):
                  for item in supported if self.args[item['name']] is not None]
         ister_log = '/var/log/ister.log'
         self.logger.debug(' '.join(ister_cmd))
-        args = ister.handle_options(ister_cmd)
         self.installation_d["SoftwareManager"] = "swupd"
 
-        ister.LOG = ister.logging.getLogger('ister')
-
         try:
-            ister.handle_logging(args.loglevel, ister_log, AlertLoggerHandler(title))
-            ister.install_os(args, self.installation_d)
-            ister.LOG.info("", extra={'block':True})
-            message = ('Successful installation, the system will be rebooted\n'
-                       'please remove installation media after restart')
-            Alert(title, message).do_alert()
-            self._exit(0, reboot=True)
+            # a crash of the install process does not take the UI with it
+            progress = InstallProgress(title)
+            if progress.run(gui_install, ister_cmd, self.installation_d,
+                            ister_log):
+                message = ('Successful installation, the system will be '
+                           'rebooted\nplease remove installation media after '
+                           'restart')
+                Alert(title, message).do_alert()
+                self._exit(0, reboot=True)
+                return
+            problem = 'The installation was cancelled and cleaned up'
         except SystemExit:
-            pass
+            return
         except Exception as e:
-            ister.LOG.debug(e)
-            end_action = ''
-            while not end_action:
-                message = ('An error has ocurred, check log file at {0}?\n'
-                           '(While in log view, press down "q" key to exit)\n'
-                           '(While in shell, type "exit" or Ctrl+D to exit)'
-                           .format("/var/log/ister.log"))
-                alert = Alert(title, message, labels=[u'View log',
-                                                      u'Shell',
-                                                      u'Reboot',
-                                                      u'Shut down'])
-                alert.do_alert()
-                if alert.response == 'View log':
-                    LogViewStep("/var/log/ister.log").handler(
-                        self.installation_d)
-                elif alert.response == 'Shell':
-                    ShellStep().handler(self.installation_d)
-                else:
-                    end_action = alert.response
-            message = ('Unsuccessful installation, system will {0}'
-                       .format(end_action.lower()))
-            reboot = True if end_action == 'Reboot' else False
-            self._exit(1, message=message, title=title, reboot=reboot)
-        return
+            self.logger.debug(e)
+            problem = 'An error has ocurred'
+        end_action = ''
+        while not end_action:
+            message = ('{0}, check log file at {1}?\n'
+                       '(While in log view, press down "q" key to exit)\n'
+                       '(While in shell, type "exit" or Ctrl+D to exit)'
+                       .format(problem, ister_log))
+            alert = Alert(title, message, labels=[u'View log',
+                                                  u'Shell',
+                                                  u'Reboot',
+                                                  u'Shut down'])
+            alert.do_alert()
+            if alert.response == 'View log':
+                LogViewStep(ister_log).handler(self.installation_d)
+            elif alert.response == 'Shell':
+                ShellStep().handler(self.installation_d)
+            else:
+                end_action = alert.response
+        message = ('Unsuccessful installation, system will {0}'
+                   .format(end_action.lower()))
+        reboot = True if end_action == 'Reboot' else False
+        self._exit(1, message=message, title=title, reboot=reboot)
 
 
 def handle_options():
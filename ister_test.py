@@ -45,13 +45,21 @@
 
 
 import functools
+import http.client
+import io
 import json
+import logging
 import os
+import select
 import shutil
 import socket
 import stat
+import struct
+import subprocess
 import sys
 import tempfile
+import threading
+import time
 import urllib.request as request
 import pycurl
 import netifaces
@@ -67,6 +75,8 @@ except:
 
 import ister
 import ister_gui
+import ister_cloud_init_svc
+import create_pxe
 
 COMMAND_RESULTS = []
 
@@ -223,6 +233,36 @@ def run_command_wrapper(func):
     return wrapper
 
 
+def mounted_wrapper(*paths):
+    """Wrapper for tests unmounting paths, they stay mounted until a umount
+    command in COMMAND_RESULTS unmounts them"""
+    def mounted_paths(func):
+        """mounted_paths wrapper"""
+        @functools.wraps(func)
+        def wrapper():
+            """mounted_wrapper"""
+            def mock_mounted_paths():
+                """mock_mounted_paths wrapper"""
+                mounted = set(paths)
+                for cmd in COMMAND_RESULTS:
+                    if not isinstance(cmd, str) or \
+                       not cmd.startswith("umount "):
+                        continue
+                    path = cmd.split()[-1]
+                    mounted = set(x for x in mounted if x != path and not (
+                        cmd.startswith("umount -R ") and
+                        x.startswith(path + "/")))
+                return mounted
+            backup_mounted_paths = ister.mounted_paths
+            ister.mounted_paths = mock_mounted_paths
+            try:
+                func()
+            finally:
+                ister.mounted_paths = backup_mounted_paths
+        return wrapper
+    return mounted_paths
+
+
 def makedirs_wrapper(test_type):
     """Wrapper for makedirs mocking"""
     def makedirs_type(func):
@@ -350,7 +390,7 @@ def urlopen_wrapper(test_type, read_str):
         @functools.wraps(func)
         def wrapper():
             """open_wrapper"""
-            backup_open = __builtins__.open
+            backup_open = request.urlopen
 
             class MockOpen():
                 """MockOpen wrapper class"""
@@ -370,14 +410,14 @@ def urlopen_wrapper(test_type, read_str):
                 def __enter__(self, *args):
                     return self
 
-            def mock_open_good(url):
+            def mock_open_good(url, timeout=None):
                 """mock_open_good wrapper"""
                 COMMAND_RESULTS.append(url)
                 return MockOpen()
 
-            def mock_open_bad(url):
+            def mock_open_bad(url, timeout=None):
                 """mock_open_bad wrapper"""
-                del url
+                del url, timeout
                 raise Exception("urlopen")
 
             if test_type == "good":
@@ -912,6 +952,263 @@ def get_part_devname_exception():
         raise Exception("Result was {}, expected None".format(res))
 
 
+class MockMainLoop(object):
+    """Record the alarms and file watches of an urwid main loop"""
+    def __init__(self):
+        self.alarms = []
+        self.watches = {}
+
+        self.pipes = {}
+
+    def set_alarm_in(self, sec, callback):
+        alarm = (sec, callback)
+        self.alarms.append(alarm)
+        return alarm
+
+    def remove_alarm(self, handle):
+        self.alarms.remove(handle)
+
+    def watch_file(self, fd, callback):
+        self.watches[fd] = callback
+        return fd
+
+    def remove_watch_file(self, handle):
+        del self.watches[handle]
+
+    def watch_pipe(self, callback):
+        pipe_rd, pipe_wr = os.pipe()
+        self.pipes[pipe_wr] = pipe_rd
+        self.watch_file(pipe_rd, lambda: callback(os.read(pipe_rd, 4096)))
+        return pipe_wr
+
+    def remove_watch_pipe(self, write_fd):
+        pipe_rd = self.pipes.pop(write_fd)
+        self.remove_watch_file(pipe_rd)
+        os.close(pipe_rd)
+
+    def run_watches(self, until=None):
+        """Call the callbacks of ready watches until none is left or until
+        returns True"""
+        while self.watches and not (until and until()):
+            ready, _, _ = select.select(list(self.watches), [], [], 10)
+            if not ready:
+                raise Exception("Timed out waiting for {}".format(until))
+            for fd in ready:
+                if fd in self.watches:
+                    self.watches[fd]()
+
+
+def command_progress_good():
+    """Show command output at the refresh rate, keeping the last lines"""
+    loop = MockMainLoop()
+    progress = ister_gui.CommandProgress("Test", ["seq", "1", "600"])
+    progress.start(loop)
+    loop.run_watches()
+    # Output only lands on the screen on a refresh, not on every read
+    if len(loop.alarms) != 1 or \
+       loop.alarms[0][0] != 1 / ister_gui.REDRAWS_PER_SECOND:
+        raise Exception("Unexpected refresh alarms {}".format(loop.alarms))
+    lines = [text.get_text()[0] for text in progress._output]
+    if len(lines) != ister_gui.OUTPUT_LINES or lines[-1] != "600":
+        raise Exception("Unexpected output {}".format(lines[-3:]))
+    if progress.returncode != 0 or \
+       progress._status.get_text()[0] != "Finished":
+        raise Exception("Command not finished")
+    try:
+        progress._on_click(None)
+        raise Exception("Ok did not leave the main loop")
+    except ister_gui.urwid.ExitMainLoop:
+        pass
+
+
+def command_progress_cancel_good():
+    """Cancel a running command"""
+    loop = MockMainLoop()
+    progress = ister_gui.CommandProgress("Test", ["sleep", "30"])
+    progress.start(loop)
+    progress._on_click(None)
+    loop.run_watches()
+    if not progress.cancelled or progress.returncode >= 0:
+        raise Exception("Command not terminated")
+    if progress._status.get_text()[0] != "Cancelled":
+        raise Exception("Cancel not shown")
+    if loop.alarms[-1][0] != 5:
+        raise Exception("Missing kill alarm")
+
+
+def progress_install(handler, lines, outcome, marker=None):
+    """Install stand in run by the install process of the progress tests"""
+    logger = logging.getLogger("ister-progress-test")
+    logger.propagate = False
+    logger.setLevel(logging.INFO)
+    logger.addHandler(handler)
+    ister.start_metrics({})
+    for i in range(lines):
+        logger.info("line %d", i)
+    ister.metrics_phase_done("partitions")
+    if outcome == "error":
+        raise Exception("install failed")
+    if outcome == "crash":
+        os._exit(3)
+    if outcome == "cancel":
+        try:
+            logger.info("waiting")
+            subprocess.call(["sleep", "30"])
+        finally:
+            with open(marker, "w") as marker_file:
+                marker_file.write("cleaned up")
+    if outcome == "cancel_cleanup":
+        ister.metrics_phase_done("filesystems", "cleanup")
+        logger.info("cleaning up")
+        # Cancelling now must neither kill nor interrupt the cleanup
+        ret = subprocess.call(["sleep", "2"])
+        with open(marker, "w") as marker_file:
+            marker_file.write("cleaned up {0}".format(ret))
+
+
+def install_progress_run(progress, loop, until=None):
+    """Run the progress screen on loop until the install process exits"""
+    loop.run_watches(until)
+    if until:
+        return 0
+    refreshes = 0
+    try:
+        while loop.alarms:
+            _, callback = loop.alarms.pop(0)
+            refreshes += 1
+            callback(loop, None)
+        raise Exception("Screen not closed")
+    except ister_gui.urwid.ExitMainLoop:
+        pass
+    return refreshes
+
+
+def install_progress_good():
+    """Batch install log lines into a few refreshes of the progress screen"""
+    loop = MockMainLoop()
+    progress = ister_gui.InstallProgress("Test")
+    progress.start(loop, progress_install, 2000, "error")
+    refreshes = install_progress_run(progress, loop)
+    if refreshes != 2:
+        raise Exception("Refreshed {} times".format(refreshes))
+    lines = [text.get_text()[0] for text in progress._output]
+    if len(lines) != ister_gui.OUTPUT_LINES or lines[-1] != "line 1999":
+        raise Exception("Unexpected output {}".format(lines[-3:]))
+    if progress._phase.get_text()[0] != "Installing: filesystems" or \
+       progress._bar.current != 100 / len(ister.INSTALL_PHASES):
+        raise Exception("Wrong phase shown")
+    if str(progress.error) != "install failed" or progress.cancelled:
+        raise Exception("Install error not kept")
+
+
+def install_progress_cancel():
+    """Cancel the install process, its cleanup still runs"""
+    loop = MockMainLoop()
+    progress = ister_gui.InstallProgress("Test")
+    with tempfile.TemporaryDirectory() as work_dir:
+        marker = os.path.join(work_dir, "cleanup")
+        start = time.monotonic()
+        progress.start(loop, progress_install, 10, "cancel", marker)
+        install_progress_run(progress, loop,
+                             lambda: "waiting" in progress._pending)
+        progress._cancel(None)
+        install_progress_run(progress, loop)
+        if not os.path.exists(marker):
+            raise Exception("Install not cleaned up")
+    if time.monotonic() - start > 20:
+        raise Exception("Running command not stopped")
+    if not progress.cancelled or progress.error:
+        raise Exception("Install not cancelled")
+    if any(alarm[0] == ister_gui.CANCEL_CLEANUP_SECONDS
+           for alarm in loop.alarms):
+        raise Exception("Kill alarm left behind")
+
+
+def install_progress_cancel_cleanup():
+    """Cancelling the install during its cleanup lets the cleanup finish"""
+    loop = MockMainLoop()
+    progress = ister_gui.InstallProgress("Test")
+    with tempfile.TemporaryDirectory() as work_dir:
+        marker = os.path.join(work_dir, "cleanup")
+        progress.start(loop, progress_install, 10, "cancel_cleanup", marker)
+        install_progress_run(progress, loop,
+                             lambda: "cleaning up" in progress._pending)
+        progress._cancel(None)
+        install_progress_run(progress, loop)
+        with open(marker) as marker_file:
+            if marker_file.read() != "cleaned up 0":
+                raise Exception("Cleanup interrupted")
+    if not progress.cancelled or progress.error:
+        raise Exception("Install not cancelled: {}".format(progress.error))
+
+
+def install_progress_crash():
+    """Report a crashed install process as an error"""
+    loop = MockMainLoop()
+    progress = ister_gui.InstallProgress("Test")
+    progress.start(loop, progress_install, 10, "crash")
+    install_progress_run(progress, loop)
+    if str(progress.error) != "The install process exited with code 3":
+        raise Exception("Unexpected error {}".format(progress.error))
+
+
+def disk_probe_good():
+    """Show disks as they are probed and pick up hotplugged ones"""
+    disks = ["sda", "sdb"]
+
+    def mock_get_disk_info(disk):
+        return {"partitions": [{"name": disk + "1", "size": "1G",
+                                "type": "Linux filesystem"}]}
+
+    def texts(step):
+        result = []
+        for widget in step._ui._form_body._body:
+            widget = getattr(widget, "original_widget", widget)
+            if isinstance(widget, ister_gui.urwid.Text):
+                result.append(widget.get_text()[0])
+        return result
+
+    get_list_of_disks_backup = ister_gui.get_list_of_disks
+    get_disk_info_backup = ister_gui.get_disk_info
+    udev_monitor_backup = ister_gui.UDEV_MONITOR
+    ister_gui.get_list_of_disks = lambda: list(disks)
+    ister_gui.get_disk_info = mock_get_disk_info
+    ister_gui.UDEV_MONITOR = ["echo", "UDEV  [12.50] add      "
+                              "/devices/pci0000:00/block/sdc (block)"]
+    loop = MockMainLoop()
+    step = ister_gui.SelectDeviceStep(1, 6)
+    try:
+        step.probe.reset()
+        step.build_ui_widgets()
+        step._ui = ister_gui.SimpleForm("Test", step._ui_widgets)
+        if "Looking for devices..." not in texts(step):
+            raise Exception("No placeholder before the first scan")
+        step.probe.start(loop)
+        loop.run_watches(lambda: step.probe.scanned and
+                         not step.probe._monitor and
+                         not step.probe._events and
+                         None not in step.probe.info.values())
+        if [alarm[0] for alarm in loop.alarms] != [ister_gui.RESCAN_SECONDS]:
+            raise Exception("No rescan without udev events")
+        disks.append("sdc")
+        _, callback = loop.alarms.pop()
+        callback(loop, None)
+        loop.run_watches(lambda: step.probe.info.get("sdc"))
+        step.probe.stop()
+    finally:
+        ister_gui.get_list_of_disks = get_list_of_disks_backup
+        ister_gui.get_disk_info = get_disk_info_backup
+        ister_gui.UDEV_MONITOR = udev_monitor_backup
+    shown = texts(step)
+    for disk in disks:
+        if "/dev/{}".format(disk) not in shown or \
+           not any(text.startswith("/dev/{}1 ".format(disk))
+                   for text in shown):
+            raise Exception("{} not shown in {}".format(disk, shown))
+    if loop.watches or loop.alarms:
+        raise Exception("Watches left after stop")
+
+
 @cryptsetup_wrapper
 @run_command_wrapper
 def create_filesystems_encrypted_good():
@@ -1482,6 +1779,76 @@ def setup_mounts_virtual_good():
     commands_compare_helper(commands)
 
 
+@run_command_wrapper
+def setup_mounts_tune_io_good():
+    """Setup virtual mount points with write optimized options"""
+
+    template = {"PartitionMountPoints": [{"mount": "/", "disk": "test",
+                                          "partition": 1},
+                                         {"mount": "/boot", "disk": "test",
+                                          "partition": 2}],
+                "FilesystemTypes": [{"disk": "test", "partition": 1,
+                                     "type": "ext4"},
+                                    {"disk": "test", "partition": 2,
+                                     "type": "vfat"}],
+                "dev": "/dev/loop0",
+                "Version": 10}
+    commands = ["sgdisk /dev/loop0 "
+                "--typecode=1:4f68bce3-e8cd-4db1-96e7-fbcaf984b709",
+                "mount -o noatime,commit=60 /dev/loop0p1 /not-writable/place/",
+                "sgdisk /dev/loop0 "
+                "--typecode=2:c12a7328-f81f-11d2-ba4b-00a0c93ec93b",
+                "mkdir -p /not-writable/place/boot",
+                "mount -o noatime /dev/loop0p2 /not-writable/place/boot"]
+    try:
+        ister.setup_mounts("/not-writable/place", template, True)
+    except Exception:
+        pass
+    commands_compare_helper(commands)
+
+
+@run_command_wrapper
+def tune_io_restore_good():
+    """Open and close the install I/O tuning window"""
+    template = {"PartitionMountPoints": [{"mount": "/", "disk": "test",
+                                          "partition": 1}],
+                "FilesystemTypes": [{"disk": "test", "partition": 1,
+                                     "type": "ext4"}],
+                "dev": "/dev/loop0"}
+    backup_settings = ister.INSTALL_VM_SETTINGS
+    backup_queues = ister.target_queues
+    with tempfile.TemporaryDirectory() as work_dir:
+        dirty = os.path.join(work_dir, "dirty_ratio")
+        with open(dirty, "w") as setting:
+            setting.write("20\n")
+        with open(os.path.join(work_dir, "read_ahead_kb"), "w") as setting:
+            setting.write("128\n")
+        with open(os.path.join(work_dir, "scheduler"), "w") as setting:
+            setting.write("[mq-deadline] none\n")
+        ister.INSTALL_VM_SETTINGS = {dirty: "40"}
+        ister.target_queues = lambda _: [work_dir]
+        try:
+            state = ister.tune_io(template, "/not-writable/place")
+            for name, value in [("dirty_ratio", "40"),
+                                ("read_ahead_kb", "4096"),
+                                ("scheduler", "none")]:
+                with open(os.path.join(work_dir, name)) as setting:
+                    if setting.read() != value:
+                        raise Exception("{} not tuned".format(name))
+            ister.restore_io(state)
+            for name, value in [("dirty_ratio", "20"),
+                                ("read_ahead_kb", "128"),
+                                ("scheduler", "mq-deadline")]:
+                with open(os.path.join(work_dir, name)) as setting:
+                    if setting.read() != value:
+                        raise Exception("{} not restored".format(name))
+        finally:
+            ister.INSTALL_VM_SETTINGS = backup_settings
+            ister.target_queues = backup_queues
+    commands_compare_helper(["mount -o remount,relatime,commit=5 "
+                             "/not-writable/place", False])
+
+
 @run_command_wrapper
 def setup_mounts_mmcblk_good():
     """Setup mount points for install"""
@@ -1524,7 +1891,7 @@ def add_bundles_good():
     COMMAND_RESULTS = []
     commands = ["/dne/usr/share/clear/bundles/",
                 0,
-                False,
+                True,
                 "/dne/usr/share/clear/bundles/a",
                 "w",
                 "close",
@@ -1809,7 +2176,7 @@ def copy_os_swupd_physical_good():
                 stat.S_IRWXU,
                 "//var/tmp",
                 0,
-                False,
+                True,
                 "//var/tmp",
                 stat.S_IRWXU,
                 "mount --bind //var/tmp /statetest",
@@ -1823,6 +2190,86 @@ def copy_os_swupd_physical_good():
     commands_compare_helper(commands)
 
 
+def update_progress_swupd_good():
+    """Parse swupd output into the install progress"""
+    state = ister.start_progress("swupd", packs=2)
+    try:
+        for line in ["Verifying version 800",
+                     "Downloading packs (104.85 Mb) for:",
+                     "Extracting os-core pack for version 800",
+                     "Extracting kernel-kvm pack for version 800",
+                     "Adding any missing files",
+                     "\t...45%"]:
+            ister.update_progress(state, line)
+            if line.startswith("Extracting os-core"):
+                summary = ister.progress_summary(state)
+                if (summary["stage"], summary["done"], summary["total"]) != \
+                   ("Extracting packs", 1, 2):
+                    raise Exception("Bad pack progress {}".format(summary))
+        summary = ister.progress_summary(state, state["stage_started"] + 45)
+        if summary["stage"] != "Installing files" or \
+           summary["percent"] != 45 or summary["eta"] != 55:
+            raise Exception("Bad file progress {}".format(summary))
+        if state["bytes_total"] != int(104.85 * 1024 ** 2):
+            raise Exception("Bad pack size {}".format(state["bytes_total"]))
+        ister.update_progress(state, "[3/6] Loading required manifests...")
+        if state["stage"] != "Loading required manifests":
+            raise Exception("Bad numbered stage {}".format(state["stage"]))
+    finally:
+        ister.finish_progress(True)
+    if ister.PROGRESS is not None:
+        raise Exception("Progress not finished")
+
+
+def update_progress_dnf_good():
+    """Parse dnf output into the install progress"""
+    state = ister.start_progress("dnf")
+    try:
+        for line in ["Total download size: 20 M",
+                     "(1/4): bash-4.4.19-1.x86_64.rpm  2.0 MB/s | 1.5 MB "
+                     "    00:00",
+                     "(2/4): glibc-2.27-1.x86_64.rpm   3.0 MB/s | 3.5 MB "
+                     "    00:01"]:
+            ister.update_progress(state, line)
+        if (state["stage"], state["done"], state["total"]) != \
+           ("Downloading packages", 2, 4) or \
+           state["bytes_done"] != 5 * 1024 ** 2:
+            raise Exception("Bad download progress {}".format(state))
+        ister.update_progress(state, "  Installing       : bash-4.4.19-1."
+                              "x86_64                   3/4 ")
+        summary = ister.progress_summary(state)
+        if (summary["stage"], summary["percent"]) != \
+           ("Installing packages", 75):
+            raise Exception("Bad install progress {}".format(summary))
+        if "Installing packages 75% (3/4 packages)" not in \
+           ister.format_progress(summary):
+            raise Exception("Bad progress text {}".format(
+                ister.format_progress(summary)))
+    finally:
+        ister.finish_progress(True)
+
+
+def report_progress_status_file_good():
+    """Write the install progress to the status file and listeners"""
+    summaries = []
+    ister.PROGRESS_LISTENERS.append(summaries.append)
+    try:
+        with tempfile.TemporaryDirectory() as work_dir:
+            path = os.path.join(work_dir, "status.json")
+            state = ister.start_progress("swupd", path, 1)
+            ister.update_progress(state, "Verifying version 800")
+            ister.finish_progress(False)
+            with open(path) as status:
+                summary = json.load(status)
+    finally:
+        ister.PROGRESS_LISTENERS.remove(summaries.append)
+    if summary["state"] != "failed" or summary["stage"] != "Verifying version":
+        raise Exception("Bad status file {}".format(summary))
+    if [x["stage"] for x in summaries] != ["Starting", "Verifying version",
+                                           "Verifying version"]:
+        raise Exception("Bad progress reports {}".format(summaries))
+
+
 @run_command_wrapper
 def copy_os_dnf_good():
     """Check installer command using dnf"""
@@ -2230,6 +2677,7 @@ def post_install_chroot_shell_good():
 
 @cryptsetup_wrapper
 @run_command_wrapper
+@mounted_wrapper("/not-writable/place")
 def cleanup_physical_encrypted_good():
     """Test cleanup of physical device"""
     backup_isdir = os.path.isdir
@@ -2257,7 +2705,7 @@ def cleanup_physical_encrypted_good():
     commands = ["/not-writable/place/var/tmp",
                 "umount /swupd/state",
                 "rm -fr /not-writable/place/var/tmp",
-                "umount -R /not-writable/place",
+                "umount /not-writable/place",
                 "rm -fr /not-writable/place",
                 "mapper_name",
                 'deactivating']
@@ -2267,6 +2715,7 @@ def cleanup_physical_encrypted_good():
 
 
 @run_command_wrapper
+@mounted_wrapper("/not-writable/place")
 def cleanup_physical_good():
     """Test cleanup of physical device"""
     backup_isdir = os.path.isdir
@@ -2297,6 +2746,7 @@ def cleanup_physical_good():
 
 
 @run_command_wrapper
+@mounted_wrapper("/not-writable/place")
 def cleanup_arg_target_dir_good():
     """Test cleanup of with target dir arg"""
     backup_isdir = os.path.isdir
@@ -2339,6 +2789,7 @@ def cleanup_arg_no_umount_good():
 
 
 @run_command_wrapper
+@mounted_wrapper("/not-writable/place")
 def cleanup_virtual_good():
     """Test cleanup of virtual device"""
     backup_isdir = os.path.isdir
@@ -2368,6 +2819,7 @@ def cleanup_virtual_good():
 
 
 @run_command_wrapper
+@mounted_wrapper("/not-writable/place")
 def cleanup_virtual_swap_good():
     """Test cleanup of virtual device"""
     backup_isdir = os.path.isdir
@@ -2399,6 +2851,142 @@ def cleanup_virtual_swap_good():
     commands_compare_helper(commands)
 
 
+def teardown_levels_good():
+    """Unmount leaves before the mount points holding them"""
+    tree = [{"mount": "/", "parent": None},
+            {"mount": "/boot", "parent": "/"},
+            {"mount": "/home", "parent": "/"},
+            {"mount": "/var", "parent": "/"},
+            {"mount": "/var/lib", "parent": "/var"}]
+    levels = ister.teardown_levels(tree)
+    if levels != [["/boot", "/home", "/var/lib"], ["/var"], ["/"]]:
+        raise Exception("Bad teardown levels {}".format(levels))
+
+
+def mount_tree_good():
+    """Find the mount point holding each template mount point"""
+    template = {"PartitionMountPoints": [{"mount": "/var/lib"},
+                                         {"mount": "/boot"},
+                                         {"mount": "/"},
+                                         {"mount": "/var"},
+                                         {"mount": "/variable"}]}
+    tree = ister.mount_tree(template)
+    if tree != [{"mount": "/", "parent": None},
+                {"mount": "/boot", "parent": "/"},
+                {"mount": "/var", "parent": "/"},
+                {"mount": "/var/lib", "parent": "/var"},
+                {"mount": "/variable", "parent": "/"}]:
+        raise Exception("Bad mount tree {}".format(tree))
+
+
+def cleanup_isdir_wrapper(func):
+    """Wrapper for cleanup tests without a /var/tmp in the target"""
+    @functools.wraps(func)
+    def wrapper():
+        """cleanup_isdir_wrapper"""
+        backup_isdir = os.path.isdir
+        os.path.isdir = lambda path: False
+        try:
+            func()
+        finally:
+            os.path.isdir = backup_isdir
+    return wrapper
+
+
+def cleanup_template():
+    """Return a template mounting /boot and /home in /"""
+    return {"FilesystemTypes": [],
+            "PartitionMountPoints": [{"disk": "sda", "partition": 3,
+                                      "mount": "/home"},
+                                     {"disk": "sda", "partition": 2,
+                                      "mount": "/"},
+                                     {"disk": "sda", "partition": 1,
+                                      "mount": "/boot"}]}
+
+
+def cleanup_args():
+    """Return the args of a cleanup not removing the target dir"""
+    def args():
+        """args empty object"""
+        pass
+    args.target_dir = "/not-writable/place"
+    args.no_unmount = False
+    return args
+
+
+@run_command_wrapper
+@mounted_wrapper("/not-writable/place", "/not-writable/place/boot",
+                 "/not-writable/place/home")
+@cleanup_isdir_wrapper
+def cleanup_mount_tree_good():
+    """Test cleanup unmounts the template mount tree in order"""
+    ister.cleanup(cleanup_args(), cleanup_template(), "/not-writable/place")
+    if sorted(COMMAND_RESULTS[:2]) != ["umount /not-writable/place/boot",
+                                       "umount /not-writable/place/home"] \
+       or COMMAND_RESULTS[2:] != ["umount /not-writable/place"]:
+        raise Exception("Bad unmount order {}".format(COMMAND_RESULTS))
+
+
+@run_command_wrapper
+@cleanup_isdir_wrapper
+def cleanup_mount_tree_left_good():
+    """Test cleanup skips what isn't mounted and unmounts what is left"""
+    def mock_run_command(cmd, **_):
+        """umount of a mount point holding another one fails"""
+        COMMAND_RESULTS.append(cmd)
+        if cmd.startswith("umount /"):
+            raise Exception("target is busy")
+        return [], [], 0
+
+    backup_run_command = ister.run_command
+    backup_mounted_paths = ister.mounted_paths
+    ister.run_command = mock_run_command
+    ister.mounted_paths = lambda: set(["/not-writable/place",
+                                       "/not-writable/place/home",
+                                       "/not-writable/place/home/bind"])
+    try:
+        ister.cleanup(cleanup_args(), cleanup_template(),
+                      "/not-writable/place")
+    finally:
+        ister.run_command = backup_run_command
+        ister.mounted_paths = backup_mounted_paths
+    # /boot isn't mounted, / is still tried after /home failed and the bind
+    # mount holding both is left to umount -R
+    commands_compare_helper(["umount /not-writable/place/home",
+                             "umount /not-writable/place",
+                             "umount -R /not-writable/place"])
+
+
+@cleanup_isdir_wrapper
+def cleanup_busy_mount_good():
+    """Test a busy mount point is kept and reported"""
+    def mock_run_command(cmd, **_):
+        """umount fails"""
+        COMMAND_RESULTS.append(cmd)
+        if cmd.startswith("umount"):
+            raise Exception("target is busy")
+        return [], [], 0
+
+    global COMMAND_RESULTS
+    COMMAND_RESULTS = []
+    backup_run_command = ister.run_command
+    backup_busy = ister.busy_processes
+    backup_mounted_paths = ister.mounted_paths
+    ister.run_command = mock_run_command
+    ister.busy_processes = lambda path: ["1 (bash) cwd: " + path]
+    ister.mounted_paths = lambda: set(["/not-writable/place"])
+    args = cleanup_args()
+    args.target_dir = None
+    try:
+        ister.cleanup(args, cleanup_template(), "/not-writable/place")
+    finally:
+        ister.run_command = backup_run_command
+        ister.busy_processes = backup_busy
+        ister.mounted_paths = backup_mounted_paths
+    commands_compare_helper(["umount /not-writable/place",
+                             "umount -R /not-writable/place"])
+
+
 def get_template_location_good():
     """Good get_template_location test"""
     template_file = ister.get_template_location("good-ister.conf")
@@ -3661,6 +4249,88 @@ def validate_softmgr_template_bad():
         raise Exception("Failed to detect bad software manager")
 
 
+def validate_template_bad_multiple_errors():
+    """Bad validate_template reports every error at once"""
+    template = json.loads(good_virtual_disk_template())
+    template["Version"] = -1
+    template["Hostname"] = "-bad"
+    template["SoftwareManager"] = "apt"
+    try:
+        ister.validate_template(template)
+    except Exception as exep:
+        msg = str(exep)
+    else:
+        raise Exception("Failed to detect invalid template")
+    for error in ["Invalid version number",
+                  "Hostname can only contain letters, digits and dashes",
+                  "Invalid package manager.  Use either swupd or dnf"]:
+        if error not in msg:
+            raise Exception("Missing '{0}' in '{1}'".format(error, msg))
+
+
+def check_disk_template_good_many_partitions():
+    """Good check_disk_template with hundreds of partitions"""
+    template = {"DestinationType": "physical",
+                "PartitionLayout": [{"disk": "sda", "partition": 1,
+                                     "size": "512M", "type": "EFI"}],
+                "FilesystemTypes": [{"disk": "sda", "partition": 1,
+                                     "type": "vfat"}],
+                "PartitionMountPoints": [{"disk": "sda", "partition": 1,
+                                          "mount": "/boot"}]}
+    for disk in ["sdb", "sdc", "sdd", "sde"]:
+        for part in range(1, 129):
+            size = "rest" if part == 128 else "1G"
+            template["PartitionLayout"].append({"disk": disk,
+                                                "partition": part,
+                                                "size": size,
+                                                "type": "linux"})
+            template["FilesystemTypes"].append({"disk": disk,
+                                                "partition": part,
+                                                "type": "ext4"})
+            template["PartitionMountPoints"].append(
+                {"disk": disk, "partition": part,
+                 "mount": "/" if disk == "sdb" and part == 1
+                          else "/srv/{0}{1}".format(disk, part)})
+    errors = ister.check_disk_template(template)
+    if errors:
+        raise Exception("Valid template failed to parse: {}".format(errors))
+
+
+def check_disk_template_bad_all_errors():
+    """Bad check_disk_template returns every error found"""
+    template = {"DestinationType": "physical",
+                "PartitionLayout": [{"disk": "sda", "partition": 1,
+                                     "size": "512M", "type": "EFI"},
+                                    {"disk": "sda", "partition": 2,
+                                     "size": "rest", "type": "linux"},
+                                    {"disk": "sda", "partition": 3,
+                                     "size": "0G", "type": "linux"}],
+                "FilesystemTypes": [{"disk": "sda", "partition": 1,
+                                     "type": "vfat"},
+                                    {"disk": "sda", "partition": 2,
+                                     "type": "ntfs"},
+                                    {"disk": "sdb", "partition": 1,
+                                     "type": "ext4"}],
+                "PartitionMountPoints": [{"disk": "sda", "partition": 2,
+                                          "mount": "/"},
+                                         {"disk": "sda", "partition": 3,
+                                          "mount": "/home"}]}
+    errors = ister.check_disk_template(template)
+    expected = ["Invalid size specified in section {0}"
+                .format(template["PartitionLayout"][2]),
+                "Partition other than last uses rest of disk sda partition 2",
+                "Invalid filesystem type ntfs, supported types are: "
+                "['ext2', 'ext3', 'ext4', 'vfat', 'btrfs', 'xfs', 'swap']",
+                "disk 'sdb' partition 1 used in FilesystemTypes not found in "
+                "PartitionLayout",
+                "disk sda partition 3 used in PartitionMountPoints not found "
+                "in FilesystemTypes",
+                "Missing boot mount"]
+    if errors != expected:
+        raise Exception("Unexpected errors:\n{0}\nexpected:\n{1}"
+                        .format(errors, expected))
+
+
 def parse_config_good():
     """Positive tests for configuration parsing"""
     # Using lots of statements for a single test is fine
@@ -3823,7 +4493,8 @@ def handle_options_good():
     sys.argv = ["ister.py", "-c", "cfg", "-t", "tpt", "-C", "/", "-V", "/",
                 "-f", "1", "-v", "-l", "log", "-L", "debug", "-S", "/",
                 "-s", "./cert", "-k", "/cmdline", "-d", "./dnf.conf",
-                "-D", "/tmp", "-m"]
+                "-D", "/tmp", "-m", "-R", "-X", "-T",
+                "--status-file", "status.json", "--metrics", "unix:/m"]
     try:
         args = ister.handle_options(sys.argv[1:])
     except Exception:
@@ -3858,6 +4529,16 @@ def handle_options_good():
         raise Exception("Failed to correctly set target directory")
     if args.no_unmount == False:
         raise Exception("Failed to correctly set no unmount")
+    if not args.resume:
+        raise Exception("Failed to correctly set resume")
+    if not args.converge:
+        raise Exception("Failed to correctly set converge")
+    if not args.tune_io:
+        raise Exception("Failed to correctly set tune io")
+    if args.status_file != "status.json":
+        raise Exception("Failed to correctly set status file")
+    if args.metrics != "unix:/m":
+        raise Exception("Failed to correctly set metrics")
 
     # Test long options next
     sys.argv = ["ister.py", "--config-file=cfg", "--template-file=tpt",
@@ -3937,6 +4618,103 @@ def handle_options_good():
         raise Exception("Incorrect default target directory set")
     if args.no_unmount == True:
         raise Exception("Incorrect default no unmount set")
+    if args.resume:
+        raise Exception("Incorrect default resume set")
+    if args.converge:
+        raise Exception("Incorrect default converge set")
+    if args.tune_io:
+        raise Exception("Incorrect default tune io set")
+    if args.status_file:
+        raise Exception("Incorrect default status file set")
+    if args.metrics:
+        raise Exception("Incorrect default metrics set")
+
+
+def lazy_imports_good():
+    """Check ister imports the optional dependencies only when used"""
+    code = ("import sys, ister; print(*[name for name in "
+            "['pycryptsetup', 'netifaces', 'urllib.request'] "
+            "if name in sys.modules])")
+    out = subprocess.check_output(
+        [sys.executable, "-c", code],
+        cwd=os.path.dirname(os.path.abspath(__file__)))
+    if out.decode("utf-8").strip():
+        raise Exception("Imported at start up: {}".format(out))
+
+
+def render_metrics_good():
+    """Render the install telemetry in Prometheus format"""
+    template = json.loads(good_virtual_disk_template())
+    template["dev"] = "/dev/loop0"
+    backup_io = ister.device_io_bytes
+    ister.device_io_bytes = lambda devices: {x: (1024, 4096) for x in devices}
+    try:
+        ister.start_metrics(template)
+        ister.metrics_phase_done("partitions")
+        text = ister.render_metrics()
+    finally:
+        ister.device_io_bytes = backup_io
+        ister.METRICS["template"] = None
+    for line in ['ister_phase{phase="filesystems"} 1',
+                 '# TYPE ister_commands_total counter',
+                 'ister_device_written_bytes_total{device="loop0"} 4096']:
+        if line not in text.splitlines():
+            raise Exception("Missing '{}' in metrics:\n{}".format(line, text))
+    if 'ister_phase_duration_seconds{phase="partitions"}' not in text:
+        raise Exception("Missing phase duration in metrics")
+    if ister.escape_label('C:\\a "b"\nc') != 'C:\\\\a \\"b\\"\\nc':
+        raise Exception("Label value not escaped")
+
+
+def render_metrics_download_good():
+    """Only render the download metrics of the tools reporting them"""
+    backup_report = ister.report_progress
+    ister.report_progress = lambda *_, **__: None
+    try:
+        ister.start_progress("swupd")
+        ister.update_progress(ister.PROGRESS,
+                              "Downloading packs (12.5 Mb) for:")
+        swupd_text = ister.render_metrics()
+        ister.start_progress("dnf")
+        ister.update_progress(ister.PROGRESS,
+                              "(1/2): a.rpm    | 2.0 MB     00:01    ")
+        dnf_text = ister.render_metrics()
+    finally:
+        ister.report_progress = backup_report
+        ister.PROGRESS = None
+    if "ister_download_bytes_total" in swupd_text or \
+       "ister_download_throughput_bytes" in swupd_text:
+        raise Exception("swupd downloads rendered:\n{}".format(swupd_text))
+    if "ister_download_bytes_total 2097152" not in dnf_text.splitlines():
+        raise Exception("dnf downloads not rendered:\n{}".format(dnf_text))
+
+
+def metrics_server_good():
+    """Serve metrics over TCP and over a Unix socket"""
+    with tempfile.TemporaryDirectory() as work_dir:
+        for address in ["127.0.0.1:0",
+                        "unix:" + os.path.join(work_dir, "metrics.sock")]:
+            server = ister.start_metrics_server(address)
+            try:
+                if address.startswith("unix:"):
+                    client = socket.socket(socket.AF_UNIX)
+                else:
+                    client = socket.socket()
+                client.connect(server.server_address)
+                client.sendall(b"GET /metrics HTTP/1.0\r\n\r\n")
+                response = b""
+                data = client.recv(4096)
+                while data:
+                    response += data
+                    data = client.recv(4096)
+                client.close()
+            finally:
+                ister.stop_metrics_server(server)
+            if not response.startswith(b"HTTP/1.0 200") or \
+               b"ister_commands_total" not in response:
+                raise Exception("Bad metrics response {}".format(response))
+        if os.listdir(work_dir):
+            raise Exception("Unix socket not removed")
 
 
 def handle_logging_good():
@@ -3983,6 +4761,291 @@ def handle_logging_good():
         ister.LOG = backup_log
 
 
+def resume_phase_good():
+    """Resume from the first phase whose inputs changed"""
+    template = json.loads(good_virtual_disk_template())
+    args = ister.handle_options([])
+    journal = {}
+    for phase in ["partitions", "filesystems", "copy_os", "users"]:
+        journal[phase] = ister.phase_inputs(args, template, phase)
+    template["Users"] = [{"username": "user"}]
+    if ister.resume_phase(args, template, journal) != "users":
+        raise Exception("Changed users phase not resumed")
+    if sorted(journal) != ["copy_os", "filesystems", "partitions"]:
+        raise Exception("Resumed phases left in journal {}".format(journal))
+    template["Version"] = 810
+    if ister.resume_phase(args, template, journal) != "copy_os":
+        raise Exception("Changed version did not reinstall the OS")
+    if ister.resume_phase(args, template, {}) != "partitions":
+        raise Exception("Empty journal did not start a full install")
+
+
+def install_journal_virtual_good():
+    """Record and read back the journal of a virtual install"""
+    template = json.loads(good_virtual_disk_template())
+    args = ister.handle_options([])
+    with tempfile.TemporaryDirectory() as work_dir:
+        image = os.path.join(work_dir, "gvdt")
+        template["PartitionLayout"][0]["disk"] = image
+        if ister.read_target_journal(template) != {}:
+            raise Exception("Journal found without an image")
+        journal = {}
+        ister.record_phase(args, template, journal, "partitions", None)
+        ister.record_phase(args, template, journal, "filesystems", None)
+        if not os.path.isfile(image + ".ister-journal"):
+            raise Exception("Journal side file not written")
+        open(image, "w").close()
+        if ister.read_target_journal(template) != journal:
+            raise Exception("Journal not read back")
+        if ister.resume_phase(args, template, journal) != "copy_os":
+            raise Exception("Completed phases not skipped")
+        with open(image + ".ister-journal", "w") as journal_file:
+            journal_file.write("{")
+        if ister.read_target_journal(template) != {}:
+            raise Exception("Corrupt journal not ignored")
+
+
+def check_filesystems_bad():
+    """Refuse to resume when a partition lost its file system"""
+    template = json.loads(good_virtual_disk_template())
+    template["dev"] = "/dev/loop0"
+    backup_run_command = ister.run_command
+    ister.run_command = lambda *_, **__: (["ext2"], [], 0)
+    try:
+        ister.check_filesystems(template)
+    except Exception:
+        return
+    finally:
+        ister.run_command = backup_run_command
+    raise Exception("Changed file system not detected")
+
+
+def install_os_resume_layout_bad():
+    """Refuse to resume on disks whose partitions no longer match"""
+    template = json.loads(good_virtual_disk_template())
+    args = ister.handle_options(["--resume"])
+    journal = {"partitions": ister.phase_inputs(args, template,
+                                                "partitions")}
+    calls = []
+
+    def bad_layout(template):
+        """check_layout mock"""
+        raise Exception("layout changed")
+
+    mocks = {"read_target_journal": lambda template: dict(journal),
+             "pre_install_shell": lambda template: None,
+             "map_loop_device": lambda template: template.update(
+                 dev="/dev/loop0"),
+             "check_layout": bad_layout,
+             "create_virtual_disk": lambda template: calls.append("disk"),
+             "create_partitions": lambda template: calls.append("parts"),
+             "create_filesystems": lambda template: calls.append("fs"),
+             "cleanup": lambda *_: None}
+    backup = {name: getattr(ister, name) for name in mocks}
+    for name, mock in mocks.items():
+        setattr(ister, name, mock)
+    try:
+        ister.install_os(args, template)
+    except Exception as exep:
+        if str(exep) != "layout changed" or calls:
+            raise Exception("Resumed on a changed layout: {} {}"
+                            .format(exep, calls))
+        return
+    finally:
+        for name, func in backup.items():
+            setattr(ister, name, func)
+        ister.METRICS.update({"phase": "starting", "template": None})
+    raise Exception("Changed layout not detected")
+
+
+def install_os_resume_post_install_good():
+    """Journal post install so a completed install isn't run again"""
+    template = json.loads(good_virtual_disk_template())
+    args = ister.handle_options(["--resume"])
+    calls = []
+
+    def fail_applied(*_):
+        """write_applied mock failing after the post install"""
+        raise Exception("disk full")
+
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as work_dir:
+        # The journal of the gvdt image is written next to it
+        os.chdir(work_dir)
+        os.makedirs(work_dir + "/target/usr/lib")
+        open(work_dir + "/target/usr/lib/os-release", "w").close()
+        journal = {x[0]: ister.phase_inputs(args, template, x[0])
+                   for x in ister.INSTALL_PHASES[:-1]}
+        mocks = {"read_target_journal": lambda template: dict(journal),
+                 "pre_install_shell": lambda template: None,
+                 "map_loop_device": lambda template: template.update(
+                     dev="/dev/loop0"),
+                 "check_layout": lambda template: None,
+                 "check_filesystems": lambda template: None,
+                 "open_filesystems": lambda template: None,
+                 "create_target_dir": lambda *_: work_dir + "/target",
+                 "setup_mounts": lambda *_: None,
+                 "post_install_nonchroot": lambda *_: calls.append("post"),
+                 "write_applied": fail_applied,
+                 "cleanup": lambda *_: None}
+        backup = {name: getattr(ister, name) for name in mocks}
+        for name, mock in mocks.items():
+            setattr(ister, name, mock)
+        try:
+            try:
+                ister.install_os(args, template)
+            except Exception as exep:
+                if str(exep) != "disk full" or calls != ["post"]:
+                    raise Exception("Bad post install run: {} {}"
+                                    .format(exep, calls))
+            journal = ister.load_journal(work_dir + "/gvdt.ister-journal")
+            if "post_install" not in journal:
+                raise Exception("Post install not journaled")
+            ister.write_applied = lambda *_: calls.append("applied")
+            ister.install_os(args, template)
+            if calls != ["post", "applied"]:
+                raise Exception("Completed install run again: {}"
+                                .format(calls))
+            if os.path.exists(work_dir + "/gvdt.ister-journal"):
+                raise Exception("Journal left after the install")
+        finally:
+            os.chdir(cwd)
+            for name, func in backup.items():
+                setattr(ister, name, func)
+            ister.METRICS.update({"phase": "starting", "template": None})
+
+
+def check_layout_good():
+    """Accept partitions matching the template layout"""
+    template = json.loads(good_virtual_disk_template())
+    template["dev"] = "/dev/loop0"
+    sizes = {"/dev/loop0p1": "535822336", "/dev/loop0p2": "536870912",
+             "/dev/loop0p3": "1048576"}
+    backup_run_command = ister.run_command
+    ister.run_command = lambda cmd, **_: ([sizes[cmd.split()[-1]]], [], 0)
+    try:
+        ister.check_layout(template)
+    finally:
+        ister.run_command = backup_run_command
+
+
+def check_layout_bad():
+    """Reject partitions with the wrong size or missing"""
+    template = json.loads(good_virtual_disk_template())
+    template["dev"] = "/dev/loop0"
+    sizes = {"/dev/loop0p1": "1073741824", "/dev/loop0p2": "536870912"}
+    backup_run_command = ister.run_command
+
+    def mock_run_command(cmd, **_):
+        """blockdev mock"""
+        if cmd.split()[-1] not in sizes:
+            return [], [], 1
+        return [sizes[cmd.split()[-1]]], [], 0
+    ister.run_command = mock_run_command
+    try:
+        ister.check_layout(template)
+    except Exception as exep:
+        if "loop0p1 is 1024MiB" not in str(exep) or \
+           "loop0p3 doesn't exist" not in str(exep):
+            raise Exception("Bad layout errors: {}".format(exep))
+        return
+    finally:
+        ister.run_command = backup_run_command
+    raise Exception("Mismatched layout accepted")
+
+
+@run_command_wrapper
+def converge_os_swupd_good():
+    """Only run swupd for what differs on the target"""
+    template = json.loads(good_virtual_disk_template())
+    template["Bundles"] = ["os-core", "editors"]
+    args = ister.handle_options([])
+    backup_which = shutil.which
+    shutil.which = lambda x: False
+    try:
+        with tempfile.TemporaryDirectory() as target_dir:
+            os.makedirs(target_dir + "/usr/lib")
+            os.makedirs(target_dir + "/usr/share/clear/bundles")
+            open(target_dir + "/usr/share/clear/bundles/os-core", "w").close()
+            with open(target_dir + "/usr/lib/os-release", "w") as rel_file:
+                rel_file.write('NAME="Clear Linux OS"\nVERSION_ID=800\n')
+            verify = "swupd verify --fix --path={0} --manifest=800 " \
+                     "--statedir=/var/lib/swupd".format(target_dir)
+            ister.converge_os_swupd(args, template, target_dir)
+            commands_compare_helper([verify, True, True])
+            if not os.path.exists(target_dir +
+                                  "/usr/share/clear/bundles/editors"):
+                raise Exception("Missing bundle not subscribed")
+
+            global COMMAND_RESULTS
+            COMMAND_RESULTS = []
+            ister.converge_os_swupd(args, template, target_dir)
+            commands_compare_helper([])
+
+            template["Version"] = 810
+            update = "swupd update --path={0} --manifest=810 " \
+                     "--statedir=/var/lib/swupd".format(target_dir)
+            ister.converge_os_swupd(args, template, target_dir)
+            commands_compare_helper([update, True, True])
+    finally:
+        shutil.which = backup_which
+
+
+def converge_configuration_good():
+    """Only rewrite configuration files that differ"""
+    template = {"Hostname": "clr", "MirrorURL": "https://new.mirror"}
+    with tempfile.TemporaryDirectory() as target_dir:
+        os.makedirs(target_dir + "/etc/swupd")
+        with open(target_dir + "/etc/hostname", "w") as conf_file:
+            conf_file.write("clr")
+        with open(target_dir + "/etc/swupd/mirror_contenturl", "w") as conf:
+            conf.write("https://old.mirror")
+        changed = ister.converge_configuration(template, target_dir)
+        if changed != ["set_mirror_url"]:
+            raise Exception("Unexpected changes {}".format(changed))
+        with open(target_dir + "/etc/swupd/mirror_contenturl") as conf:
+            if conf.read() != "https://new.mirror":
+                raise Exception("Mirror url not updated")
+        if ister.converge_configuration(template, target_dir):
+            raise Exception("Unchanged configuration rewritten")
+
+
+def converge_users_good():
+    """Only add users missing from the target"""
+    calls = []
+    backups = {}
+    for func in ["add_users", "create_account", "add_user_key", "setup_sudo",
+                 "disable_root_login", "add_user_fullname"]:
+        backups[func] = getattr(ister, func)
+        setattr(ister, func, lambda *a, f=func: calls.append((f, a[0])))
+    changed = {"username": "changed", "password": "$6$new"}
+    template = {"Users": [{"username": "old", "uid": 1000, "sudo": True,
+                           "fullname": "Old User"},
+                          {"username": "same", "password": "$6$same"},
+                          changed,
+                          {"username": "new"}]}
+    try:
+        with tempfile.TemporaryDirectory() as target_dir:
+            os.makedirs(target_dir + "/etc")
+            with open(target_dir + "/etc/passwd", "w") as passwd:
+                passwd.write("old:x:1000:1000:Old User:/home/old:/bin/bash\n"
+                             "same:x:1001:1001::/home/same:/bin/bash\n"
+                             "changed:x:1002:1002::/home/changed:/bin/bash\n")
+            with open(target_dir + "/etc/shadow", "w") as shadow:
+                shadow.write("old:!:17000::::::\n"
+                             "same:$6$same:17000::::::\n"
+                             "changed:$6$old:17000::::::\n")
+            with open(target_dir + "/etc/group", "w") as group:
+                group.write("wheel:x:10:old\n")
+            ister.converge_users(template, target_dir)
+    finally:
+        for func, backup in backups.items():
+            setattr(ister, func, backup)
+    if calls != [("create_account", changed),
+                 ("add_users", {"Users": [{"username": "new"}]})]:
+        raise Exception("Unexpected user changes {}".format(calls))
+
+
 @run_command_wrapper
 def validate_network_good():
     """Test validate_network"""
@@ -4012,7 +5075,7 @@ def validate_network_bad():
     def mock_request_urlopen(_, **__):
         """mock urlopen with an error code"""
         del __
-        exep = ister.URLError("Could not reach host")
+        exep = request.URLError("Could not reach host")
         exep.code = 1
         raise exep
 
@@ -4030,6 +5093,85 @@ def validate_network_bad():
         raise Exception("Failed to fail getting bad url")
 
 
+def rate_limit_filter_good():
+    """Test console records are rate limited"""
+    limit = ister.RateLimitFilter(2)
+    records = []
+    for idx in range(5):
+        record = ister.logging.LogRecord("test", ister.logging.INFO, "", 0,
+                                         "line %d", (idx,), None)
+        record.created = 100.5
+        records.append(record)
+    passed = [limit.filter(x) for x in records]
+    if passed != [True, True, False, False, False]:
+        raise Exception("Bad rate limiting {}".format(passed))
+    error = ister.logging.LogRecord("test", ister.logging.ERROR, "", 0,
+                                    "failed", (), None)
+    error.created = 100.5
+    if not limit.filter(error):
+        raise Exception("Error record rate limited")
+    formatter = ister.RateLimitFormatter(limit)
+    records[0].created = 101.2
+    if not limit.filter(records[0]) or \
+       records[0].getMessage() != "line 0" or \
+       formatter.format(records[0]) != "(3 lines skipped) line 0" or \
+       formatter.format(records[0]) != "line 0":
+        raise Exception("Skipped lines not reported")
+    lines = ister.logging.LogRecord("test", ister.logging.INFO, "", 0,
+                                    "a\nb", (), None)
+    lines.created = 101.2
+    records[1].created = 101.2
+    if not limit.filter(lines) or limit.filter(records[1]):
+        raise Exception("Lines of a record not counted")
+    records[2].created = 102.1
+    if not limit.filter(records[2]) or \
+       formatter.format(records[2]) != "(1 lines skipped) line 2":
+        raise Exception("Skipped lines not reported")
+    batch = ister.logging.LogRecord("test", ister.logging.INFO, "", 0,
+                                    "a\nb\nc", (), None)
+    batch.created = 102.1
+    if not limit.filter(batch) or \
+       formatter.format(batch) != "a\n(2 lines skipped)" or \
+       batch.getMessage() != "a\nb\nc":
+        raise Exception("Record over the budget not truncated")
+    records[3].created = 102.1
+    if limit.filter(records[3]):
+        raise Exception("Truncated record lines not counted")
+
+
+def handle_logging_background_good():
+    """Test handle_logging with the background listener"""
+    class ListHandler(ister.logging.Handler):
+        """Collect formatted records"""
+        def __init__(self):
+            super(ListHandler, self).__init__()
+            self.lines = []
+
+        def emit(self, record):
+            self.lines.append(self.format(record))
+
+    backup_log = ister.LOG
+    backup_register = ister.atexit.register
+    listeners = []
+    ister.atexit.register = listeners.append
+    ister.LOG = ister.logging.getLogger("test-background")
+    ister.LOG.handlers = []
+    handler = ListHandler()
+    try:
+        ister.handle_logging("info", None, handler, background=True)
+        if not isinstance(ister.LOG.handlers[0], ister.BackgroundLogHandler):
+            raise Exception("Records not queued")
+        ister.LOG.debug("hidden %s", "debug")
+        ister.LOG.info("shown %s", "info")
+        listeners[0]()
+        if handler.lines != ["shown info"]:
+            raise Exception("Bad background output {}".format(handler.lines))
+    finally:
+        ister.LOG.handlers = []
+        ister.LOG = backup_log
+        ister.atexit.register = backup_register
+
+
 @urlopen_wrapper("good", "baz")
 @fdopen_wrapper("good", "")
 @open_wrapper("good", "bar isterconf=http://localhost/")
@@ -4234,6 +5376,34 @@ def get_iface_for_host_bad_hostname():
         raise Exception("Did not return None for bad hostname")
 
 
+def get_ifaces_for_host_multiple():
+    """ Every interface with a route to the icis service is found, the one
+    of the most specific route first
+    """
+    def mock_gethostbyname(host):
+        """ yield ip addr """
+        return "192.168.1.1"
+
+    def mock_run_command(cmd):
+        """ yield result of ip show route with two NICs """
+        return ["default via 10.0.0.1 dev eno1 proto dhcp metric 100",
+                "default via 192.168.1.254 dev eno2 proto dhcp metric 200",
+                "192.168.1.0/24 dev eno2 proto kernel scope link"], [], 0
+
+    gethostbyname_orig = socket.gethostbyname
+    run_command_orig = ister.run_command
+    socket.gethostbyname = mock_gethostbyname
+    ister.run_command = mock_run_command
+
+    ifaces = ister.get_ifaces_for_host("hostname")
+
+    socket.gethostbyname = gethostbyname_orig
+    ister.run_command = run_command_orig
+
+    if ifaces != ["eno2", "eno1"]:
+        raise Exception("Wrong interfaces {0}".format(ifaces))
+
+
 def get_mac_for_iface_good():
     """ Obtain mac address of valid network interface
     """
@@ -4308,9 +5478,9 @@ def get_cloud_init_configs_good():
         """ stub """
         return "host"
 
-    def mock_get_iface_for_host(host):
+    def mock_get_ifaces_for_host(host):
         """ stub """
-        return "iface"
+        return ["iface"]
 
     def mock_get_mac_for_iface(iface):
         """ stub """
@@ -4321,19 +5491,23 @@ def get_cloud_init_configs_good():
         return "good_configs"
 
     get_host_from_url_orig = ister.get_host_from_url
-    get_iface_for_host_orig = ister.get_iface_for_host
+    get_ifaces_for_host_orig = ister.get_ifaces_for_host
     get_mac_for_iface_orig = ister.get_mac_for_iface
     fetch_cloud_init_configs_orig = ister.fetch_cloud_init_configs
 
     ister.get_host_from_url = mock_get_host_from_url
-    ister.get_iface_for_host = mock_get_iface_for_host
+    ister.get_ifaces_for_host = mock_get_ifaces_for_host
     ister.get_mac_for_iface = mock_get_mac_for_iface
     ister.fetch_cloud_init_configs = mock_fetch_cloud_init_configs
+    cache_dir_orig = ister.CLOUD_INIT_CACHE_DIR
+    ister.CLOUD_INIT_CACHE_DIR = tempfile.mkdtemp()
 
     confs = ister.get_cloud_init_configs("source")
 
+    shutil.rmtree(ister.CLOUD_INIT_CACHE_DIR)
+    ister.CLOUD_INIT_CACHE_DIR = cache_dir_orig
     ister.get_host_from_url = get_host_from_url_orig
-    ister.get_iface_for_host = get_iface_for_host_orig
+    ister.get_ifaces_for_host = get_ifaces_for_host_orig
     ister.get_mac_for_iface = get_mac_for_iface_orig
     ister.fetch_cloud_init_configs = fetch_cloud_init_configs_orig
 
@@ -4341,6 +5515,104 @@ def get_cloud_init_configs_good():
         raise Exception("Failed to get good configs")
 
 
+def get_cloud_init_configs_all_ifaces():
+    """ Every interface is queried at once, the first answer with configs
+    is used without waiting on the others and cached for the boot
+    """
+    release = threading.Event()
+    hang = []
+    queried = []
+
+    def mock_get_mac_for_iface(iface):
+        """ MAC of every interface """
+        return {"eno1": "m1", "eno2": "m2", "eno3": "m2"}[iface]
+
+    def mock_fetch_cloud_init_configs(icis_source, mac):
+        """ Only m3 is known to the service, m2 can hang until released """
+        queried.append(mac)
+        if mac == "m2" and hang:
+            release.wait(10)
+        return {"role": "compute"} if mac == "m3" else {}
+
+    get_host_from_url_orig = ister.get_host_from_url
+    get_ifaces_for_host_orig = ister.get_ifaces_for_host
+    get_mac_for_iface_orig = ister.get_mac_for_iface
+    fetch_cloud_init_configs_orig = ister.fetch_cloud_init_configs
+    cache_dir_orig = ister.CLOUD_INIT_CACHE_DIR
+
+    ister.get_host_from_url = lambda icis_source: "host"
+    ister.get_ifaces_for_host = lambda host: ["eno1", "eno2", "eno3"]
+    ister.get_mac_for_iface = mock_get_mac_for_iface
+    ister.fetch_cloud_init_configs = mock_fetch_cloud_init_configs
+    ister.CLOUD_INIT_CACHE_DIR = tempfile.mkdtemp()
+    try:
+        confs = ister.get_cloud_init_configs("source")
+        if confs != {} or sorted(queried) != ["m1", "m2"]:
+            raise Exception("Unknown MACs gave {0} after querying {1}"
+                            .format(confs, queried))
+        if os.listdir(ister.CLOUD_INIT_CACHE_DIR):
+            raise Exception("Cached configs without an answer")
+
+        queried[:] = []
+        hang.append(True)
+        ister.get_mac_for_iface = lambda iface: {"eno1": "m3"}.get(iface,
+                                                                   "m2")
+        confs = ister.get_cloud_init_configs("source")
+        if confs != {"role": "compute"}:
+            raise Exception("Did not use the first answer: {0}"
+                            .format(confs))
+
+        queried[:] = []
+        confs = ister.get_cloud_init_configs("source")
+        if confs != {"role": "compute"} or queried:
+            raise Exception("Cached configs not used: {0} {1}"
+                            .format(confs, queried))
+        for name in os.listdir(ister.CLOUD_INIT_CACHE_DIR):
+            mode = os.stat(os.path.join(ister.CLOUD_INIT_CACHE_DIR,
+                                        name)).st_mode
+            if stat.S_IMODE(mode) != 0o600:
+                raise Exception("Cache file {0} has mode {1:o}"
+                                .format(name, stat.S_IMODE(mode)))
+
+        os.environ[ister.CLOUD_INIT_NO_CACHE_ENV] = "1"
+        confs = ister.get_cloud_init_configs("source")
+        if confs != {"role": "compute"} or "m3" not in queried:
+            raise Exception("Cache not skipped: {0} {1}"
+                            .format(confs, queried))
+    finally:
+        os.environ.pop(ister.CLOUD_INIT_NO_CACHE_ENV, None)
+        release.set()
+        shutil.rmtree(ister.CLOUD_INIT_CACHE_DIR)
+        ister.CLOUD_INIT_CACHE_DIR = cache_dir_orig
+        ister.get_host_from_url = get_host_from_url_orig
+        ister.get_ifaces_for_host = get_ifaces_for_host_orig
+        ister.get_mac_for_iface = get_mac_for_iface_orig
+        ister.fetch_cloud_init_configs = fetch_cloud_init_configs_orig
+
+
+def query_cloud_init_configs_default_last():
+    """ The default configs are only used when no MAC is listed
+    """
+    def mock_fetch_cloud_init_configs(icis_source, mac):
+        """ m2 is listed but answers last """
+        if mac == "m2":
+            time.sleep(0.1)
+            return {"mac": "m2", "role": "storage"}
+        return {"mac": ister.CLOUD_INIT_DEFAULT_MAC, "role": "compute"}
+
+    fetch_cloud_init_configs_orig = ister.fetch_cloud_init_configs
+    ister.fetch_cloud_init_configs = mock_fetch_cloud_init_configs
+    try:
+        confs = ister.query_cloud_init_configs("source", ["m1", "m2"])
+        if confs.get("role") != "storage":
+            raise Exception("Used the default configs: {0}".format(confs))
+        confs = ister.query_cloud_init_configs("source", ["m1", "m3"])
+        if confs.get("role") != "compute":
+            raise Exception("Default configs not used: {0}".format(confs))
+    finally:
+        ister.fetch_cloud_init_configs = fetch_cloud_init_configs_orig
+
+
 def get_cloud_init_configs_bad_url_has_no_host():
     """ if get_host_from_url has problems, we should get None
     """
@@ -4348,9 +5620,9 @@ def get_cloud_init_configs_bad_url_has_no_host():
         """ failed to get host from url """
         return None
 
-    def mock_get_iface_for_host(host):
+    def mock_get_ifaces_for_host(host):
         """ stub """
-        return "iface"
+        return ["iface"]
 
     def mock_get_mac_for_iface(iface):
         """ stub """
@@ -4361,19 +5633,19 @@ def get_cloud_init_configs_bad_url_has_no_host():
         return "good_configs"
 
     get_host_from_url_orig = ister.get_host_from_url
-    get_iface_for_host_orig = ister.get_iface_for_host
+    get_ifaces_for_host_orig = ister.get_ifaces_for_host
     get_mac_for_iface_orig = ister.get_mac_for_iface
     fetch_cloud_init_configs_orig = ister.fetch_cloud_init_configs
 
     ister.get_host_from_url = mock_get_host_from_url
-    ister.get_iface_for_host = mock_get_iface_for_host
+    ister.get_ifaces_for_host = mock_get_ifaces_for_host
     ister.get_mac_for_iface = mock_get_mac_for_iface
     ister.fetch_cloud_init_configs = mock_fetch_cloud_init_configs
 
     confs = ister.get_cloud_init_configs("source")
 
     ister.get_host_from_url = get_host_from_url_orig
-    ister.get_iface_for_host = get_iface_for_host_orig
+    ister.get_ifaces_for_host = get_ifaces_for_host_orig
     ister.get_mac_for_iface = get_mac_for_iface_orig
     ister.fetch_cloud_init_configs = fetch_cloud_init_configs_orig
 
@@ -4382,15 +5654,15 @@ def get_cloud_init_configs_bad_url_has_no_host():
 
 
 def get_cloud_init_configs_bad_no_route_to_host():
-    """ If get_iface_for_host runs into trouble, we should get None
+    """ If get_ifaces_for_host runs into trouble, we should get None
     """
     def mock_get_host_from_url(icis_source):
         """ stub """
         return "host"
 
-    def mock_get_iface_for_host(host):
+    def mock_get_ifaces_for_host(host):
         """ failed to get a valid Interface """
-        return None
+        return []
 
     def mock_get_mac_for_iface(iface):
         """ stub """
@@ -4401,19 +5673,19 @@ def get_cloud_init_configs_bad_no_route_to_host():
         return "good_configs"
 
     get_host_from_url_orig = ister.get_host_from_url
-    get_iface_for_host_orig = ister.get_iface_for_host
+    get_ifaces_for_host_orig = ister.get_ifaces_for_host
     get_mac_for_iface_orig = ister.get_mac_for_iface
     fetch_cloud_init_configs_orig = ister.fetch_cloud_init_configs
 
     ister.get_host_from_url = mock_get_host_from_url
-    ister.get_iface_for_host = mock_get_iface_for_host
+    ister.get_ifaces_for_host = mock_get_ifaces_for_host
     ister.get_mac_for_iface = mock_get_mac_for_iface
     ister.fetch_cloud_init_configs = mock_fetch_cloud_init_configs
 
     confs = ister.get_cloud_init_configs("source")
 
     ister.get_host_from_url = get_host_from_url_orig
-    ister.get_iface_for_host = get_iface_for_host_orig
+    ister.get_ifaces_for_host = get_ifaces_for_host_orig
     ister.get_mac_for_iface = get_mac_for_iface_orig
     ister.fetch_cloud_init_configs = fetch_cloud_init_configs_orig
 
@@ -4428,9 +5700,9 @@ def get_cloud_init_configs_bad_iface():
         """ stub """
         return "host"
 
-    def mock_get_iface_for_host(host):
+    def mock_get_ifaces_for_host(host):
         """ stub """
-        return "iface"
+        return ["iface"]
 
     def mock_get_mac_for_iface(iface):
         """ Could not find mac addr of iface """
@@ -4441,19 +5713,19 @@ def get_cloud_init_configs_bad_iface():
         return "good_configs"
 
     get_host_from_url_orig = ister.get_host_from_url
-    get_iface_for_host_orig = ister.get_iface_for_host
+    get_ifaces_for_host_orig = ister.get_ifaces_for_host
     get_mac_for_iface_orig = ister.get_mac_for_iface
     fetch_cloud_init_configs_orig = ister.fetch_cloud_init_configs
 
     ister.get_host_from_url = mock_get_host_from_url
-    ister.get_iface_for_host = mock_get_iface_for_host
+    ister.get_ifaces_for_host = mock_get_ifaces_for_host
     ister.get_mac_for_iface = mock_get_mac_for_iface
     ister.fetch_cloud_init_configs = mock_fetch_cloud_init_configs
 
     confs = ister.get_cloud_init_configs("source")
 
     ister.get_host_from_url = get_host_from_url_orig
-    ister.get_iface_for_host = get_iface_for_host_orig
+    ister.get_ifaces_for_host = get_ifaces_for_host_orig
     ister.get_mac_for_iface = get_mac_for_iface_orig
     ister.fetch_cloud_init_configs = fetch_cloud_init_configs_orig
 
@@ -4468,9 +5740,9 @@ def get_cloud_init_configs_bad_no_configs_for_target():
         """ stub """
         return "host"
 
-    def mock_get_iface_for_host(host):
+    def mock_get_ifaces_for_host(host):
         """ stub """
-        return "iface"
+        return ["iface"]
 
     def mock_get_mac_for_iface(iface):
         """ stub """
@@ -4481,19 +5753,19 @@ def get_cloud_init_configs_bad_no_configs_for_target():
         return dict()
 
     get_host_from_url_orig = ister.get_host_from_url
-    get_iface_for_host_orig = ister.get_iface_for_host
+    get_ifaces_for_host_orig = ister.get_ifaces_for_host
     get_mac_for_iface_orig = ister.get_mac_for_iface
     fetch_cloud_init_configs_orig = ister.fetch_cloud_init_configs
 
     ister.get_host_from_url = mock_get_host_from_url
-    ister.get_iface_for_host = mock_get_iface_for_host
+    ister.get_ifaces_for_host = mock_get_ifaces_for_host
     ister.get_mac_for_iface = mock_get_mac_for_iface
     ister.fetch_cloud_init_configs = mock_fetch_cloud_init_configs
 
     confs = ister.get_cloud_init_configs("source")
 
     ister.get_host_from_url = get_host_from_url_orig
-    ister.get_iface_for_host = get_iface_for_host_orig
+    ister.get_ifaces_for_host = get_ifaces_for_host_orig
     ister.get_mac_for_iface = get_mac_for_iface_orig
     ister.fetch_cloud_init_configs = fetch_cloud_init_configs_orig
 
@@ -4620,6 +5892,171 @@ def modify_cloud_init_service_file_bad_open():
         raise Exception("Open did not throw exception")
 
 
+def ister_cloud_init_svc_good():
+    """ ister gets its configs and role from the reference service, answers
+    are revalidated with their ETag on a kept alive connection
+    """
+    work_dir = tempfile.mkdtemp()
+    os.makedirs(work_dir + "/roles")
+    os.makedirs(work_dir + "/target/etc")
+    with open(work_dir + "/configs.json", "w") as configs:
+        json.dump({"default": {"role": "compute"},
+                   "52-54-00-AB-CD-EF": {"role": "storage"}}, configs)
+    with open(work_dir + "/roles/compute", "w") as role:
+        role.write("#cloud-config compute\n")
+    with open(work_dir + "/roles/storage", "w") as role:
+        role.write("#cloud-config storage\n")
+
+    server = ister_cloud_init_svc.ConfigServer(
+        ("127.0.0.1", 0), ister_cloud_init_svc.load_index(
+            work_dir + "/configs.json", work_dir + "/roles"))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = "http://127.0.0.1:{0}/".format(server.server_address[1])
+    try:
+        confs = ister.fetch_cloud_init_configs(url, "52:54:00:ab:cd:ef")
+        if confs != {"mac": "52:54:00:ab:cd:ef", "role": "storage"}:
+            raise Exception("Wrong configs {0}".format(confs))
+        confs = ister.fetch_cloud_init_configs(url, "52:54:00:00:00:01")
+        if confs != {"mac": ister.CLOUD_INIT_DEFAULT_MAC, "role": "compute"}:
+            raise Exception("Wrong default configs {0}".format(confs))
+        confs = ister.query_cloud_init_configs(url, ["52:54:00:00:00:01",
+                                                     "52:54:00:ab:cd:ef"])
+        if confs.get("role") != "storage":
+            raise Exception("Used the default configs {0}".format(confs))
+        ister.fetch_cloud_init_role(url, "storage", work_dir + "/target")
+        with open(work_dir + "/target/etc/cloud-init-user-data") as role:
+            if role.read() != "#cloud-config storage\n":
+                raise Exception("Wrong role file")
+
+        conn = http.client.HTTPConnection("127.0.0.1",
+                                          server.server_address[1])
+        conn.request("GET", "/get_role/compute")
+        response = conn.getresponse()
+        response.read()
+        etag = response.getheader("ETag")
+        conn.request("GET", "/get_role/compute",
+                     headers={"If-None-Match": etag})
+        response = conn.getresponse()
+        if response.status != 304 or response.read():
+            raise Exception("Unchanged role sent again")
+        conn.request("GET", "/get_role/missing")
+        response = conn.getresponse()
+        response.read()
+        if response.status != 404:
+            raise Exception("Missing role answered {0}".format(
+                response.status))
+        conn.close()
+    finally:
+        server.shutdown()
+        server.server_close()
+        shutil.rmtree(work_dir)
+
+
+def create_pxe_partition_offset_good():
+    """Find the partitions of GPT and MBR images"""
+    with tempfile.TemporaryDirectory() as work_dir:
+        gpt = os.path.join(work_dir, "gpt.img")
+        header = bytearray(512)
+        header[:8] = b"EFI PART"
+        struct.pack_into("<QII", header, 72, 2, 128, 128)
+        entries = bytearray(128 * 128)
+        struct.pack_into("<Q", entries, 128 + 32, 4096)
+        with open(gpt, "wb") as image:
+            image.write(bytes(512) + header + entries)
+        mbr = os.path.join(work_dir, "mbr.img")
+        sector = bytearray(512)
+        struct.pack_into("<I", sector, 446 + 16 + 8, 2048)
+        sector[510:512] = b"\x55\xaa"
+        with open(mbr, "wb") as image:
+            image.write(bytes(sector))
+        if create_pxe.partition_offset(gpt, 2) != 4096 * 512:
+            raise Exception("Bad GPT partition offset")
+        if create_pxe.partition_offset(mbr, 2) != 2048 * 512:
+            raise Exception("Bad MBR partition offset")
+        for image, number in [(gpt, 1), (gpt, 129), (mbr, 1), (mbr, 5)]:
+            exception_flag = False
+            try:
+                create_pxe.partition_offset(image, number)
+            except Exception:
+                exception_flag = True
+            if not exception_flag:
+                raise Exception("Found missing partition {0} of {1}"
+                                .format(number, image))
+
+
+def read_newc(data):
+    """Return the (name, fields, contents) of the entries of a newc cpio
+    archive"""
+    entries = []
+    pos = 0
+    while pos < len(data):
+        if data[pos:pos + 6] != b"070701":
+            raise Exception("Bad newc magic at {0}".format(pos))
+        fields = [int(data[pos + 6 + idx * 8:pos + 14 + idx * 8], 16)
+                  for idx in range(13)]
+        pos += 110
+        name = data[pos:pos + fields[11] - 1].decode("utf-8")
+        pos += fields[11]
+        pos += -pos % 4
+        contents = data[pos:pos + fields[6]]
+        pos += fields[6]
+        pos += -pos % 4
+        entries.append((name, fields, contents))
+    return entries
+
+
+def create_pxe_write_cpio_good():
+    """Write the files, links and directories of a tree as newc cpio"""
+    with tempfile.TemporaryDirectory() as root:
+        os.makedirs(os.path.join(root, "etc"))
+        with open(os.path.join(root, "etc", "hostname"), "w") as out:
+            out.write("clr\n")
+        os.symlink("hostname", os.path.join(root, "etc", "name"))
+        os.makedirs(os.path.join(root, "var", "log"))
+        entries = create_pxe.walk_tree(root)
+        out = io.BytesIO()
+        create_pxe.write_cpio(out, root, entries)
+    if [x[0] for x in entries] != ["etc", "etc/hostname", "etc/name"]:
+        raise Exception("Bad tree {0}".format([x[0] for x in entries]))
+    archive = read_newc(out.getvalue())
+    expected = [("etc", b""), ("etc/hostname", b"clr\n"),
+                ("etc/name", b"hostname"), ("TRAILER!!!", b"")]
+    if [(x[0], x[2]) for x in archive] != expected:
+        raise Exception("Bad archive {0}".format(archive))
+    for (name, info), (_, fields, contents) in zip(entries, archive):
+        want = [0, info.st_mode, info.st_uid, info.st_gid, 1,
+                int(info.st_mtime), len(contents), 0, 0, 0, 0,
+                len(name) + 1, 0]
+        if fields != want:
+            raise Exception("Bad {0} header {1}, expected {2}".format(
+                name, fields, want))
+    if archive[-1][1] != [0, 0, 0, 0, 1] + [0] * 6 + [11, 0]:
+        raise Exception("Bad trailer {0}".format(archive[-1][1]))
+
+
+def create_pxe_build_initrd_good():
+    """Reuse the cached parts and only prune the parts of older builds"""
+    with tempfile.TemporaryDirectory() as work_dir:
+        root = os.path.join(work_dir, "root")
+        cache = os.path.join(work_dir, "cache")
+        os.makedirs(os.path.join(root, "usr", "bin"))
+        with open(os.path.join(root, "usr", "bin", "tool"), "w") as out:
+            out.write("tool")
+        os.makedirs(cache)
+        for name in ["keep.cpio", create_pxe.PART_PREFIX + "old.cpio"]:
+            open(os.path.join(cache, name), "w").close()
+        initrd = os.path.join(work_dir, "initrd")
+        built = create_pxe.build_initrd(root, initrd, cache, "gzip", 1, 2)
+        reused = create_pxe.build_initrd(root, initrd, cache, "gzip", 1, 2)
+        left = sorted(os.listdir(cache))
+    if built != (2, 0) or reused != (0, 2):
+        raise Exception("Bad parts built {0} and reused {1}"
+                        .format(built, reused))
+    if len(left) != 3 or "keep.cpio" not in left or \
+       create_pxe.PART_PREFIX + "old.cpio" in left:
+        raise Exception("Bad cache pruning {0}".format(left))
+
+
 def cloud_init_configs_good():
     """ Successfuly fetch/install/configure cloud init configs
     """
@@ -4660,6 +6097,27 @@ def cloud_init_configs_good():
     commands_compare_helper(commands)
 
 
+def cloud_init_configs_good_no_configs():
+    """ Do nothing if ister-cloud-init-svc can't be reached
+    """
+    global COMMAND_RESULTS
+    COMMAND_RESULTS = []
+
+    def mock_get_cloud_init_configs(source):
+        """ No host, route or MAC to query the service with """
+        COMMAND_RESULTS.append("get_cloud_init_configs")
+        return None
+
+    gcic_orig = ister.get_cloud_init_configs
+    ister.get_cloud_init_configs = mock_get_cloud_init_configs
+    try:
+        ister.cloud_init_configs({"IsterCloudInitSvc": "http://host/icis"},
+                                 "/path")
+    finally:
+        ister.get_cloud_init_configs = gcic_orig
+    commands_compare_helper(["get_cloud_init_configs"])
+
+
 def cloud_init_configs_good_no_role():
     """ Do nothing if we can't get identify a role for install target
     """
@@ -4764,11 +6222,8 @@ def gui_network_connection():
         raise Exception("pycurl.Curl options {} do not match "
                         "expected options {}".format(actual, expected))
 
-    commands = ['/usr/bin/systemctl',
-                'status',
-                'systemd-networkd',
-                'systemd-resolved']
-    commands_compare_helper(commands)
+    # building the screen does not wait for the network any more
+    commands_compare_helper([])
 
 
 def gui_network_connection_curl_exception():
@@ -4892,6 +6347,404 @@ def gui_network_connection_curl_exception_version_url():
                         "expected options {}".format(actual, expected))
 
 
+def gui_system_facts_cache():
+    """Gather each system fact once until it is invalidated"""
+    calls = []
+
+    def gatherer(name):
+        def gather():
+            calls.append(name)
+            return name.upper()
+        return gather
+
+    facts = ister_gui.SystemFacts({"dns": (gatherer("dns"), []),
+                                   "virt": (gatherer("virt"), "none")})
+    facts.start()
+    if facts.get("dns") != "DNS" or facts.get("virt") != "VIRT" or \
+       facts.get("dns") != "DNS":
+        raise Exception("Wrong facts returned")
+    facts.invalidate("dns")
+    if facts.get("dns") != "DNS":
+        raise Exception("Wrong fact after invalidate")
+    if sorted(calls) != ["dns", "dns", "virt"]:
+        raise Exception("Unexpected gatherer calls {}".format(calls))
+
+
+def gui_system_facts_fallback():
+    """Use the fallback of a fact whose gatherer fails"""
+    def mock_check_output(*_):
+        raise FileNotFoundError("localectl")
+
+    facts_backup = ister_gui.FACTS
+    check_output_backup = ister_gui.subprocess.check_output
+    ister_gui.FACTS = ister_gui.SystemFacts(
+        {"keymaps": (ister_gui.read_keyboards, ["us"])})
+    ister_gui.subprocess.check_output = mock_check_output
+    try:
+        keyboards = ister_gui.get_keyboards()
+    finally:
+        ister_gui.FACTS = facts_backup
+        ister_gui.subprocess.check_output = check_output_backup
+    if keyboards != ["us"]:
+        raise Exception("Fallback not used: {}".format(keyboards))
+
+
+def gui_read_swupd_mirror():
+    """Read both swupd urls from a single swupd mirror run"""
+    calls = []
+
+    def mock_check_output(cmd):
+        calls.append(cmd)
+        return b"Version URL:    https://version.example/update\n" \
+               b"Content URL:    https://content.example/update\n"
+
+    check_output_backup = ister_gui.subprocess.check_output
+    ister_gui.subprocess.check_output = mock_check_output
+    try:
+        urls = ister_gui.read_swupd_mirror()
+    finally:
+        ister_gui.subprocess.check_output = check_output_backup
+    if urls != {"Content URL": "https://content.example/update",
+                "Version URL": "https://version.example/update"}:
+        raise Exception("Unexpected urls {}".format(urls))
+    if calls != [["swupd", "mirror"]]:
+        raise Exception("Unexpected commands {}".format(calls))
+
+
+def gui_dns_servers():
+    """Read the DNS servers from the first existing resolv.conf"""
+    with tempfile.TemporaryDirectory() as work_dir:
+        resolv = os.path.join(work_dir, "resolv.conf")
+        with open(resolv, "w") as resolv_file:
+            resolv_file.write("# comment\nnameserver 10.0.0.1\n"
+                              "search example.com\nnameserver 10.0.0.2\n")
+        paths_backup = ister_gui.RESOLV_CONF_PATHS
+        ister_gui.RESOLV_CONF_PATHS = [os.path.join(work_dir, "missing"),
+                                       resolv]
+        try:
+            servers = ister_gui.dns_servers()
+            ister_gui.FACTS.invalidate('dns')
+            first = ister_gui.find_dns()
+        finally:
+            ister_gui.RESOLV_CONF_PATHS = paths_backup
+            ister_gui.FACTS.invalidate('dns')
+    if servers != ["10.0.0.1", "10.0.0.2"]:
+        raise Exception("Unexpected DNS servers {}".format(servers))
+    if first != "10.0.0.1":
+        raise Exception("Unexpected DNS server {}".format(first))
+
+
+def gui_network_service_ready():
+    """Return as soon as the network is usable, False after the timeout"""
+    checks = []
+
+    def mock_network_usable():
+        checks.append(1)
+        return len(checks) > 2
+
+    network_usable_backup = ister_gui.network_usable
+    default_route_backup = ister_gui.default_route
+    ister_gui.network_usable = mock_network_usable
+    ister_gui.default_route = lambda: True
+    try:
+        start = time.monotonic()
+        if not ister_gui.network_service_ready(5):
+            raise Exception("Usable network not detected")
+        if time.monotonic() - start > 2:
+            raise Exception("Network detected late")
+        ister_gui.network_usable = lambda: False
+        start = time.monotonic()
+        if ister_gui.network_service_ready(0.5):
+            raise Exception("Network detected without route and DNS")
+        if time.monotonic() - start < 0.5:
+            raise Exception("Returned before the timeout")
+    finally:
+        ister_gui.network_usable = network_usable_backup
+        ister_gui.default_route = default_route_backup
+
+
+def gui_restart_networkd_resolved():
+    """Wait for the restarted network services to be active again"""
+    calls = []
+    active = []
+
+    def mock_call(cmd):
+        calls.append(" ".join(cmd[1:]))
+        if "is-active" in cmd:
+            active.append(1)
+            return 0 if len(active) > 2 else 3
+        return 0
+
+    def mock_network_service_ready(timeout):
+        calls.append("ready")
+        return True
+
+    call_backup = ister_gui.subprocess.call
+    ready_backup = ister_gui.network_service_ready
+    timeout_backup = ister_gui.NETWORK_READY_TIMEOUT
+    ister_gui.subprocess.call = mock_call
+    ister_gui.network_service_ready = mock_network_service_ready
+    try:
+        ister_gui.restart_networkd_resolved()
+        is_active = "is-active --quiet systemd-networkd systemd-resolved"
+        if calls != ["restart systemd-networkd systemd-resolved",
+                     is_active, is_active, is_active, "ready"]:
+            raise Exception("Unexpected calls {}".format(calls))
+        ister_gui.NETWORK_READY_TIMEOUT = 0.2
+        ister_gui.subprocess.call = lambda cmd: 3
+        try:
+            ister_gui.restart_networkd_resolved()
+        except Exception:
+            return
+        raise Exception("Inactive network services not detected")
+    finally:
+        ister_gui.subprocess.call = call_backup
+        ister_gui.network_service_ready = ready_backup
+        ister_gui.NETWORK_READY_TIMEOUT = timeout_backup
+        ister_gui.FACTS.invalidate('dns')
+
+
+def gui_network_monitor():
+    """Report network state changes to the screen from the main loop"""
+    usable = []
+    changes = []
+
+    network_usable_backup = ister_gui.network_usable
+    default_route_backup = ister_gui.default_route
+    ister_gui.network_usable = lambda: bool(usable)
+    ister_gui.default_route = lambda: False
+    loop = MockMainLoop()
+    monitor = ister_gui.NetworkMonitor(lambda: changes.append(monitor.usable))
+    try:
+        monitor.start(loop)
+        if changes:
+            raise Exception("Change reported without a change")
+        usable.append(1)
+        if loop.watches:
+            # no netlink message is needed, any wake up checks the state
+            list(loop.watches.values())[0]()
+        else:
+            _, callback = loop.alarms.pop()
+            callback(loop, None)
+        monitor.stop()
+    finally:
+        ister_gui.network_usable = network_usable_backup
+        ister_gui.default_route = default_route_backup
+    if changes != [True]:
+        raise Exception("Unexpected changes {}".format(changes))
+    if loop.watches or loop.alarms:
+        raise Exception("Watches left after stop")
+
+    # Without on_change the state is only followed
+    ister_gui.network_usable = lambda: True
+    monitor = ister_gui.NetworkMonitor()
+    try:
+        monitor.start(loop)
+        monitor.stop()
+    finally:
+        ister_gui.network_usable = network_usable_backup
+    if not monitor.usable:
+        raise Exception("Network state not followed")
+
+
+def gui_lazy_list_walker():
+    """Build list rows only when shown and filter them incrementally"""
+    built = []
+
+    def make_row(item):
+        built.append(item)
+        return ister_gui.urwid.Text(item)
+
+    header = ister_gui.urwid.Text("header")
+    items = [header] + ["keymap-{0:03}".format(i) for i in range(300)]
+    walker = ister_gui.LazyListWalker(items, make_row)
+    listbox = ister_gui.urwid.ListBox(walker)
+    listbox.render((40, 10), focus=True)
+    if not built or len(built) > 10:
+        raise Exception("Built {} rows for 10 shown".format(len(built)))
+    for index in range(1, len(items)):
+        walker.row(index)
+    if len(walker._rows) != ister_gui.ROW_CACHE:
+        raise Exception("Row cache not bounded")
+    walker.set_focus(5)
+    walker.set_filter("keymap-1")
+    if len(walker) != 101 or walker[0] is not header:
+        raise Exception("Wrong rows shown for keymap-1")
+    walker.set_filter("keymap-12")
+    if [walker[i].get_text()[0] for i in range(1, len(walker))] != \
+       ["keymap-12{}".format(i) for i in range(10)]:
+        raise Exception("Incremental filter failed")
+    if walker.focus != 0:
+        raise Exception("Focus not reset when the row was filtered")
+    walker.set_focus(3)
+    walker.set_filter("KEYMAP-122")
+    if len(walker) != 2 or walker.focus != 1:
+        raise Exception("Focused row not kept by a narrower filter")
+    walker.set_filter("")
+    if len(walker) != len(items):
+        raise Exception("Filter not cleared")
+
+
+def gui_keyboard_search():
+    """Filter the keyboard list as the search is typed"""
+    get_keyboards_backup = ister_gui.get_keyboards
+    ister_gui.get_keyboards = lambda: ["us", "uk", "de", "de-latin1", "fr"]
+    try:
+        menu = ister_gui.KeyboardSelection()
+    finally:
+        ister_gui.get_keyboards = get_keyboards_backup
+    size = (40, 10)
+    for key in ["/", "d", "e", "-"]:
+        if menu._lb.keypress(size, key) is not None:
+            raise Exception("Search key {} not handled".format(key))
+    if len(menu._menu) != 1 or \
+       menu._lb.search_text.get_text()[0] != "Search: de-_":
+        raise Exception("List not filtered while typing")
+    menu._lb.keypress(size, "backspace")
+    menu._lb.keypress(size, "enter")
+    if len(menu._menu) != 2 or menu._lb.searching:
+        raise Exception("Filter not kept after enter")
+    # navigation keys work again with the filter kept
+    menu._lb.keypress(size, "j")
+    if menu._lb.focus_position != 1:
+        raise Exception("j did not move down the filtered list")
+    menu._lb.keypress(size, "esc")
+    if len(menu._menu) != 5 or menu._action:
+        raise Exception("esc did not clear the filter first")
+    try:
+        menu._lb.keypress(size, "esc")
+        raise Exception("esc without a filter did not leave the screen")
+    except ister_gui.urwid.ExitMainLoop:
+        pass
+
+
+def gui_bundle_selector_state():
+    """Keep the bundle choices made in rows rebuilt while scrolling"""
+    step = ister_gui.BundleSelectorStep(1, 2)
+    config = {"Bundles": ["editors"]}
+    step.required_bundles = []
+    step.build_ui_widgets(config)
+    walker = step._ui_widgets
+    positions = [i for i in walker.positions()
+                 if not isinstance(walker.items[i], ister_gui.urwid.Widget)]
+    check = walker[positions[0]].contents[0][0]
+    check.set_state(False)
+    check = walker[positions[1]].contents[0][0]
+    check.set_state(True)
+    walker._rows.clear()
+    if walker[positions[1]].contents[0][0].get_state() is not True:
+        raise Exception("Bundle state lost when the row was rebuilt")
+    if list(step._selected.items())[:2] != \
+       [("editors", False), ("user-basic", True)]:
+        raise Exception("Unexpected selection {}".format(step._selected))
+
+
+def gui_mount_points_update():
+    """Rebuild only the row of the partition whose mount point changed"""
+    step = ister_gui.MountPointsStep(1, 2)
+    step.choices = [step.display_fmt.format("sda{}".format(number), "1G",
+                                            "Linux filesystem", "", "")
+                    for number in range(1, 65)]
+    step.build_ui_widgets()
+    step.build_ui()
+    form = step._ui
+    walker = step._ui_widgets
+    form._ui.render((136, 42), focus=True)
+    before = [walker[position] for position in range(2, 12)]
+    point = step.display_fmt.format("sda3", "1G", "Linux filesystem", "/",
+                                    "Yes")
+    step._set_choice(2, point)
+    after = [walker[position] for position in range(2, 12)]
+    changed = [position for position, (old, new)
+               in enumerate(zip(before, after)) if old is not new]
+    if changed != [2]:
+        raise Exception("Rows {} rebuilt".format(changed))
+    if step.choices[2] != point or walker.items[4] != point:
+        raise Exception("Mount point not set")
+    step.update_ui(None)
+    if step._ui is not form or step._ui_widgets is not walker:
+        raise Exception("Form not kept when shown again")
+
+
+def gui_lazy_steps():
+    """Build the installer steps when shown, prefetch what they need"""
+    started = []
+
+    class MockFacts():
+        """Record the facts started"""
+        @staticmethod
+        def start(names=None):
+            started.extend(names)
+
+        @staticmethod
+        def get(name):
+            return {"keymaps": ["us", "de"]}[name]
+
+    facts_backup = ister_gui.FACTS
+    ister_gui.FACTS = MockFacts()
+    try:
+        ins = ister_gui.Installation.__new__(ister_gui.Installation)
+        ins.args = {"contenturl": None, "versionurl": None}
+        ins.start = ister_gui.SplashScreen()
+        ins._init_actions()
+        ister_gui.prefetch_steps(ins.start)
+        keyboard = ins.start.get_next_step("Next")
+        if not isinstance(keyboard, ister_gui.LazyStep) or keyboard.step:
+            raise Exception("Keyboard step built before it is shown")
+        if sorted(started) != ["dns", "keymaps", "swupd_mirror"]:
+            raise Exception("Unexpected facts prefetched {}".format(started))
+        step = keyboard.build()
+        if not isinstance(step, ister_gui.KeyboardSelection) or \
+           keyboard.build() is not step:
+            raise Exception("Keyboard step not built once")
+        if step.get_next_step("Previous") is not ins.start or \
+           step.get_next_step("Next") is not keyboard.action_map["Next"]:
+            raise Exception("Actions not passed to the built step")
+        if step.get_next_step("Next").step:
+            raise Exception("Next step built before it is shown")
+    finally:
+        ister_gui.FACTS = facts_backup
+
+
+def gui_connection_check_cache():
+    """Run connectivity checks once per key and TTL, in the background"""
+    calls = []
+    results = []
+    release = threading.Event()
+
+    def check(proxy, content_url, version_url):
+        calls.append((proxy, content_url, version_url))
+        release.wait(10)
+        return content_url == "good"
+
+    loop = MockMainLoop()
+    conn = ister_gui.ConnectionCheck(check, lambda: results.append(1))
+    conn.start(loop)
+    try:
+        key = (None, "good", "version")
+        if conn.result(key) is not None or conn.result(key) is not None:
+            raise Exception("Result before the check finished")
+        release.set()
+        loop.run_watches(lambda: len(results) > 1)
+        if conn.result(key) is not True or \
+           conn.result((None, "bad", "version")) is not None:
+            raise Exception("Cached result not used")
+        loop.run_watches(lambda: len(results) > 2)
+        if conn.result((None, "bad", "version")) is not False:
+            raise Exception("Second key not checked")
+        conn.invalidate()
+        if conn.result(key) is not None:
+            raise Exception("Result kept after invalidate")
+        loop.run_watches(lambda: len(results) > 3)
+    finally:
+        conn.stop()
+    if calls != [(None, "good", "version"), (None, "bad", "version"),
+                 (None, "good", "version")]:
+        raise Exception("Unexpected checks {}".format(calls))
+    if loop.watches:
+        raise Exception("Pipe left after stop")
+
+
 @run_command_wrapper
 @open_wrapper("good", "")
 def gui_static_configuration():
@@ -4932,16 +6785,17 @@ def gui_static_configuration():
     makedirs_backup = os.makedirs
     sleep_backup = time.sleep
     service_ready_backup = ister_gui.network_service_ready
+    paths_backup = ister_gui.RESOLV_CONF_PATHS
 
     subprocess.call = mock_call
     os.makedirs = mock_makedirs
     time.sleep = mock_sleep
     ister_gui.network_service_ready = mock_service_ready
+    ister_gui.RESOLV_CONF_PATHS = []
+    ister_gui.FACTS.invalidate('dns')
 
     # we will be running the function twice, once without then once with DNS
-    commands = ['/etc/resolv.conf', 'r',
-                'readlines',
-                '/etc/systemd/network/10-en-static.network', 'w',
+    commands = ['/etc/systemd/network/10-en-static.network', 'w',
                 '[Match]\n',
                 'Name=enp0s1\n\n',
                 '[Network]\n',
@@ -4986,6 +6840,8 @@ def gui_static_configuration():
     os.makedirs = makedirs_backup
     time.sleep = sleep_backup
     ister_gui.network_service_ready = service_ready_backup
+    ister_gui.RESOLV_CONF_PATHS = paths_backup
+    ister_gui.FACTS.invalidate('dns')
 
 
 def gui_set_proxy():
@@ -5705,15 +7561,15 @@ def run_tests(tests):
 if __name__ == '__main__':
     class log_wrapper():
         """ Trivial dummy log object that suffices for most tests."""
-        def debug(self, _):
+        def debug(self, *_):
             """dummy debug"""
             pass
 
-        def info(self, _):
+        def info(self, *_):
             """dummy info"""
             pass
 
-        def error(self, _):
+        def error(self, *_):
             """dummy error"""
             pass
 
@@ -5740,6 +7596,13 @@ if __name__ == '__main__':
         get_part_devname_with_devname,
         get_part_devname_with_no_input,
         get_part_devname_exception,
+        command_progress_good,
+        command_progress_cancel_good,
+        install_progress_good,
+        install_progress_cancel,
+        install_progress_cancel_cleanup,
+        install_progress_crash,
+        disk_probe_good,
         create_filesystems_encrypted_good,
         create_filesystems_good,
         create_filesystems_virtual_good,
@@ -5755,6 +7618,8 @@ if __name__ == '__main__':
         setup_mounts_good_no_boot,
         setup_mounts_virtual_good,
         setup_mounts_mmcblk_good,
+        setup_mounts_tune_io_good,
+        tune_io_restore_good,
         setup_mounts_good_units,
         add_bundles_good,
         set_hostname_good,
@@ -5767,6 +7632,9 @@ if __name__ == '__main__':
         copy_os_swupd_which_good,
         copy_os_swupd_fast_install_good,
         copy_os_swupd_physical_good,
+        update_progress_swupd_good,
+        update_progress_dnf_good,
+        report_progress_status_file_good,
         copy_os_dnf_good,
         copy_os_dnf_config_good,
         copy_os_dnf_proxy_good,
@@ -5799,6 +7667,11 @@ if __name__ == '__main__':
         cleanup_arg_no_umount_good,
         cleanup_virtual_good,
         cleanup_virtual_swap_good,
+        teardown_levels_good,
+        mount_tree_good,
+        cleanup_mount_tree_good,
+        cleanup_mount_tree_left_good,
+        cleanup_busy_mount_good,
         get_template_location_good,
         get_template_location_bad_missing,
         get_template_location_fallback,
@@ -5886,12 +7759,31 @@ if __name__ == '__main__':
         validate_version_template_bad_version_num,
         validate_version_template_bad_version_str,
         validate_softmgr_template_bad,
+        validate_template_bad_multiple_errors,
+        check_disk_template_good_many_partitions,
+        check_disk_template_bad_all_errors,
+        resume_phase_good,
+        install_journal_virtual_good,
+        check_filesystems_bad,
+        install_os_resume_layout_bad,
+        install_os_resume_post_install_good,
+        check_layout_good,
+        check_layout_bad,
+        converge_os_swupd_good,
+        converge_configuration_good,
+        converge_users_good,
         validate_network_good,
         validate_network_bad,
         parse_config_good,
         parse_config_bad,
         handle_options_good,
+        lazy_imports_good,
+        render_metrics_good,
+        render_metrics_download_good,
+        metrics_server_good,
         handle_logging_good,
+        rate_limit_filter_good,
+        handle_logging_background_good,
         process_kernel_cmdline_good,
         process_kernel_cmdline_bad_no_isterconf,
         set_kernel_cmdline_appends_good,
@@ -5902,6 +7794,7 @@ if __name__ == '__main__':
         get_iface_for_host_good,
         get_iface_for_host_bad_no_route,
         get_iface_for_host_bad_hostname,
+        get_ifaces_for_host_multiple,
         get_mac_for_iface_good,
         get_mac_for_iface_bad,
         fetch_cloud_init_configs_good,
@@ -5910,17 +7803,37 @@ if __name__ == '__main__':
         get_cloud_init_configs_bad_url_has_no_host,
         get_cloud_init_configs_bad_no_route_to_host,
         get_cloud_init_configs_bad_iface,
+        get_cloud_init_configs_all_ifaces,
+        query_cloud_init_configs_default_last,
         get_cloud_init_configs_bad_no_configs_for_target,
         fetch_cloud_init_role_good,
         fetch_cloud_init_role_bad_cannot_open_url,
         fetch_cloud_init_role_bad_cannot_target_file,
         modify_cloud_init_service_file_good,
         modify_cloud_init_service_file_bad_open,
+        ister_cloud_init_svc_good,
+        create_pxe_partition_offset_good,
+        create_pxe_write_cpio_good,
+        create_pxe_build_initrd_good,
         cloud_init_configs_good,
+        cloud_init_configs_good_no_configs,
         cloud_init_configs_good_no_role,
         gui_network_connection,
         gui_network_connection_curl_exception,
         gui_network_connection_curl_exception_version_url,
+        gui_connection_check_cache,
+        gui_lazy_list_walker,
+        gui_keyboard_search,
+        gui_bundle_selector_state,
+        gui_mount_points_update,
+        gui_lazy_steps,
+        gui_dns_servers,
+        gui_network_service_ready,
+        gui_restart_networkd_resolved,
+        gui_network_monitor,
+        gui_system_facts_cache,
+        gui_system_facts_fallback,
+        gui_read_swupd_mirror,
         gui_static_configuration,
         gui_set_proxy,
         gui_set_mirror,
@@ -35,13 +35,56 @@ then
         exit 1
 fi
 
+function attach_qcow2()
+{
+    # qcow2 overlays are attached to the first free nbd device, the lock
+    # keeps concurrent runs from picking the same one
+    sudo /usr/sbin/modprobe nbd max_part=8
+    exec 9>/tmp/update_gui_expect.lock
+    flock 9
+    for dev in /dev/nbd[0-9]*
+    do
+        if [ ! -e /sys/block/$(basename $dev)/pid ]
+        then
+            sudo qemu-nbd --connect=$dev $1 || continue
+            next_dev=$dev
+            break
+        fi
+    done
+    flock -u 9
+    if [ -z "$next_dev" ]
+    then
+        echo "No free nbd device for $1"
+        exit 1
+    fi
+    for _ in $(seq 50)
+    do
+        [ -e ${next_dev}p2 ] && break
+        sleep 0.1
+    done
+}
+
 mnt=$(/usr/bin/mktemp -d)
-next_dev=$(sudo losetup -f --show -P $1)
+case $1 in
+    *.qcow2)
+        attach_qcow2 $1
+        ;;
+    *)
+        next_dev=$(sudo losetup -f --show -P $1)
+        ;;
+esac
 sudo /usr/bin/mount ${next_dev}p2 $mnt
 sudo cp ister_gui.py ${mnt}/usr/bin/ister_gui.py
 sudo cp ister.py ${mnt}/usr/bin/ister.py
 sudo cp $2 ${mnt}/usr/bin
 sudo cp $3 ${mnt}/usr/lib/systemd/system/ister.service
 sudo /usr/bin/umount $mnt
-sudo /usr/bin/losetup -D
+case $1 in
+    *.qcow2)
+        sudo qemu-nbd --disconnect ${next_dev}
+        ;;
+    *)
+        sudo /usr/bin/losetup -d ${next_dev}
+        ;;
+esac
 echo "$1 set to use expect to drive install"
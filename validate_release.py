@@ -1,15 +1,57 @@
 #!/usr/bin/python3
 
 import argparse
-import ctypes
+import glob
+import hashlib
 import json
 import os
-import pwd
+import shutil
+import socket
 import subprocess
 import sys
 import tempfile
+import threading
 import time
-import urllib.request as request
+import urllib.request
+
+# The scripts and images are used from the source directory
+SRCDIR = os.path.dirname(os.path.abspath(__file__))
+# Resources a scenario virtual machine uses
+VM_CPUS = 2
+VM_MEMORY_MB = 1024
+# Memory qemu needs on top of the guest memory
+VM_OVERHEAD_MB = 256
+TARGET_SIZE = '10G'
+INSTALLER_IMAGE = 'installer-val.img'
+# Read only installer base images, one per version of BASE_INPUTS
+CACHE_DIR = os.path.join(SRCDIR, '.validate-cache')
+# Template and files the installer base image is built from
+BASE_TEMPLATE = 'installer-config-vm.json'
+BASE_INPUTS = ['ister.py', BASE_TEMPLATE,
+               'vm-installation-image-post-update-version.py']
+# Version swupd installs for a template asking for "latest"
+LATEST_VERSION_URL = 'https://download.clearlinux.org/latest'
+# Seconds a stub virtual machine runs
+STUB_SECONDS = 1
+
+# Keeps the lines printed by concurrent runs apart
+OUTPUT_LOCK = threading.Lock()
+
+SCENARIOS = [
+    {'name': 'Automatic Installation',
+     'expect': 'autoinstall.expect',
+     'unit': 'ister-expect.service',
+     'check': None},
+    {'name': 'Manual Installation',
+     'expect': 'maninstall.expect',
+     'unit': 'ister-manexpect.service',
+     'check': None},
+    {'name': 'Manual Installation root Encrypted',
+     'expect': 'encryption.expect',
+     'unit': 'ister-encryption.service',
+     'check': 'encryption'},
+]
+
 
 def handle_options():
     """Setup option parsing
@@ -19,102 +61,329 @@ def handle_options():
                         help='More verbose output.')
     parser.add_argument('-b' , '--bios', action='store', default=None,
                         help='Use specified bios file for qemu')
-    parser.add_argument('-V' , '--vnc', action='store', default=0,
-                        help='Use specified vnc port number')
+    parser.add_argument('-V' , '--vnc', action='store', type=int, default=0,
+                        help='First vnc display number, each run uses the '
+                             'next free one')
+    parser.add_argument('-c', '--cpus', action='store', type=int,
+                        default=os.cpu_count(),
+                        help='CPUs the scenario virtual machines may use '
+                             'together, default=all')
+    parser.add_argument('-m', '--memory', action='store', type=int,
+                        default=None,
+                        help='Memory in MB the scenario virtual machines '
+                             'may use together, default=available memory')
+    parser.add_argument('-w', '--workdir', action='store', default=None,
+                        help='Directory holding the working directory of '
+                             'each run, default=current directory')
+    parser.add_argument('-k', '--keep', action='store_true', default=False,
+                        help='Keep the working directories of successful '
+                             'runs')
+    parser.add_argument('-r', '--rebuild', action='store_true',
+                        default=False,
+                        help='Build the installer base image even when a '
+                             'cached one matches')
+    parser.add_argument('--stub', action='store_true', default=False,
+                        help='Log the commands instead of running them, to '
+                             'test the scheduling without qemu')
     args = parser.parse_args()
 
-    if args.bios is None:
+    if args.bios is None and not args.stub:
         print("Error: -b|--bios require")
         # print("{0}").format(parser.usage)
         sys.exit(1)
+    if args.memory is None:
+        args.memory = available_memory()
+    if args.cpus < VM_CPUS or args.memory < VM_MEMORY_MB + VM_OVERHEAD_MB:
+        print("Error: the budget does not fit a single virtual machine")
+        sys.exit(1)
 
     return args
 
 
-def spin_up_installer():
-    print(">>> Spinning new installer into ./installer-val.img")
-    if os.path.isfile('./installer-val.img'):
-        os.remove('./installer-val.img')
-    cp = subprocess.run(['qemu-img', 'create', 'installer-val.img', '2G'])
-    cp = subprocess.run(['sudo', 'python3', 'ister.py', '-t',
-        'installer-config-vm.json'])
-    cp.check_returncode()
-
-
-def validate_installer(args, expectfile, unitfile, alternative_check=None):
-    print(">>> Configuring installer-val.img to be driven by expect using new ister and gui")
-    cp = subprocess.run(['sudo', './update_gui_expect.sh', 'installer-val.img',
-                         expectfile, unitfile])
-    cp.check_returncode()
-
-    print(">>> Create target image for install")
-    if os.path.isfile('installer-target.img'):
-        os.remove('./installer-target.img')
-    cp = subprocess.run(['qemu-img', 'create', 'installer-target.img', '10G'])
-    cp.check_returncode()
-
-    print(">>> Booting installer-val.img against installer-target.img")
-    cp = subprocess.run(['sudo', 'qemu-system-x86_64', '-enable-kvm', '-m',
-                         '1024', '-vnc', '0.0.0.0:{}'.format(args.vnc), '-cpu', 'host', '-drive',
-                         'file=installer-target.img,if=virtio,aio=threads',
-                         '-drive', 'file=installer-val.img,if=virtio,aio=threads',
-                         '-net', 'nic,model=virtio', '-net',
-                         'user,hostfwd=tcp::2233-:22', '-smp', '2',
-                         '-bios', args.bios])
-    cp.check_returncode()
-
-    if not alternative_check:
-        print(">>> Installing boot canary into installer-target.mg")
-        cp = subprocess.run(['sudo', './install-canary.sh', 'installer-target.img'])
-        cp.check_returncode()
-
-        print(">>> Booting installer-target.img")
-        cp = subprocess.run(['sudo', 'qemu-system-x86_64', '-enable-kvm', '-m',
-                             '1024', '-vnc', '0.0.0.0:{}'.format(args.vnc), '-cpu', 'host', '-drive',
-                             'file=installer-target.img,if=virtio,aio=threads',
-                             '-net', 'nic,model=virtio', '-net',
-                             'user,hostfwd=tcp::2233-:22', '-smp', '2',
-                             '-bios', args.bios])
-        cp.check_returncode()
-
-        # Check for boot canary
-        cp = subprocess.run(['sudo', './check-canary.sh', 'installer-target.img'])
-
-        status_code = cp.returncode
-    else:
-        status_code = alternative_check(args)
-
-    if status_code == 0:
-        status = ">>> SUCCESS! Boot Canary detected!"
-    else:
-        status = ">>> Failure: installer-target.img failed to boot"
-
-    print(status)
-    return status
-
-def encryption_validation(args):
-    cp = subprocess.run(['sudo', './post-encryption.expect', args.bios])
-    cp.check_returncode()
-    return cp.returncode
+def say(message):
+    """Print message, runs may print concurrently"""
+    with OUTPUT_LOCK:
+        print(message, flush=True)
+
+
+def available_memory():
+    """Return the MemAvailable of /proc/meminfo in MB"""
+    with open('/proc/meminfo') as meminfo:
+        for line in meminfo:
+            if line.startswith('MemAvailable:'):
+                return int(line.split()[1]) // 1024
+    return VM_MEMORY_MB + VM_OVERHEAD_MB
+
+
+class Budget(object):
+    """CPUs and memory shared by the runs, acquire blocks until the run fits
+    """
+    def __init__(self, cpus, memory):
+        self.cpus = cpus
+        self.memory = memory
+        self._cond = threading.Condition()
+
+    def acquire(self, cpus, memory):
+        with self._cond:
+            self._cond.wait_for(lambda: self.cpus >= cpus and
+                                self.memory >= memory)
+            self.cpus -= cpus
+            self.memory -= memory
+
+    def release(self, cpus, memory):
+        with self._cond:
+            self.cpus += cpus
+            self.memory += memory
+            self._cond.notify_all()
+
+
+class PortAllocator(object):
+    """Hand out free host ports, never the same one to two runs"""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._used = set()
+
+    def allocate(self, first=1024):
+        """Return a free port, the first one from first up"""
+        with self._lock:
+            port = first
+            while port in self._used or not port_free(port):
+                port += 1
+            self._used.add(port)
+            return port
+
+    def release(self, port):
+        with self._lock:
+            self._used.discard(port)
+
+
+def port_free(port):
+    """Whether nothing listens on port"""
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        try:
+            sock.bind(('0.0.0.0', port))
+        except OSError:
+            return False
+    return True
+
+
+def qemu_runner(cmd, log):
+    """Run cmd with its output in log, return its exit code"""
+    log.write('$ {}\n'.format(' '.join(cmd)))
+    log.flush()
+    return subprocess.run(cmd, stdout=log, stderr=subprocess.STDOUT,
+                          cwd=SRCDIR).returncode
+
+
+def stub_runner(cmd, log):
+    """Log cmd instead of running it, virtual machines take STUB_SECONDS"""
+    log.write('$ {}\n'.format(' '.join(cmd)))
+    log.flush()
+    if any(part.startswith('qemu-system') or part.endswith('.expect')
+           for part in cmd):
+        time.sleep(STUB_SECONDS)
+    return 0
+
+
+def run_step(run, cmd, log):
+    """Run cmd, raise an Exception when it fails"""
+    if run(cmd, log) != 0:
+        raise Exception("{} failed".format(' '.join(cmd)))
+
+
+def spin_up_installer(run):
+    print(">>> Spinning new installer into {}".format(
+        os.path.join(SRCDIR, INSTALLER_IMAGE)))
+    run(['rm', '-f', INSTALLER_IMAGE], sys.stdout)
+    run(['qemu-img', 'create', INSTALLER_IMAGE, '2G'], sys.stdout)
+    if run(['sudo', 'python3', 'ister.py', '-t',
+            BASE_TEMPLATE], sys.stdout) != 0:
+        raise Exception("Unable to create {}".format(INSTALLER_IMAGE))
+
+
+def base_version():
+    """Return the version the installer base image installs, None when the
+    template asks for "latest" and it can't be found out"""
+    with open(os.path.join(SRCDIR, BASE_TEMPLATE)) as template:
+        version = json.load(template).get('Version', 'latest')
+    if version != 'latest':
+        return str(version)
+    try:
+        with urllib.request.urlopen(LATEST_VERSION_URL,
+                                    timeout=10) as latest:
+            return latest.read().decode('utf-8').strip()
+    except (OSError, ValueError) as exep:
+        print(">>> Unable to get the latest version: {}".format(exep))
+        return None
+
+
+def base_key(version):
+    """Return the hash of the files the installer base image is built
+    from and of the version it installs"""
+    sha = hashlib.sha256(b'version\0' + str(version).encode('utf-8'))
+    for name in BASE_INPUTS:
+        with open(os.path.join(SRCDIR, name), 'rb') as base_input:
+            sha.update(name.encode('utf-8') + b'\0' + base_input.read())
+    return sha.hexdigest()[:16]
+
+
+def installer_base(args, run):
+    """Return the read only installer base image, building it when no cached
+    one was built from the current BASE_INPUTS and version"""
+    version = base_version()
+    base = os.path.join(CACHE_DIR, 'installer-{}.img'.format(
+        base_key(version)))
+    if os.path.isfile(base) and not args.rebuild and version is not None:
+        print(">>> Reusing installer base {} of version {}".format(base,
+                                                                   version))
+        return base
+    spin_up_installer(run)
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    # bases built from older inputs are not used any more
+    for old in glob.glob(os.path.join(CACHE_DIR, 'installer-*.img')):
+        run_step(run, ['rm', '-f', old], sys.stdout)
+    run_step(run, ['mv', INSTALLER_IMAGE, base], sys.stdout)
+    run_step(run, ['chmod', '0444', base], sys.stdout)
+    return base
+
+
+def qemu_cmd(args, port, vnc, drives):
+    """Return the qemu command line booting drives"""
+    cmd = ['sudo', 'qemu-system-x86_64', '-enable-kvm', '-m',
+           str(VM_MEMORY_MB), '-vnc', '0.0.0.0:{}'.format(vnc), '-cpu',
+           'host']
+    for drive in drives:
+        cmd.extend(['-drive', 'file={},if=virtio,aio=threads'.format(drive)])
+    cmd.extend(['-net', 'nic,model=virtio', '-net',
+                'user,hostfwd=tcp::{}-:22'.format(port), '-smp',
+                str(VM_CPUS), '-bios', str(args.bios)])
+    return cmd
+
+
+def validate_installer(args, scenario, run, workdir, port, vnc, log):
+    """Install to a new target with the installer driven by the scenario
+    expect file and check the target boots, return the exit code
+
+    The installer is a copy on write overlay of the base image, only the
+    files update_gui_expect.sh changes are written to the run.
+    """
+    installer = os.path.join(workdir, 'installer-overlay.qcow2')
+    target = os.path.join(workdir, 'installer-target.img')
+
+    def step(cmd):
+        run_step(run, cmd, log)
+
+    log.write(">>> Configuring {} to be driven by expect using new ister "
+              "and gui\n".format(installer))
+    step(['qemu-img', 'create', '-f', 'qcow2', '-F', 'raw', '-b',
+          args.base, installer])
+    step(['sudo', './update_gui_expect.sh', installer, scenario['expect'],
+          scenario['unit']])
+
+    log.write(">>> Create target image for install\n")
+    step(['qemu-img', 'create', target, TARGET_SIZE])
+
+    log.write(">>> Booting {} against {}\n".format(installer, target))
+    step(qemu_cmd(args, port, vnc, [target, installer]))
+
+    if scenario['check'] == 'encryption':
+        return run(['sudo', './post-encryption.expect', str(args.bios),
+                    target, str(port)], log)
+
+    log.write(">>> Installing boot canary into {}\n".format(target))
+    step(['sudo', './install-canary.sh', target])
+
+    log.write(">>> Booting {}\n".format(target))
+    step(qemu_cmd(args, port, vnc, [target]))
+
+    # Check for boot canary
+    return run(['sudo', './check-canary.sh', target], log)
+
+
+def run_scenario(args, scenario, run, budget, ports, result):
+    """Run a scenario once it fits the budget, filling in result"""
+    memory = VM_MEMORY_MB + VM_OVERHEAD_MB
+    queued = time.monotonic()
+    budget.acquire(VM_CPUS, memory)
+    port = ports.allocate(2233)
+    vnc = ports.allocate(5900 + args.vnc) - 5900
+    result['wait'] = time.monotonic() - queued
+    started = time.monotonic()
+    workdir = os.path.abspath(tempfile.mkdtemp(prefix='validate-',
+                                               dir=args.workdir or '.'))
+    result['workdir'] = workdir
+    say(">>> {} started in {} (ssh port {}, vnc :{})".format(
+        scenario['name'], workdir, port, vnc))
+    try:
+        with open(os.path.join(workdir, 'validate.log'), 'w') as log:
+            code = validate_installer(args, scenario, run, workdir, port,
+                                      vnc, log)
+        if code == 0:
+            result['status'] = "SUCCESS! Boot Canary detected!"
+        else:
+            result['status'] = "Failure: target failed to boot"
+    except Exception as exep:
+        result['status'] = "Failed: {}".format(exep)
+        code = -1
+    finally:
+        ports.release(port)
+        ports.release(vnc + 5900)
+        budget.release(VM_CPUS, memory)
+        result['time'] = time.monotonic() - started
+    result['ok'] = code == 0
+    say(">>> {} {}".format(scenario['name'], result['status']))
+    if result['ok'] and not args.keep:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def run_scenarios(args, scenarios, run):
+    """Run the scenarios concurrently within the budget, return their
+    results"""
+    budget = Budget(args.cpus, args.memory)
+    ports = PortAllocator()
+    results = [{'name': scenario['name'], 'status': 'not run', 'ok': False,
+                'wait': 0.0, 'time': 0.0, 'workdir': None}
+               for scenario in scenarios]
+    threads = [threading.Thread(target=run_scenario,
+                                args=(args, scenario, run, budget, ports,
+                                      result))
+               for scenario, result in zip(scenarios, results)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+def print_summary(results, elapsed):
+    """Print the timing summary table of the runs"""
+    width = max(len(result['name']) for result in results)
+    print('\n{0:<{w}}  {1:>8}  {2:>8}  {3}'.format('Scenario', 'waited',
+                                                   'ran', 'result', w=width))
+    for result in results:
+        print('{0:<{w}}  {1:>7.0f}s  {2:>7.0f}s  {3}'.format(
+            result['name'], result['wait'], result['time'],
+            result['status'], w=width))
+    print('{0:<{w}}  {1:>8}  {2:>7.0f}s  (sequential {3:.0f}s)'.format(
+        'Total', '', elapsed, sum(result['time'] for result in results),
+        w=width))
+
 
 def main():
     """Start the installer
     """
     args = handle_options()
+    run = stub_runner if args.stub else qemu_runner
+    start = time.monotonic()
     try:
-        spin_up_installer()
-        autostatus = validate_installer(args, 'autoinstall.expect', 'ister-expect.service')
-        manstatus = validate_installer(args, 'maninstall.expect', 'ister-manexpect.service')
-        encryptstatus = validate_installer(args, 'encryption.expect', 'ister-encryption.service', encryption_validation)
-        print('\nAutomatic Installation', autostatus)
-        print('Manual Installation   ', manstatus)
-        print('Manual Installation root Encrypted   ', encryptstatus)
+        args.base = installer_base(args, run)
     except Exception as exep:
         print("Failed: {}".format(exep))
         sys.exit(-1)
 
-    sys.exit(0)
+    results = run_scenarios(args, SCENARIOS, run)
+    print_summary(results, time.monotonic() - start)
+    sys.exit(0 if all(result['ok'] for result in results) else -1)
 
 if __name__ == '__main__':
     main()
-